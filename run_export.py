@@ -0,0 +1,60 @@
+import os
+import time
+import argparse
+import numpy as np
+
+from run_server import load_model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--training-data-dir', type=str, required=True,
+                        help='path of training data')
+    parser.add_argument('--embed-dir', type=str, required=True,
+                        help='directory with the checkpoint and args.bin written by run_unsupervised.py')
+    parser.add_argument('--gpu', type=int, default=1,
+                        help='index of gpu card')
+    parser.add_argument('--output', type=str, default='',
+                        help='path of the frozen graph (default: embed-dir/CGAT_frozen.pb)')
+    parser.add_argument('--feed-tables', action='store_true',
+                        help='Keep graph tables out of the frozen graph, they are loaded from a side file')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    from tensorflow.python.util import deprecation
+    from src.export import inference_outputs, freeze, save, FrozenModel
+    deprecation._PRINT_DEPRECATION_WARNINGS = False
+
+    output = args.output or '{}/CGAT_frozen.pb'.format(args.embed_dir)
+    loader, placeholders, minibatch, model, sess = load_model(args)
+    inference_outputs(model)
+    graph_def, tables = freeze(sess, model, placeholders, feed_tables=args.feed_tables)
+    save(output, graph_def, tables)
+    print ('graph {}: {} MB'.format(output, os.path.getsize(output) // 2**20))
+    if len(tables) > 0:
+        print ('tables {}.tables: {} MB ({})'.format(output, os.path.getsize('{}.tables'.format(output)) // 2**20,
+                                                      ', '.join(sorted(tables.keys()))))
+
+    # the frozen graph must give the embeddings of the training graph
+    t = time.time()
+    frozen = FrozenModel(output)
+    print ('loaded frozen graph in {:.1f}s'.format(time.time() - t))
+    nodes = np.array(minibatch.nodes[:256])
+    feed_dict = {placeholders['batch1']: nodes, placeholders['batch_size']: len(nodes),
+                 placeholders['is_training']: False}
+    expected = sess.run(model.embeddings, feed_dict=feed_dict)
+    t = time.time()
+    embeddings = frozen.embed(nodes)
+    print ('embedded {} nodes in {:.1f}ms'.format(len(nodes), (time.time() - t) * 1000))
+    # neighbors are sampled, so only the deterministic part of the check is exact
+    print ('embedding shape {} (expected {}), mean cosine to the trained graph {:.4f}'.format(
+            embeddings.shape, expected.shape, float(np.mean(np.sum(embeddings * expected, axis=1)))))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,141 @@
+import os
+import multiprocessing as mp
+import numpy as np
+
+from src.parallel import DataParallelTrainer
+from run_unsupervised import get_parser
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--workers', type=str, default='1,2,4,8',
+                        help='Comma separated numbers of worker processes to run')
+    parser.add_argument('--steps', type=int, default=500,
+                        help='Number of synchronous steps per run')
+    parser.add_argument('--partitions', type=int, default=0,
+                        help='Graph-partitioned mode with one worker per partition (0: data parallel)')
+    parser.add_argument('--partition-dir', type=str, default='',
+                        help='Directory of the saved partition stores, split from the training data if '
+                             'missing (default: $embed_dir/partitions_$partitions)')
+    parser.add_argument('--halo-cache', type=int, default=1000000,
+                        help='Maximum number of cached remote rows per table')
+    parser.add_argument('--worker-memory-gb', type=float, default=16.,
+                        help='Memory budget per worker for the capacity estimate')
+    parser.add_argument('--sync-timeout', type=float, default=600.,
+                        help='Seconds a worker waits for the others before the run is aborted')
+    return parser.parse_args()
+
+def split_partitions(args, dirname):
+    """
+    Load the whole graph once and save one store per partition; runs in its own
+    process, so that neither the trainer nor the partition servers hold the graph
+    """
+    from src.data_loader import DataLoader
+    from src.partition import save_partitions
+    loader = DataLoader(args.training_data_dir, stream_walks=args.stream_walks)
+    save_partitions(loader, args.partitions, dirname)
+
+def train_partitioned(args):
+    """
+    One worker per partition: it trains on walks rooted in its partition, and gets
+    neighbor rows of the halo from their owners through a local RPC stand-in.
+    Partition servers and workers only load their own store from disk
+    """
+    from src.partition import PartitionStore, HaloClient, serve_partition, build_local_data, \
+        table_bytes, peak_rss, load_meta, partition_key
+    from src.cache import ArtifactCache
+    from src.data_loader import SEED
+
+    ctx = mp.get_context('fork')
+    dirname = args.partition_dir or '{}/partitions_{}'.format(args.embed_dir, args.partitions)
+    meta = load_meta(dirname) if os.path.exists(os.path.join(dirname, 'meta.bin')) else None
+    # stores are split again when the data, the split or the partition settings change
+    key = partition_key(ArtifactCache(args.training_data_dir, SEED), SEED, args.partitions, args.stream_walks)
+    if meta is None or meta.get('key') != key:
+        if meta is not None:
+            print ('{} is stale, split again'.format(dirname))
+        split = ctx.Process(target=split_partitions, args=(args, dirname))
+        split.start()
+        split.join()
+        if split.exitcode != 0:
+            raise RuntimeError('splitting the graph into {} failed'.format(dirname))
+        meta = load_meta(dirname)
+    parts = meta['parts']
+    print ('===== {} partitions from {}, sizes: {} ====='.format(
+            args.partitions, dirname, np.bincount(parts, minlength=args.partitions).tolist()))
+
+    # every partition serves its own tables
+    queue = ctx.Queue()
+    servers = []
+    for part in range(args.partitions):
+        server = ctx.Process(target=serve_partition, args=(dirname, part, queue))
+        server.daemon = True
+        server.start()
+        servers.append(server)
+    addresses = dict([queue.get() for part in range(args.partitions)])
+
+    def data_fn(rank):
+        store = PartitionStore.load(dirname, rank)
+        client = HaloClient(rank, parts, addresses, cache_size=args.halo_cache)
+        data_trn, nodes = build_local_data(store, client, meta['vocab_dim'], hops=2, seed=meta['seed'])
+        # memory per worker and how many owned nodes fit into the budget at this halo ratio
+        sizes = table_bytes(data_trn, args.max_degree)
+        total = sum(sizes.values())
+        owned = np.count_nonzero(parts == rank)
+        print ('partition {}: tables {} MB ({}), peak rss {} MB, {:.0f} table bytes per owned node, '
+               '~{} owned nodes fit in {} GB'.format(
+                rank, total // 2**20, ', '.join(['{}={}MB'.format(k, v // 2**20) for k, v in sizes.items()]),
+                peak_rss() // 2**20, total / owned, int(args.worker_memory_gb * 2**30 / (total / owned)),
+                args.worker_memory_gb))
+        return data_trn
+
+    trainer = DataParallelTrainer(args, args.partitions, data_fn,
+                                  meta['feature_dim'], meta['vocab_dim'], args.sync_timeout)
+    try:
+        stats = trainer.run(args.steps, save=True)
+    finally:
+        for server in servers:
+            server.terminate()
+    print ('partitions\tpairs/sec\tloss\tmrr\tpeak rss MB')
+    print ('{}\t{:.1f}\t{:.5f}\t{:.5f}\t{}'.format(stats['workers'], stats['pairs_per_sec'], stats['loss'],
+                                                stats['mrr'], stats['peak_rss'] // 2**20))
+
+def main():
+    args = parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
+    # tensorflow is only imported by the forked workers, after these are set
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    from src.data_loader import DataLoader
+
+    if args.partitions > 0:
+        train_partitioned(args)
+        return
+
+    # load data once, forked workers share it
+    loader = DataLoader(args.training_data_dir, stream_walks=args.stream_walks)
+
+    workers = [int(n) for n in args.workers.split(',')]
+    stats = []
+    for num_workers in workers:
+        # each worker trains on its own shard of walk pairs
+        def data_fn(rank, num_workers=num_workers):
+            walks = loader.walks
+            walks = walks.shard(rank, num_workers) if args.stream_walks else walks[rank::num_workers]
+            return (loader.G_trn, loader.features, walks,
+                    loader.edge_text, len(loader.vocab))
+        print ('===== data parallel training with {} workers ====='.format(num_workers))
+        trainer = DataParallelTrainer(args, num_workers, data_fn,
+                                      loader.features.shape[1], len(loader.vocab), args.sync_timeout)
+        stats.append(trainer.run(args.steps, save=(num_workers == workers[-1])))
+
+    # scaling efficiency: throughput relative to linear scaling of the smallest run
+    base = stats[0]['pairs_per_sec'] / stats[0]['workers']
+    print ('workers\tpairs/sec\tspeedup\tefficiency\tloss\tmrr')
+    for s in stats:
+        print ('{}\t{:.1f}\t{:.2f}\t{:.2f}\t{:.5f}\t{:.5f}'.format(
+            s['workers'], s['pairs_per_sec'], s['pairs_per_sec'] / stats[0]['pairs_per_sec'],
+            s['pairs_per_sec'] / (base * s['workers']), s['loss'], s['mrr']))
+
+if __name__=='__main__':
+    main()
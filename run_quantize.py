@@ -0,0 +1,96 @@
+import os
+import time
+import argparse
+import pickle as pkl
+import numpy as np
+
+from src.data_loader import DataLoader
+from src.quantize import quantize_int8, dequantize_int8, ScalarQuantizer, ProductQuantizer, link_mrr
+from run_retrieval import load_embeddings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--training-data-dir', type=str, required=True,
+                        help='path of training data (for the held-out edges of G_tst)')
+    parser.add_argument('--embed-dir', type=str, required=True,
+                        help='directory with CGAT.bin and CGAT_topic.bin, quantized files are saved next to them')
+    parser.add_argument('--pq-sub', type=int, default=0,
+                        help='Number of PQ subspaces, 1 byte each (0: dim / 4, i.e. 16x smaller than float32)')
+    parser.add_argument('--pq-codes', type=int, default=256,
+                        help='Number of centroids per PQ subspace (at most 256)')
+    parser.add_argument('--neg-sample', type=int, default=100,
+                        help='Number of negatives per held-out edge for MRR')
+    parser.add_argument('--eval-edges', type=int, default=100000,
+                        help='Maximum number of held-out edges for MRR')
+
+    return parser.parse_args()
+
+def quantize_topics(embed_dir):
+    """
+    int8 beta and phi of every layer; beta rows are renormalized after decoding
+    """
+    with open('{}/CGAT_topic.bin'.format(embed_dir), 'rb') as f:
+        (beta, phi) = pkl.load(f)
+    quantized = ([quantize_int8(b) for b in beta], [quantize_int8(p) for p in phi])
+    filename = '{}/CGAT_topic_int8.bin'.format(embed_dir)
+    with open(filename, 'wb') as f:
+        pkl.dump(quantized, f, protocol=4)
+    print ('topics: {} KB -> {} KB'.format(os.path.getsize('{}/CGAT_topic.bin'.format(embed_dir)) // 1024,
+                                           os.path.getsize(filename) // 1024))
+    for layer, (b, q) in enumerate(zip(beta, quantized[0])):
+        decoded = dequantize_int8(*q)
+        decoded /= decoded.sum(axis=1, keepdims=True)
+        k = min(20, b.shape[1])
+        top = np.argsort(-b, axis=1)[:, :k]
+        top_q = np.argsort(-decoded, axis=1)[:, :k]
+        overlap = np.mean([len(set(t) & set(tq)) / float(k) for t, tq in zip(top, top_q)])
+        print ('layer {}: beta max abs error {:.2e}, top-{} words overlap {:.4f}'.format(
+                layer + 1, np.abs(decoded - b).max(), k, overlap))
+
+def main():
+    args = parse_args()
+    rand = np.random.RandomState(0)
+
+    embeddings, nodes = load_embeddings(args.embed_dir)
+    # float32 embedding bytes, without the pickle overhead of CGAT.bin
+    raw = len(embeddings) * embeddings.shape[1] * 4
+    pq_sub = args.pq_sub or embeddings.shape[1] // 4
+
+    # held-out edges between embedded nodes, as store rows
+    loader = DataLoader(args.training_data_dir, stream_walks=True)
+    rows = -np.ones(nodes.max() + 1, dtype=np.int64)
+    rows[nodes] = np.arange(len(nodes))
+    edges = np.array(list(loader.G_tst.edges()), dtype=np.int64).reshape(-1, 2)
+    edges = edges[(edges.max(axis=1) <= nodes.max())]
+    edges = rows[edges]
+    edges = edges[(edges >= 0).all(axis=1)]
+    edges = edges[rand.permutation(len(edges))[:args.eval_edges]]
+    negatives = rand.randint(len(nodes), size=(len(edges), args.neg_sample))
+    print ('===== MRR on {} held-out edges, {} negatives each ====='.format(len(edges), args.neg_sample))
+
+    def float_scores(rows1, rows2):
+        return np.einsum('ij,ij->i', embeddings[rows1], embeddings[rows2])
+
+    # ratio: float32 embedding bytes over the bytes of the store arrays
+    print ('store\tbytes/vector\tfile MB\tratio\tmrr\tbuild s')
+    print ('float32\t{}\t{:.1f}\t1.0\t{:.5f}\t-'.format(embeddings.shape[1] * 4,
+                                                     os.path.getsize('{}/CGAT.bin'.format(args.embed_dir)) / 2.**20,
+                                                     link_mrr(float_scores, edges, negatives)))
+    stores = [('int8', ScalarQuantizer(), embeddings.shape[1] + 4),
+              ('pq', ProductQuantizer(pq_sub, args.pq_codes), pq_sub)]
+    for name, store, size in stores:
+        t = time.time()
+        store.build(embeddings, nodes)
+        elapsed = time.time() - t
+        filename = '{}/CGAT_{}.bin'.format(args.embed_dir, name)
+        store.save(filename)
+        print ('{}\t{}\t{:.1f}\t{:.1f}\t{:.5f}\t{:.1f}'.format(
+                name, size, os.path.getsize(filename) / 2.**20, raw / float(store.nbytes()),
+                link_mrr(store.pair_scores, edges, negatives), elapsed))
+
+    quantize_topics(args.embed_dir)
+
+if __name__=='__main__':
+    main()
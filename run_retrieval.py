@@ -0,0 +1,67 @@
+import time
+import argparse
+import pickle as pkl
+import numpy as np
+
+from src.retrieval import IVFIndex
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--training-data-dir', type=str, required=True,
+                        help='path of training data (user_map.bin, item_map.bin)')
+    parser.add_argument('--embed-dir', type=str, required=True,
+                        help='directory with CGAT.bin, the index is saved next to it')
+    parser.add_argument('--target', type=str, default='item', choices=['item', 'user', 'all'],
+                        help='nodes indexed for retrieval')
+    parser.add_argument('--nlist', type=int, default=100,
+                        help='Number of inverted lists')
+    parser.add_argument('--nprobe', type=int, default=8,
+                        help='Number of lists scanned per query')
+    parser.add_argument('--topk', type=int, default=10,
+                        help='Number of retrieved nodes per query')
+    parser.add_argument('--eval-queries', type=int, default=1000,
+                        help='Number of queries to measure recall against exact search')
+
+    return parser.parse_args()
+
+def load_embeddings(embed_dir):
+    with open('{}/CGAT.bin'.format(embed_dir), 'rb') as f:
+        (embeddings, nodes) = pkl.load(f)
+    return np.array(embeddings, dtype=np.float32), np.array(nodes, dtype=np.int64)
+
+def node_range(folder, target):
+    """
+    Node idx of users/items, None for all nodes
+    """
+    if target == 'all':
+        return None
+    with open('{}/{}_map.bin'.format(folder, target), 'rb') as f:
+        id_map = pkl.load(f)
+    return np.array(list(id_map.values()), dtype=np.int64)
+
+def main():
+    args = parse_args()
+
+    embeddings, nodes = load_embeddings(args.embed_dir)
+    targets = node_range(args.training_data_dir, args.target)
+    mask = np.ones(len(nodes), dtype=bool) if targets is None else np.isin(nodes, targets)
+
+    t = time.time()
+    index = IVFIndex(args.nlist, args.nprobe).build(embeddings[mask], nodes[mask])
+    print ('build time: {:.3f}s'.format(time.time() - t))
+    index.save('{}/CGAT_ann_{}.bin'.format(args.embed_dir, args.target))
+
+    # queries: users for item retrieval, otherwise any node
+    queries = embeddings[~mask] if args.target == 'item' and (~mask).any() else embeddings
+    queries = queries[np.random.RandomState(0).permutation(len(queries))[:args.eval_queries]]
+    t = time.time()
+    index.search(queries, args.topk)
+    elapsed = time.time() - t
+    print ('query: {:.3f} ms/query'.format(1000 * elapsed / len(queries)))
+    for nprobe in sorted(set([1, args.nprobe // 2, args.nprobe, 2 * args.nprobe]) - set([0])):
+        print ('nprobe={}: recall@{}={:.4f}'.format(nprobe, args.topk, index.recall(queries, args.topk, nprobe)))
+
+if __name__=='__main__':
+    main()
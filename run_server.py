@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import argparse
+import contextlib
+import pickle as pkl
+
+from src.lazy import START
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--training-data-dir', type=str, required=True,
+                        help='path of training data')
+    parser.add_argument('--embed-dir', type=str, required=True,
+                        help='directory with the checkpoint and args.bin written by run_unsupervised.py')
+    parser.add_argument('--gpu', type=int, default=1,
+                        help='index of gpu card')
+
+    parser.add_argument('--mode', type=str, default='http', choices=['http', 'stdio'],
+                        help='http server, or json lines over stdin/stdout')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port of http server')
+    parser.add_argument('--max-batch', type=int, default=256,
+                        help='Maximum number of items in one micro-batch')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0,
+                        help='Maximum time to wait for filling a micro-batch')
+    parser.add_argument('--queue-size', type=int, default=1024,
+                        help='Maximum number of pending requests')
+    parser.add_argument('--stdio-workers', type=int, default=64,
+                        help='Maximum number of json lines served concurrently in stdio mode')
+    parser.add_argument('--reserve-nodes', type=int, default=1000,
+                        help='Number of table rows kept for cold-start nodes')
+    parser.add_argument('--reserve-edges', type=int, default=10000,
+                        help='Number of table rows kept for cold-start edge docs')
+
+    return parser.parse_args()
+
+def load_model(args, reserve_nodes=0, reserve_edges=0):
+    """
+    Rebuild the trained model from args.bin and restore the checkpoint in args.embed_dir
+    """
+    import tensorflow as tf
+    from src.data_loader import DataLoader
+    from run_unsupervised import build_model
+
+    with open('{}/args.bin'.format(args.embed_dir), 'rb') as f:
+        train_args = argparse.Namespace(**pkl.load(f))
+    # cluster batches only change training, inference uses the full adj lists
+    train_args.cluster_batch = 0
+
+    # load data and rebuild the trained model (no walk list, inference never trains)
+    loader = DataLoader(args.training_data_dir, stream_walks=True)
+    data_trn = (loader.G_trn, loader.features, loader.walks, loader.edge_text, len(loader.vocab))
+    placeholders, minibatch, model, sess = build_model(data_trn, train_args, reserve_nodes=reserve_nodes,
+                                                       reserve_edges=reserve_edges)
+    # graph tables are rebuilt from the data (with reserved rows), restore the model only
+    sampler = model.layer_infos[0].neighbor_sampler
+    tables = [model.features, model.edge_idxs, model.edge_words, model.edge_counts, sampler.adj_info]
+    if sampler.weights is not None:
+        tables.append(sampler.weights)
+    tables = set([v.name for v in tables])
+    checkpoint = tf.train.latest_checkpoint(args.embed_dir)
+    tf.train.Saver([v for v in tf.global_variables() if v.name not in tables]).restore(sess, checkpoint)
+    print ('===== restored {} ====='.format(checkpoint))
+    return (loader, placeholders, minibatch, model, sess)
+
+def load_server(args):
+    from src.serving import InferenceServer, ColdStart
+    loader, placeholders, minibatch, model, sess = load_model(args, args.reserve_nodes, args.reserve_edges)
+    server = InferenceServer(sess, model, placeholders, max_batch=args.max_batch,
+                             max_wait=args.max_wait_ms / 1000., queue_size=args.queue_size,
+                             cold_start=ColdStart(sess, model, minibatch, loader))
+    return (server, loader)
+
+def main():
+    args = parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    from tensorflow.python.util import deprecation
+    from src.serving import serve_stdio, serve_http
+    deprecation._PRINT_DEPRECATION_WARNINGS = False
+
+    if args.mode == 'http':
+        server, _ = load_server(args)
+        print ('===== startup {:.1f}s ====='.format(time.time() - START))
+        serve_http(server, args.port)
+    else:
+        # keep stdout for responses only
+        with contextlib.redirect_stdout(sys.stderr):
+            server, _ = load_server(args)
+            print ('===== startup {:.1f}s ====='.format(time.time() - START))
+        serve_stdio(server, workers=args.stdio_workers)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,263 @@
+import os
+import time
+import itertools
+import argparse
+import multiprocessing as mp
+import numpy as np
+
+from run_unsupervised import get_parser
+
+# data inherited by forked trials, read-only: (data_trn, {max_degree: EdgeBatch tables}, eval pairs);
+# host arrays are shared copy-on-write, and fed to the trial sessions without a copy
+SHARED = {}
+# dtypes of the placeholders the shared tables are fed to (build_model)
+TABLE_DTYPES = {'features': np.float32, 'adj': np.int32, 'edge_idx': np.int32,
+                'edge_words': np.int32, 'edge_counts': np.float32}
+# values of swept store_true flags
+BOOLS = {'1': True, 'true': True, 'yes': True, '0': False, 'false': False, 'no': False}
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument('--grid', type=str, required=True,
+                        help='Swept values, e.g. "dim1=64,128;attn_head1=4,8;sample1=10,25;dropout=0,0.2"')
+    parser.add_argument('--steps', type=int, default=2000,
+                        help='Number of training steps per trial')
+    parser.add_argument('--pool', type=int, default=2,
+                        help='Number of trials running at the same time')
+    parser.add_argument('--trial-threads', type=int, default=0,
+                        help='Number of tf threads per trial (0: cores split between the pool)')
+    parser.add_argument('--trial-memory-gb', type=float, default=0.,
+                        help='Resident memory limit per trial, the trial is stopped beyond it (0: unlimited)')
+    parser.add_argument('--trial-timeout', type=int, default=3600,
+                        help='Wall time limit per trial in seconds')
+    parser.add_argument('--eval-pairs', type=int, default=10000,
+                        help='Number of held-out walk pairs for the MRR of every trial')
+    return parser.parse_args()
+
+def parse_grid(grid, args):
+    """
+    All combinations of the swept values, typed like the parser defaults
+    (flags take 0/1, true/false or yes/no)
+    """
+    names = []
+    values = []
+    for item in grid.split(';'):
+        name, vals = item.split('=')
+        name = name.strip().replace('-', '_')
+        default = getattr(args, name)
+        if isinstance(default, bool):
+            def cast(v, name=name):
+                if v.strip().lower() not in BOOLS:
+                    raise ValueError('{}: {} is not a boolean'.format(name, v))
+                return BOOLS[v.strip().lower()]
+        else:
+            cast = type(default)
+        names.append(name)
+        values.append([cast(v) for v in vals.split(',')])
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+def aligned(array, dtype, alignment=64):
+    """
+    Copy of array with the given dtype, at an address tensorflow can read in place when fed
+    """
+    array = np.asarray(array)
+    size = array.size * np.dtype(dtype).itemsize
+    buf = np.empty(size + alignment, dtype=np.uint8)
+    offset = -buf.ctypes.data % alignment
+    out = buf[offset : offset + size].view(dtype).reshape(array.shape)
+    out[...] = array
+    return out
+
+def rss_bytes(pid):
+    """
+    Resident memory of a process (Linux /proc), 0 if unknown
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return 0
+
+def split_eval_pairs(walks, num_pairs, seed=0):
+    """
+    Fixed held-out walk pairs, the same for every trial
+    Returns:
+        eval pairs [num_pairs, 2], training walks without them
+    A list of walks is split; streamed walks are regenerated every epoch, so the
+    eval pairs are drawn from an epoch of their own (seed - 1, never trained on)
+    and may still coincide with some pairs of the training epochs
+    """
+    from src.data_loader import WalkStream
+    rand = np.random.RandomState(seed)
+    if isinstance(walks, WalkStream):
+        pairs = []
+        for chunk in walks.epoch(-1):
+            pairs.append(chunk)
+            if sum([len(p) for p in pairs]) >= num_pairs:
+                break
+        pairs = np.concatenate(pairs)
+        return pairs[rand.permutation(len(pairs))[:num_pairs]], walks
+    order = rand.permutation(len(walks))
+    held_out = set(order[:num_pairs].tolist())
+    return (np.array([walks[i] for i in order[:num_pairs]], dtype=np.int64).reshape(-1, 2),
+            [w for i, w in enumerate(walks) if i not in held_out])
+
+def eval_mrr(placeholders, minibatch, model, sess, pairs, batch_size):
+    """
+    MRR of the eval pairs over the complete adj lists, with the same negatives for every trial
+    """
+    minibatch.full_graph()
+    np.random.seed(0)
+    total = 0.
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start : start + batch_size]
+        feed_dict = minibatch.batch_feed_dict(batch)
+        feed_dict.update({placeholders['neg_sample']: minibatch.negatives(batch),
+                          placeholders['is_training']: False})
+        total += sess.run(model.mrr, feed_dict=feed_dict) * len(batch)
+    return total / max(1, len(pairs))
+
+def run_trial(trial, params, args):
+    """
+    Train one configuration on the shared tables, time the training steps only
+    Returns:
+        row of the results table
+    """
+    import tensorflow as tf
+    from run_unsupervised import build_model
+
+    args = argparse.Namespace(**dict(vars(args), **params))
+    args.embed_dir = '{}/trial_{}'.format(args.embed_dir, trial)
+    result = dict(params, trial=trial, status='ok', steps=0, loss=np.nan, mrr=np.nan, time=0.)
+    try:
+        threads = args.trial_threads or max(1, mp.cpu_count() // args.pool)
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                inter_op_parallelism_threads=threads)
+        data_trn = SHARED['data_trn']
+        placeholders, minibatch, model, sess = build_model(data_trn, args, config,
+                                                           tables=SHARED['tables'][args.max_degree],
+                                                           feed_tables=True)
+        losses = []
+        t = time.time()
+        for step in range(args.steps):
+            if minibatch.end_edge():
+                minibatch.shuffle()
+            feed_dict, _ = minibatch.next_edgebatch_feed_dict()
+            feed_dict.update({placeholders['dropout']: args.dropout})
+            feed_dict.update({placeholders['ffd_dropout']: args.ffd_dropout})
+            feed_dict.update({placeholders['attn_dropout']: args.attn_dropout})
+            feed_dict.update({placeholders['vae_dropout']: args.vae_dropout})
+            outs = sess.run([model.loss, model.train_op(step)], feed_dict=feed_dict)
+            losses.append(outs[0])
+            result['steps'] = step + 1
+        model.flush(sess, args.steps)
+        result['time'] = time.time() - t
+        # loss averaged over the last 100 steps, mrr of the held-out pairs
+        result['loss'] = float(np.mean(losses[-100:]))
+        result['mrr'] = eval_mrr(placeholders, minibatch, model, sess, SHARED['eval_pairs'], args.batch_size)
+        if not os.path.exists(args.embed_dir):
+            os.makedirs(args.embed_dir)
+        tf.train.Saver().save(sess, '{}/model.ckpt'.format(args.embed_dir), global_step=args.steps)
+    except (MemoryError, tf.errors.ResourceExhaustedError):
+        result['status'] = 'out of memory'
+    result['steps_per_sec'] = result['steps'] / result['time'] if result['time'] > 0 else np.nan
+    print ('-- trial {}: {}'.format(trial, result))
+    return result
+
+def trial_main(trial, params, args, conn):
+    conn.send(run_trial(trial, params, args))
+
+def run_trials(trials, args):
+    """
+    One process per trial, at most args.pool at a time. Limits are enforced from
+    here: a trial is terminated past its wall time or resident memory limit
+    (an alarm cannot interrupt a running session call, and an address space
+    limit breaks the virtual reservations of tensorflow)
+    """
+    ctx = mp.get_context('fork')
+    limit = args.trial_memory_gb * 2**30
+    pending = list(enumerate(trials))
+    running = {}
+    results = []
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < args.pool:
+            trial, params = pending.pop(0)
+            recv, send = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=trial_main, args=(trial, params, args, send))
+            process.start()
+            running[trial] = (process, recv, time.time())
+        time.sleep(0.5)
+        for trial, (process, recv, start) in list(running.items()):
+            alive = process.is_alive()
+            # a result sent before the process ended is still in the pipe
+            if recv.poll():
+                results.append(recv.recv())
+            else:
+                if not alive:
+                    status = 'failed: exit code {}'.format(process.exitcode)
+                elif time.time() - start > args.trial_timeout:
+                    status = 'timeout'
+                elif limit > 0 and rss_bytes(process.pid) > limit:
+                    status = 'out of memory'
+                else:
+                    continue
+                process.terminate()
+                results.append(dict(trials[trial], trial=trial, status=status, steps=0, loss=np.nan,
+                                    mrr=np.nan, time=time.time() - start, steps_per_sec=np.nan))
+                print ('-- trial {}: {}'.format(trial, status))
+            process.join()
+            del running[trial]
+    return results
+
+def main():
+    args = parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    from tensorflow.python.util import deprecation
+    from src.data_loader import DataLoader
+    from src.minibatch import EdgeBatch
+    deprecation._PRINT_DEPRECATION_WARNINGS = False
+
+    trials = parse_grid(args.grid, args)
+    print ('===== sweep: {} trials, {} at a time ====='.format(len(trials), args.pool))
+
+    # load data and build the host tables once, forked trials inherit them instead of rebuilding
+    loader = DataLoader(args.training_data_dir, stream_walks=args.stream_walks)
+    eval_pairs, walks = split_eval_pairs(loader.walks, args.eval_pairs)
+    print ('===== mrr of {} held-out walk pairs ====='.format(len(eval_pairs)))
+    SHARED['eval_pairs'] = eval_pairs
+    SHARED['data_trn'] = (loader.G_trn, loader.features, walks, loader.edge_text, len(loader.vocab))
+    SHARED['tables'] = {}
+    # zero row for the padding sentinel of the adj lists, as in build_model
+    features = aligned(np.vstack((loader.features, np.zeros((1, loader.features.shape[1])))), np.float32)
+    for max_degree in sorted(set([params.get('max_degree', args.max_degree) for params in trials])):
+        t = time.time()
+        tables = EdgeBatch(loader.G_trn, loader.edge_text, None, [], max_degree=max_degree).tables()
+        tables['features'] = features
+        for name, dtype in TABLE_DTYPES.items():
+            tables[name] = aligned(tables[name], dtype)
+        SHARED['tables'][max_degree] = tables
+        print ('tables for max_degree={}: {:.1f}s'.format(max_degree, time.time() - t))
+
+    results = run_trials(trials, args)
+
+    # results table, best mrr first
+    names = sorted(trials[0].keys())
+    columns = ['trial'] + names + ['status', 'steps', 'loss', 'mrr', 'time', 'steps_per_sec']
+    results = sorted(results, key=lambda r: -np.nan_to_num(r['mrr'], nan=-1.))
+    lines = ['\t'.join(columns)]
+    for r in results:
+        lines.append('\t'.join([('{:.5f}'.format(r[c]) if isinstance(r[c], float) else str(r[c])) for c in columns]))
+    print ('\n'.join(lines))
+    if not os.path.exists(args.embed_dir):
+        os.makedirs(args.embed_dir)
+    with open('{}/sweep.tsv'.format(args.embed_dir), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+if __name__=='__main__':
+    main()
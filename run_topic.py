@@ -0,0 +1,79 @@
+import os
+import argparse
+import pickle as pkl
+import numpy as np
+
+from src.topic import TopicIndex
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--training-data-dir', type=str, required=True,
+                        help='path of training data (vocab_map.bin, edge_text.bin, adj_all.bin)')
+    parser.add_argument('--embed-dir', type=str, required=True,
+                        help='directory with CGAT_topic.bin, the index is saved next to it')
+    parser.add_argument('--num-words', type=int, default=20,
+                        help='Number of top words per channel')
+    parser.add_argument('--num-top', type=int, default=100,
+                        help='Number of top edges/nodes per channel in the inverted index')
+    parser.add_argument('--theta', type=str, default='model', choices=['model', 'beta'],
+                        help='edge channels from the trained encoder (restores the checkpoint), '
+                             'or the posterior of the docs under beta alone (no tensorflow, approximate)')
+    parser.add_argument('--gpu', type=int, default=1,
+                        help='index of gpu card')
+
+    return parser.parse_args()
+
+def model_doc_theta(args, batch_size=4096):
+    """
+    doc_theta of TopicIndex.build from the trained encoder, the same theta
+    as CGAT.edge_channels and the inference server
+    """
+    # set before tensorflow is imported, it reads them at import time
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    import tensorflow as tf
+    from run_server import load_model
+    _, placeholders, minibatch, model, sess = load_model(args)
+    doc_len = minibatch.edge_words.shape[1]
+    word_ids = tf.placeholder(tf.int32, shape=(None, doc_len))
+    word_counts = tf.placeholder(tf.float32, shape=(None, doc_len))
+    thetas = model.doc_channels(word_ids, word_counts)
+
+    def doc_theta(texts):
+        outs = [[] for _ in thetas]
+        for start in range(0, len(texts), batch_size):
+            bags = [minibatch.doc_row(doc) for doc in texts[start : start + batch_size]]
+            feed_dict = {word_ids: np.array([w for w, c in bags]).reshape(-1, doc_len),
+                         word_counts: np.array([c for w, c in bags]).reshape(-1, doc_len),
+                         placeholders['is_training']: False}
+            for layer, theta in enumerate(sess.run(thetas, feed_dict=feed_dict)):
+                outs[layer].append(theta)
+        return [np.concatenate(out) if len(out) > 0 else np.zeros((0, theta.get_shape().as_list()[1]))
+                for out, theta in zip(outs, thetas)]
+    return doc_theta
+
+def main():
+    args = parse_args()
+
+    with open('{}/CGAT_topic.bin'.format(args.embed_dir), 'rb') as f:
+        (beta, phi) = pkl.load(f)
+    with open('{}/vocab_map.bin'.format(args.training_data_dir), 'rb') as f:
+        vocab = pkl.load(f)
+    with open('{}/edge_text.bin'.format(args.training_data_dir), 'rb') as f:
+        edge_text = pkl.load(f)
+    with open('{}/adj_all.bin'.format(args.training_data_dir), 'rb') as f:
+        num_nodes = len(pkl.load(f))
+
+    doc_theta = model_doc_theta(args) if args.theta == 'model' else None
+    index = TopicIndex(args.num_words, args.num_top).build(beta, vocab, edge_text, num_nodes, doc_theta)
+    index.save('{}/CGAT_topic_index.bin'.format(args.embed_dir))
+
+    for layer in range(len(index.layers)):
+        print ('=== layer {} ==='.format(layer + 1))
+        for channel in range(len(index.layers[layer]['top_words'])):
+            print ('channel {}: {}'.format(channel, ' '.join(index.channel_words(layer, channel))))
+
+if __name__=='__main__':
+    main()
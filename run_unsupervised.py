@@ -1,19 +1,17 @@
 import os
 import time
-import tensorflow as tf
 import numpy as np
 import argparse
 import pickle as pkl
-import networkx as nx
-from tensorflow.python.util import deprecation
-import logging
 
-from src.data_loader import DataLoader
-from src.minibatch import EdgeBatch, NeighborSampler
-from src.model import LayerInfo, CGAT
+from src.lazy import LazyModule, START
 
+# tensorflow, networkx and the model are imported once they are used,
+# so --help and the scripts importing get_parser start without them
+tf = LazyModule('tensorflow')
 
-def parse_args():
+
+def get_parser():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--training-data-dir', type=str, required=True,
@@ -39,15 +37,33 @@ def parse_args():
                         help="Number of neighbor for layer 1")
     parser.add_argument('--sample2', type=int, default=10,
                         help="Number of neighbor for layer 2")
+    parser.add_argument('--dim3', type=int, default=0, 
+                        help='Size of hidden dim for an optional layer 3 (0: two layers)')
+    parser.add_argument('--attn-head3', type=int, default=1, 
+                        help='Number of attention head for layer 3')
+    parser.add_argument('--sample3', type=int, default=10,
+                        help="Number of neighbor for layer 3")
     parser.add_argument('--neg-sample', type=int, default=20,
                         help="Number of negative sample")
+    parser.add_argument('--neg-exclude', action='store_true',
+                        help='Never draw the true partner of a pair of the batch as a negative')
     parser.add_argument('--max-degree', type=int, default=100,
                         help='Maximum degree per node')
+    parser.add_argument('--weighted-sampling', action='store_true',
+                        help='Sample neighbors proportional to the log length of the edge doc')
+    parser.add_argument('--layer-sampling', type=int, default=0,
+                        help='Layer-wise importance sampling of this many nodes per hop (0: neighbors per node)')
 
     parser.add_argument('--learning-rate', type=float, default=0.0005,
                         help='Learning rate')
     parser.add_argument('--weight-decay', type=float, default=0.0, 
                         help="L2 weight factor")
+    parser.add_argument('--accum-steps', type=int, default=1,
+                        help='Number of micro-batches whose gradients are averaged into one update')
+    parser.add_argument('--lr-scaling', type=str, default='sqrt', choices=['sqrt', 'linear', 'none'],
+                        help='Learning rate scaling with the number of accumulated micro-batches')
+    parser.add_argument('--warmup-steps', type=int, default=0,
+                        help='Number of updates over which the learning rate ramps up linearly')
     parser.add_argument('--dropout', type=float, default=0.0, 
                         help="Fraction for dropout  (1 - keep probability)")
     parser.add_argument('--ffd-dropout', type=float, default=0.0, 
@@ -57,6 +73,17 @@ def parse_args():
     parser.add_argument('--vae-dropout', type=float, default=0.0, 
                         help="Fraction for dropout  (1 - keep probability)")
 
+    parser.add_argument('--stream-walks', action='store_true',
+                        help='Generate random-walk pairs on the fly every epoch instead of a precomputed list')
+    parser.add_argument('--history', action='store_true',
+                        help='Read hidden outputs of out-of-batch neighbors from a historical embedding cache')
+    parser.add_argument('--history-refresh', type=int, default=1000,
+                        help='Number of steps between full refreshes of the history cache (0: only before training)')
+    parser.add_argument('--cluster-batch', type=int, default=0,
+                        help='Number of graph clusters for Cluster-GCN style batches (0: batches of walk pairs)')
+    parser.add_argument('--clusters-per-batch', type=int, default=2,
+                        help='Number of clusters whose walk pairs form consecutive batches')
+
     parser.add_argument('--max-steps', type=int, default=1000000, 
                         help="Maximum number of steps to batches to train for")
     parser.add_argument('--eval-steps', type=int, default=1000, 
@@ -64,70 +91,193 @@ def parse_args():
     parser.add_argument('--checkpoint-steps', type=int, default=1000, 
                         help="Number of steps between checkpoints")
 
-    return parser.parse_args()
+    return parser
+
+def parse_args():
+    return get_parser().parse_args()
  
-def train(data_trn, args):
-    # data: graph, node features, random walks
-    (G, features, walks, edgetexts, vocab_dim) = data_trn
-    print ('===== start training on graph(node={}, edge={}, walks={})====='.format(
-            len(G.nodes()), len(G.edges()), len(walks)))
-    print ('batch_size: ', '{}\n'.format(args.batch_size),
-           'max_degree', '{}\n'.format(args.max_degree),
-           'sample1: ', '{}\n'.format(args.sample1),
-           'sample2: ', '{}\n'.format(args.sample2),
-           'neg_sample: ', '{}\n'.format(args.neg_sample),
-           'dropout: ', '{}\n'.format(args.dropout))
-    
-    # placeholders
+def construct_placeholders():
     placeholders = {
         'batch1': tf.placeholder(tf.int32, shape=(None), name='batch1'),
         'batch2': tf.placeholder(tf.int32, shape=(None), name='batch2'),
-        'neg_sample': tf.placeholder(tf.int32, shape=(None,), name='neg_sample_size'),
+        'neg_sample': tf.placeholder(tf.int32, shape=(None,), name='neg_sample'),
         'dropout': tf.placeholder_with_default(0., shape=(), name='dropout'),
         'ffd_dropout': tf.placeholder_with_default(0., shape=(), name='ffd_dropout'),
         'attn_dropout': tf.placeholder_with_default(0., shape=(), name='attn_dropout'),
         'vae_dropout': tf.placeholder_with_default(0., shape=(), name='vae_dropout'),
+        'is_training': tf.placeholder_with_default(True, shape=(), name='is_training'),
         'batch_size': tf.placeholder(tf.int32, name='batch_size'),
     }
+    return placeholders
+
+def construct_layers(sampler, args):
+    from src.model import LayerInfo
+    # two layers, or three with dim3
+    layer_infos = [LayerInfo('layer1', sampler, args.sample1, args.dim1, args.attn_head1),
+                   LayerInfo('layer2', sampler, args.sample2, args.dim2, args.attn_head2)]
+    if getattr(args, 'dim3', 0) > 0:
+        layer_infos.append(LayerInfo('layer3', sampler, args.sample3, args.dim3, args.attn_head3))
+    return layer_infos
+
+def build_model(data_trn, args, config=None, reserve_nodes=0, reserve_edges=0, tables=None, feed_tables=False):
+    """
+    Construct placeholders, edge batches, graph tables and CGAT in a new session,
+    tables keep reserve_nodes/reserve_edges empty rows for cold start, or are
+    shared from EdgeBatch.tables() of an earlier build (with 'features' already
+    padded, if given). With feed_tables, the tables are placeholders fed with every
+    batch (EdgeBatch.feed_tables) instead of variables holding a copy of them
+    """
+    from src.minibatch import EdgeBatch, ClusterBatch, NeighborSampler, LayerSampler
+    from src.model import CGAT
+
+    (G, features, walks, edgetexts, vocab_dim) = data_trn
+    if tables is not None and 'features' in tables:
+        features = tables['features']
+    else:
+        # zero rows for cold start nodes and for the padding sentinel of the adj lists
+        features = np.vstack((features, np.zeros((reserve_nodes + 1, features.shape[1]))))
+    
+    # placeholders
+    placeholders = construct_placeholders()
     
     # batch of edges
-    minibatch = EdgeBatch(G, edgetexts, placeholders, walks, 
-                          batch_size=args.batch_size, max_degree=args.max_degree, vocab_dim=vocab_dim)
+    cluster_batch = getattr(args, 'cluster_batch', 0)
+    neg_exclude = getattr(args, 'neg_exclude', False)
+    if cluster_batch > 0:
+        # shared tables hold all neighbors, the in-group adj lists are built every epoch
+        minibatch = ClusterBatch(G, edgetexts, placeholders, walks, 
+                                 num_clusters=cluster_batch, clusters_per_batch=args.clusters_per_batch,
+                                 batch_size=args.batch_size, max_degree=args.max_degree,
+                                 neg_sample=args.neg_sample, reserve_nodes=reserve_nodes,
+                                 reserve_edges=reserve_edges, tables=tables, neg_exclude=neg_exclude)
+    else:
+        minibatch = EdgeBatch(G, edgetexts, placeholders, walks, 
+                              batch_size=args.batch_size, max_degree=args.max_degree,
+                              neg_sample=args.neg_sample, reserve_nodes=reserve_nodes,
+                              reserve_edges=reserve_edges, tables=tables, neg_exclude=neg_exclude)
+    def table(dtype, shape, name):
+        """
+        placeholder fed with every batch, or variable initialized once from it
+        """
+        ph = tf.placeholder(dtype, shape=shape, name=name if feed_tables else None)
+        return ph, (ph if feed_tables else tf.Variable(ph, trainable=False, name=name))
     # adj_info
-    adj_info_ph = tf.placeholder(tf.int32, shape=minibatch.adj.shape)
-    adj_info = tf.Variable(adj_info_ph, trainable=False, name="adj_info")
+    adj_info_ph, adj_info = table(tf.int32, minibatch.adj.shape, 'adj_info')
     # (node1, node2) -> edge_idx
-    edge_idx_ph = tf.placeholder(dtype=tf.int32, shape=minibatch.edge_idx.shape)
-    edge_idx = tf.Variable(edge_idx_ph, trainable=False, name='edge_idx')
-    # edge_vecs
-    edge_vec_ph = tf.placeholder(dtype=tf.float32, shape=minibatch.edge_vec.shape)
-    edge_vec = tf.Variable(edge_vec_ph, trainable=False, name='edge_vec')
+    edge_idx_ph, edge_idx = table(tf.int32, minibatch.edge_idx.shape, 'edge_idx')
+    # edge docs as bag of words
+    edge_words_ph, edge_words = table(tf.int32, minibatch.edge_words.shape, 'edge_words')
+    edge_counts_ph, edge_counts = table(tf.float32, minibatch.edge_counts.shape, 'edge_counts')
 
     # sample of neighbor for convolution
-    sampler = NeighborSampler(adj_info)
-    # two layers
-    layer_infos = [LayerInfo('layer1', sampler, args.sample1, args.dim1, args.attn_head1),
-                   LayerInfo('layer2', sampler, args.sample2, args.dim2, args.attn_head2)]
+    adj_weights = None
+    adj_weights_ph = None
+    if getattr(args, 'weighted_sampling', False):
+        adj_weights_ph, adj_weights = table(tf.float32, minibatch.adj.shape, 'adj_weights')
+    if getattr(args, 'layer_sampling', 0) > 0:
+        sampler = LayerSampler(adj_info, layer_size=args.layer_sampling)
+    else:
+        sampler = NeighborSampler(adj_info, weights=adj_weights)
+    layer_infos = construct_layers(sampler, args)
 
     # initialize session
-    sess = tf.Session(config=tf.ConfigProto(log_device_placement=False))
+    sess = tf.Session(config=config or tf.ConfigProto(log_device_placement=False))
         
-    # GCN model
-    model = CGAT(placeholders, features, vocab_dim, edge_idx, edge_vec, 
-                             minibatch.deg, layer_infos, 
-                             args.neg_sample, args.learning_rate, args.weight_decay)
+    # GCN model, the learning rate scaled with the effective batch size
+    accum_steps = getattr(args, 'accum_steps', 1)
+    lr_scale = {'sqrt': np.sqrt(accum_steps), 'linear': accum_steps, 'none': 1.}[getattr(args, 'lr_scaling', 'sqrt')]
+    model = CGAT(placeholders, features, vocab_dim, edge_idx, edge_words, edge_counts, 
+                             layer_infos, 
+                             args.neg_sample, args.learning_rate * lr_scale, args.weight_decay,
+                             history=getattr(args, 'history', False),
+                             share_roots=cluster_batch > 0,
+                             accum_steps=accum_steps,
+                             warmup_steps=getattr(args, 'warmup_steps', 0),
+                             feed_features=feed_tables)
+    
+    if feed_tables:
+        minibatch.feed_tables({model.features_ph: features,
+                               adj_info_ph: minibatch.adj,
+                               edge_idx_ph: minibatch.edge_idx,
+                               edge_words_ph: minibatch.edge_words,
+                               edge_counts_ph: minibatch.edge_counts},
+                              adj_info_ph, adj_weights_ph)
+        sess.run(tf.global_variables_initializer())
+        sess.run(tf.local_variables_initializer())
+        return (placeholders, minibatch, model, sess)
+
+    feed_dict = {model.features_ph: features,
+                 adj_info_ph: minibatch.adj, 
+                 edge_idx_ph: minibatch.edge_idx, 
+                 edge_words_ph: minibatch.edge_words,
+                 edge_counts_ph: minibatch.edge_counts}
+    if adj_weights is not None:
+        feed_dict[adj_weights_ph] = minibatch.neighbor_weights()
+    sess.run(tf.global_variables_initializer(), feed_dict=feed_dict)
+    sess.run(tf.local_variables_initializer())
+    if cluster_batch > 0:
+        # in-group adj lists change every epoch
+        minibatch.bind(sess, adj_info, adj_weights)
+    return (placeholders, minibatch, model, sess)
+
+def refresh_history(placeholders, minibatch, model, sess, batch_size):
+    """
+    Recompute the history tables of all nodes batch by batch,
+    one pass per hidden layer so that deeper tables see fresh inputs
+    """
+    nodes = minibatch.nodes
+    for layer in range(len(model.histories)):
+        for start in range(0, len(nodes), batch_size):
+            batch = nodes[start : start + batch_size]
+            sess.run(model.history_refresh, feed_dict={placeholders['batch1']: batch,
+                                                       placeholders['batch2']: batch,
+                                                       placeholders['batch_size']: len(batch),
+                                                       placeholders['is_training']: False})
+
+def report_history(placeholders, minibatch, model, sess, num_batches=10):
+    """
+    Embedding quality with the history cache against exact sampling over all hops
+    """
+    minibatch.shuffle()
+    outs = []
+    while not minibatch.end_edge() and len(outs) < num_batches:
+        feed_dict, _ = minibatch.next_edgebatch_feed_dict()
+        feed_dict.update({placeholders['is_training']: False})
+        outs.append(sess.run([model.mrr, model.exact_mrr, model.history_drift], feed_dict=feed_dict))
+    outs = np.mean(outs, axis=0)
+    print ('history: mrr={:.5f}, exact mrr={:.5f}, embedding drift (1 - cosine)={:.5f}'.format(outs[0], outs[1], outs[2]))
+
+def train(data_trn, args):
+    # data: graph, node features, random walks
+    (G, features, walks, edgetexts, vocab_dim) = data_trn
+    print ('===== start training on graph(node={}, edge={}, walks={})====='.format(
+            len(G.nodes()), len(G.edges()), len(walks)))
+    print ('batch_size: ', '{}\n'.format(args.batch_size),
+           'max_degree', '{}\n'.format(args.max_degree),
+           'sample1: ', '{}\n'.format(args.sample1),
+           'sample2: ', '{}\n'.format(args.sample2),
+           'neg_sample: ', '{}\n'.format(args.neg_sample),
+           'accum_steps: ', '{}\n'.format(args.accum_steps),
+           'dropout: ', '{}\n'.format(args.dropout))
     
-    sess.run(tf.global_variables_initializer(), 
-             feed_dict={adj_info_ph: minibatch.adj, 
-                        edge_idx_ph: minibatch.edge_idx, 
-                        edge_vec_ph: minibatch.edge_vec})
+    placeholders, minibatch, model, sess = build_model(data_trn, args)
 
     # print out model size
     para_size = np.sum([np.prod(v.get_shape().as_list()) for v in tf.trainable_variables()])
     print ("Model size: {}".format(para_size))
     
+    # checkpoints, with the arguments needed to rebuild the model
+    if not os.path.exists(args.embed_dir):
+        os.makedirs(args.embed_dir)
+    with open('{}/args.bin'.format(args.embed_dir), 'wb') as f:
+        pkl.dump(vars(args), f)
+    saver = tf.train.Saver()
+    
     # begin training
     t = time.time()
+    step = 0
+    if args.history:
+        refresh_history(placeholders, minibatch, model, sess, args.batch_size)
     for epoch in range(args.epoch):
         minibatch.shuffle()
         
@@ -142,7 +292,7 @@ def train(data_trn, args):
             feed_dict.update({placeholders['vae_dropout']: args.vae_dropout})
             
             # train  
-            outs = sess.run([model.graph_loss, model.reconstr_loss, model.kl_loss, model.loss, model.mrr], 
+            outs = sess.run([model.graph_loss, model.reconstr_loss, model.kl_loss, model.loss, model.mrr, model.train_op(step)], 
                             feed_dict=feed_dict)
             graph_loss = outs[0]
             reconstr_loss = outs[1]
@@ -161,10 +311,20 @@ def train(data_trn, args):
                         'time so far=', '{:.5f}'.format((time.time() - t)/60))
             
             iter += 1
+            step += 1
+            if step % args.checkpoint_steps == 0:
+                saver.save(sess, '{}/model.ckpt'.format(args.embed_dir), global_step=step)
+            if args.history and args.history_refresh > 0 and step % args.history_refresh == 0:
+                refresh_history(placeholders, minibatch, model, sess, args.batch_size)
             
-    print ('Training finished!')
+    print ('Training finished! {:.2f} steps/sec'.format(step / (time.time() - t)))
+    model.flush(sess, step)
+    saver.save(sess, '{}/model.ckpt'.format(args.embed_dir), global_step=step)
+    if args.history:
+        report_history(placeholders, minibatch, model, sess)
     
-    # save embeddings
+    # save embeddings, computed over all neighbors
+    minibatch.full_graph()
     embeddings = []
     nodes = []
     seen = set()
@@ -172,13 +332,14 @@ def train(data_trn, args):
     iter = 0
     while not minibatch.end_node():
         feed_dict, edges = minibatch.next_nodebatch_feed_dict()
+        feed_dict.update({placeholders['is_training']: False})
         print ('-- iter: ', '{:4d}'.format(iter), edges)
         for p in edges:
             (n, _) = p
             if n >= len(G.nodes()):
                 print ('Gotcha!{}'.format(n))
 
-        outs = sess.run([model.outputs1, model.beta, model.phi], 
+        outs = sess.run([model.embeddings], 
                     feed_dict=feed_dict)
 
         # only save embeds1 because of planetoid
@@ -192,27 +353,30 @@ def train(data_trn, args):
             print ('-- iter: ', '{:4d}'.format(iter), 
                    'node_embeded=', '{}'.format(len(seen)))
         iter += 1
-    if not os.path.exists(args.embed_dir):
-        os.makedirs(args.embed_dir)
     with open('{}/CGAT.bin'.format(args.embed_dir), 'wb') as f:
         pkl.dump((embeddings, nodes), f)
     
+    # topic-word distributions do not depend on the batch, fetch once
+    topics = sess.run([model.beta, model.phi])
     with open('{}/CGAT_topic.bin'.format(args.embed_dir), 'wb') as f:
-        pkl.dump((outs[1], outs[2]), f)
+        pkl.dump((topics[0], topics[1]), f)
         
 def main():
-    print(tf.__version__)
-
     args = parse_args()
 
+    # set before tensorflow is imported, it reads them at import time
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
+    from tensorflow.python.util import deprecation
     deprecation._PRINT_DEPRECATION_WARNINGS = False
+    print(tf.__version__)
 
     # tf.logging.set_verbosity(tf.logging.INFO)
 
     # load data
-    loader = DataLoader(args.training_data_dir)
+    from src.data_loader import DataLoader
+    loader = DataLoader(args.training_data_dir, stream_walks=args.stream_walks)
+    print ('startup (imports, data): {:.2f}s'.format(time.time() - START))
 
     # train
     train((loader.G_trn, loader.features, loader.walks, loader.edge_text, len(loader.vocab)), args)
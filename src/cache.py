@@ -0,0 +1,75 @@
+import os
+import hashlib
+import pickle as pkl
+
+
+class ArtifactCache(object):
+    """
+    Preprocessing artifacts keyed by a content hash of their inputs.
+    Artifact <name>_<seed>.bin is stored along with a <name>_<seed>.key file,
+    and is only reused when the stored key matches the current one. An artifact
+    without a key file (e.g. shipped with the data) is adopted on first load,
+    it is never overwritten
+    """
+    def __init__(self, folder, seed):
+        self.folder = folder
+        self.seed = seed
+        self.file_hashes = {}
+
+    def file_hash(self, filename):
+        if filename not in self.file_hashes:
+            h = hashlib.sha1()
+            with open('{}/{}'.format(self.folder, filename), 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            self.file_hashes[filename] = h.hexdigest()
+        return self.file_hashes[filename]
+
+    def key(self, files, params):
+        """
+        Args:
+            files: input files (relative to folder) the artifact depends on
+            params: dict of parameters (including keys of upstream artifacts)
+        """
+        h = hashlib.sha1()
+        for filename in files:
+            h.update(self.file_hash(filename).encode())
+        h.update(repr(sorted(params.items())).encode())
+        return h.hexdigest()
+
+    def reset(self):
+        # input files changed on disk
+        self.file_hashes = {}
+
+    def path(self, name):
+        return '{}/{}_{}.bin'.format(self.folder, name, self.seed)
+
+    def key_path(self, name):
+        return '{}/{}_{}.key'.format(self.folder, name, self.seed)
+
+    def load(self, name, key):
+        if not os.path.exists(self.path(name)):
+            return None
+        if not os.path.exists(self.key_path(name)):
+            print ('{} has no key, adopted as built from the current inputs '
+                   '(delete it to rebuild)'.format(self.path(name)))
+            with open(self.key_path(name), 'w') as f:
+                f.write(key)
+        with open(self.key_path(name), 'r') as f:
+            if f.read().strip() != key:
+                print ('{} is stale, rebuild'.format(self.path(name)))
+                return None
+        with open(self.path(name), 'rb') as f:
+            return pkl.load(f)
+
+    def save(self, name, key, obj):
+        if os.path.exists(self.path(name)) and not os.path.exists(self.key_path(name)):
+            print ('{} exists without a key, not overwritten'.format(self.path(name)))
+            return
+        if os.path.exists(self.key_path(name)):
+            os.remove(self.key_path(name))
+        with open(self.path(name), 'wb') as f:
+            pkl.dump(obj, f)
+        # key is removed first and written last, so an interrupted dump is never reused
+        with open(self.key_path(name), 'w') as f:
+            f.write(key)
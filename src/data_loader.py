@@ -7,17 +7,38 @@ from os import path
 import networkx as nx
 import pickle as pkl
 
+from src.cache import ArtifactCache
+
 WALK_LEN = 5
 WALK_N = 50
+TST_RATIO = 0.1
+# seed of the split and walks
+SEED = 448
+
+def artifact_keys(cache, seed):
+    """
+    Keys of the graph/feature/walk artifacts of cache.folder, each artifact
+    is rebuilt only when its own inputs change
+    """
+    graph_key = cache.key(['adj_all.bin', 'user_map.bin', 'item_map.bin'],
+                          {'seed': seed, 'tst_ratio': TST_RATIO, 'split': 'per_user'})
+    feature_key = cache.key(['edge_text.bin', 'vocab_map.bin'], {'graph': graph_key})
+    walk_key = cache.key([], {'graph': graph_key, 'seed': seed, 
+                              'walk_len': WALK_LEN, 'walk_n': WALK_N})
+    return {'graph': graph_key, 'feature': feature_key, 'walk': walk_key}
+
 
 class DataLoader(object):
-    def __init__(self, folder, uni_flag=True, seed=448, split="Edge"):
+    def __init__(self, folder, uni_flag=True, seed=SEED, split="Edge", stream_walks=False):
         uni_str = "_uni" if uni_flag else ""
         # id to idx
         with open('{}/user_map.bin'.format(folder), 'rb') as f:
             self.user_dict = pkl.load(f)   # dict: k=userID, v=idx
         with open('{}/item_map.bin'.format(folder), 'rb') as f:
             self.item_dict = pkl.load(f)   # dict: k=userID, v=idx
+        # homogeneous graph (e.g. stackoverflow): users and items share one id space
+        if self.item_dict == self.user_dict:
+            self.item_dict = self.user_dict
         with open("{}/vocab_map.bin".format(folder), 'rb') as f: #dict: k=word, v=idx
             self.vocab = pkl.load(f)
         # ajacent dict
@@ -33,93 +54,98 @@ class DataLoader(object):
         print ("{} features".format(len(self.vocab)))
         
         self.G = nx.from_dict_of_lists(self.adj)
+        self.folder = folder
+        self.seed = seed
+        # random-walk pairs generated on the fly every epoch instead of a precomputed list
+        self.stream_walks = stream_walks
         
         if split == "Edge":
-            if path.exists("{}/graph_{}.bin".format(folder, seed)):
-                (self.G_trn, self.G_tst) = pkl.load(open("{}/graph_{}.bin".format(folder, seed), 'rb'))
-                self.features = pkl.load(open("{}/feature_{}.bin".format(folder, seed), 'rb'))
-                self.walks = pkl.load(open("{}/walk_{}.bin".format(folder, seed), 'rb'))
-            else:
-                (self.G_trn, self.G_tst, self.features, self.walks) = self.split_by_edge(seed, folder)
+            self.cache = ArtifactCache(folder, seed)
+            (self.G_trn, self.G_tst, self.features, self.walks) = self.split_by_edge(seed, folder)
                 
     
-    # split into train/test set
+    def artifact_keys(self, seed):
+        return artifact_keys(self.cache, seed)
+
     def split_by_edge(self, seed, folder):
-        print ('===== split trn/tst/ set=====')        
-        rand = random.Random(seed)
-        # randomly sample 0.1 of edges for test for each user
-        adj_trn = {}
-        adj_tst = {idx:[] for idx in self.adj.keys()}
-        for _, uidx in self.user_dict.items():
-            nei_items = self.adj[uidx]
-            tst_num = 0.1 * len(nei_items)
-            if len(adj_tst[uidx]) >= tst_num:
-                continue
-            tst_nei_items = rand.sample(nei_items, int(tst_num))
-            adj_tst[uidx] = tst_nei_items
-            for n in tst_nei_items:
-                adj_tst[n].append(uidx)
-            
-            
-        for k, v in self.adj.items():
-            adj_trn[k] = list(set(v) - set(adj_tst[k]))
-        # statistics
-        lens = []
-        for k, v in adj_trn.items():
-            lens.append(len(v))
-        print ("trn edge stats: ave={}, max={}, min={}".format(sum(lens)/len(lens), max(lens), min(lens)))
-        # test
-        lens = []
-        for k, v in adj_tst.items():
-            lens.append(len(v))
-        print ("tst edge stats: ave={}, max={}, min={}".format(sum(lens)/len(lens), max(lens), min(lens)))
-        # user
-        lens_all = []
-        lens_trn = []
-        lens_tst = []
-        ratio = []
-        for uid, idx in self.user_dict.items():
-            lens_all.append(len(self.adj[idx]))
-            lens_trn.append(len(adj_trn[idx]))
-            lens_tst.append(len(adj_tst[idx]))
-            ratio.append(len(adj_tst[idx])/len(self.adj[idx]))
-        print ("=== user node ===")
-        print ("all stats: ave={}, max={}, min={}".format(sum(lens_all)/len(lens_all), max(lens_all), min(lens_all)))
-        print ("trs stats: ave={}, max={}, min={}".format(sum(lens_trn)/len(lens_trn), max(lens_trn), min(lens_trn)))
-        print ("tst stats: ave={}, max={}, min={}".format(sum(lens_tst)/len(lens_tst), max(lens_tst), min(lens_tst)))
-        print ("ratio for tst: {}".format(sum(ratio)/len(ratio)))
-        # item
-        lens_all = []
-        lens_trn = []
-        lens_tst = []
-        ratio = []
-        for iid, idx in self.item_dict.items():
-            lens_all.append(len(self.adj[idx]))
-            lens_trn.append(len(adj_trn[idx]))
-            lens_tst.append(len(adj_tst[idx]))
-            ratio.append(len(adj_tst[idx])/len(self.adj[idx]))
-        print ("=== item node ===")
-        print ("all stats: ave={}, max={}, min={}".format(sum(lens_all)/len(lens_all), max(lens_all), min(lens_all)))
-        print ("trs stats: ave={}, max={}, min={}".format(sum(lens_trn)/len(lens_trn), max(lens_trn), min(lens_trn)))
-        print ("tst stats: ave={}, max={}, min={}".format(sum(lens_tst)/len(lens_tst), max(lens_tst), min(lens_tst)))
-        print ("ratio for tst: {}".format(sum(ratio)/len(ratio)))
+        keys = self.artifact_keys(seed)
+        graphs = self.cache.load('graph', keys['graph'])
+        if graphs is None:
+            graphs = self.sample_edges(seed)
+            self.cache.save('graph', keys['graph'], graphs)
+        (G_trn, G_tst) = graphs
         
         # aggregate node feature
-        feat = self.get_feature(adj_trn)
+        feat = self.cache.load('feature', keys['feature'])
+        if feat is None:
+            feat = self.get_feature(nx.to_dict_of_lists(G_trn))
+            self.cache.save('feature', keys['feature'], feat)
         
         # generate random walks
-        G_trn = nx.from_dict_of_lists(adj_trn)
-        G_tst = nx.from_dict_of_lists(adj_tst)
-        walks = self.gen_random_walk(G_trn, G_trn.nodes(), seed)
-        
-        with open("{}/graph_{}.bin".format(folder, seed), 'wb') as f:
-            pkl.dump((G_trn, G_tst), f)
-        with open("{}/feature_{}.bin".format(folder, seed), 'wb') as f:
-            pkl.dump(feat, f)
-        with open("{}/walk_{}.bin".format(folder, seed), 'wb') as f:
-            pkl.dump(walks, f)
+        if self.stream_walks:
+            return (G_trn, G_tst, feat, WalkStream(G_trn, G_trn.nodes(), seed))
+        walks = self.cache.load('walk', keys['walk'])
+        if walks is None:
+            walks = self.gen_random_walk(G_trn, G_trn.nodes(), seed)
+            self.cache.save('walk', keys['walk'], walks)
             
         return (G_trn, G_tst, feat, walks)
+        
+    # split into train/test set
+    def sample_edges(self, seed):
+        print ('===== split trn/tst/ set=====')        
+        rand = np.random.RandomState(seed)
+        num_nodes = len(self.adj)
+        # edge array: one row per (node, neighbor)
+        deg = np.array([len(self.adj[k]) for k in range(num_nodes)], dtype=np.int64)
+        src = np.repeat(np.arange(num_nodes, dtype=np.int64), deg)
+        dst = np.concatenate([np.array(self.adj[k], dtype=np.int64) for k in range(num_nodes)])
+        is_user = np.zeros(num_nodes, dtype=bool)
+        is_user[list(self.user_dict.values())] = True
+        
+        # randomly sample 0.1 of edges for test for each user, from all of its neighbors
+        pick = self.pick_test_edges(src, deg, is_user, rand)
+        tst_src = np.concatenate((src[pick], dst[pick]))
+        tst_dst = np.concatenate((dst[pick], src[pick]))
+        is_tst = np.isin(src * num_nodes + dst, tst_src * num_nodes + tst_dst)
+        
+        adj_trn = self.to_adj(src[~is_tst], dst[~is_tst], num_nodes)
+        adj_tst = self.to_adj(src[is_tst], dst[is_tst], num_nodes)
+        
+        # statistics
+        deg_trn = np.bincount(src[~is_tst], minlength=num_nodes)
+        deg_tst = np.bincount(src[is_tst], minlength=num_nodes)
+        print ("trn edge stats: {}".format(self.len_stats(deg_trn)))
+        print ("tst edge stats: {}".format(self.len_stats(deg_tst)))
+        for name, id_map in [('user', self.user_dict), ('item', self.item_dict)]:
+            idx = np.array(list(id_map.values()), dtype=np.int64)
+            print ("=== {} node ===".format(name))
+            print ("all stats: {}".format(self.len_stats(deg[idx])))
+            print ("trs stats: {}".format(self.len_stats(deg_trn[idx])))
+            print ("tst stats: {}".format(self.len_stats(deg_tst[idx])))
+            print ("ratio for tst: {}".format(np.mean(deg_tst[idx] / deg[idx])))
+        
+        G_trn = nx.from_dict_of_lists(adj_trn)
+        G_tst = nx.from_dict_of_lists(adj_tst)
+        return (G_trn, G_tst)
+    
+    # random permutation within the edges of each user, keep the first floor(TST_RATIO * deg);
+    # an edge between two users may be picked by both (the loop it replaces skipped users
+    # whose test share was already filled by earlier users)
+    def pick_test_edges(self, src, deg, is_user, rand):
+        order = np.lexsort((rand.random_sample(len(src)), src))
+        rank = np.empty(len(src), dtype=np.int64)
+        rank[order] = np.arange(len(src)) - (np.cumsum(deg) - deg)[src[order]]
+        return is_user[src] & (rank < np.floor(TST_RATIO * deg)[src])
+    
+    # edge array -> adjacent dict
+    def to_adj(self, src, dst, num_nodes):
+        order = np.argsort(src, kind='stable')
+        splits = np.cumsum(np.bincount(src, minlength=num_nodes))[:-1]
+        return {k: v.tolist() for k, v in enumerate(np.split(dst[order], splits))}
+    
+    def len_stats(self, lens):
+        return "ave={}, max={}, min={}".format(np.mean(lens), np.max(lens), np.min(lens))
        
     # aggregate edge feature to node, and normalize
     def get_feature(self, adj):
@@ -160,4 +186,152 @@ class DataLoader(object):
             if cnt % 1000 == 0:
                 print("--- Done walks for", cnt, "nodes")
         return pairs
-    
\ No newline at end of file
+
+    # incrementally append new edges with text, without rebuilding from scratch
+    def update(self, delta, persist=True):
+        """
+        Args:
+            delta: list of (user_id, item_id, doc), doc={word_idx: count}
+                   unseen ids are appended to user_map/item_map
+            persist: write the updated maps and artifacts to folder
+        Returns:
+            set of affected node idx
+        """
+        print ('===== incremental update: {} edges ====='.format(len(delta)))
+        num_nodes = len(self.adj)
+        affected = set()
+        new_edges = 0
+        for u_id, i_id, doc in delta:
+            u = self.node_idx(u_id, self.user_dict)
+            i = self.node_idx(i_id, self.item_dict)
+            if u == i:
+                continue
+            # merge text of duplicated edges, both directions share one doc
+            merged = dict(self.edge_text.get((u, i), {}))
+            for k, v in doc.items():
+                merged[k] = merged.get(k, 0) + v
+            self.edge_text[(u, i)] = merged
+            self.edge_text[(i, u)] = merged
+            # new edges always go to the training graph
+            if i not in self.adj[u]:
+                self.adj[u].append(i)
+                self.adj[i].append(u)
+                self.G.add_edge(u, i)
+                self.G_trn.add_edge(u, i)
+                new_edges += 1
+            affected.update((u, i))
+        print ('{} new nodes, {} new edges, {} affected nodes'.format(len(self.adj) - num_nodes, new_edges, len(affected)))
+
+        # aggregated node features: append rows for new nodes, recompute affected rows
+        if len(self.adj) > num_nodes:
+            self.features = np.vstack((self.features, np.zeros((len(self.adj) - num_nodes, self.features.shape[1]))))
+        for k in affected:
+            self.features[k] = self.node_feature(list(self.G_trn.neighbors(k)), k)
+
+        # random walks: drop and regenerate walks rooted at affected nodes
+        # (a stream walks the updated graph from its next epoch on)
+        if isinstance(self.walks, WalkStream):
+            self.walks.nodes = list(self.G_trn.nodes())
+        else:
+            self.walks = [p for p in self.walks if p[0] not in affected]
+            self.walks.extend(self.gen_random_walk(self.G_trn, sorted(affected), self.seed))
+
+        if persist:
+            self.save()
+        return affected
+
+    def node_idx(self, node_id, id_map):
+        if node_id in id_map:
+            return id_map[node_id]
+        idx = len(self.adj)
+        id_map[node_id] = idx
+        self.adj[idx] = []
+        for G in [self.G, self.G_trn, self.G_tst]:
+            G.add_node(idx)
+        return idx
+
+    # aggregated edge feature of a single node, same as a row of get_feature
+    def node_feature(self, neighbors, k):
+        x = np.zeros(len(self.vocab))
+        for n in neighbors:
+            for pair in [(k, n), (n, k)]:
+                if pair in self.edge_text:
+                    for feat, freq in self.edge_text[pair].items():
+                        x[feat] += freq
+        row_sum = x.sum()
+        if row_sum > 0:
+            x = x / row_sum
+        return x
+
+    def save(self):
+        folder = self.folder
+        with open('{}/user_map.bin'.format(folder), 'wb') as f:
+            pkl.dump(self.user_dict, f)
+        with open('{}/item_map.bin'.format(folder), 'wb') as f:
+            pkl.dump(self.item_dict, f)
+        with open('{}/adj_all.bin'.format(folder), 'wb') as f:
+            pkl.dump(self.adj, f)
+        with open("{}/edge_text.bin".format(folder), 'wb') as f:
+            pkl.dump(self.edge_text, f)
+        # inputs changed, restamp every artifact
+        self.cache.reset()
+        keys = self.artifact_keys(self.seed)
+        self.cache.save('graph', keys['graph'], (self.G_trn, self.G_tst))
+        self.cache.save('feature', keys['feature'], self.features)
+        if not isinstance(self.walks, WalkStream):
+            self.cache.save('walk', keys['walk'], self.walks)
+
+
+class WalkStream(object):
+    """
+    Random-walk co-occurrence pairs of DataLoader.gen_random_walk, generated lazily
+    in shuffled chunks of start nodes with a fresh seed every epoch; memory only
+    depends on the graph and the chunk size, not on the number of walks
+    """
+    def __init__(self, G, nodes, seed, chunk_size=1000):
+        self.G = G
+        self.nodes = list(nodes)
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        # expected number of pairs per epoch (a walk may come back to its start node)
+        return len(self.nodes) * WALK_N * (WALK_LEN - 1)
+
+    def shard(self, rank, num_shards):
+        return WalkStream(self.G, self.nodes[rank::num_shards], self.seed, self.chunk_size)
+
+    def epoch(self, epoch):
+        """
+        Yields [num_pairs, 2] arrays of (start node, co-occurring node)
+        """
+        rand = np.random.RandomState(self.seed + epoch)
+        indptr, indices = self.csr()
+        deg = np.diff(indptr)
+        nodes = np.array(self.nodes, dtype=np.int64)
+        nodes = nodes[rand.permutation(len(nodes))]
+        for start in range(0, len(nodes), self.chunk_size):
+            starts = nodes[start : start + self.chunk_size]
+            starts = np.repeat(starts[deg[starts] > 0], WALK_N)
+            cur = starts
+            pairs = []
+            for j in range(WALK_LEN):
+                # self co-occurrences are useless
+                keep = cur != starts
+                pairs.append(np.stack((starts[keep], cur[keep]), axis=1))
+                if j < WALK_LEN - 1:
+                    cur = indices[indptr[cur] + (rand.random_sample(len(cur)) * deg[cur]).astype(np.int64)]
+            pairs = np.concatenate(pairs)
+            yield pairs[rand.permutation(len(pairs))]
+
+    def csr(self):
+        # neighbor lists of the current graph as flat arrays
+        num_nodes = max(self.G.nodes()) + 1 if self.G.number_of_nodes() > 0 else 0
+        deg = np.zeros(num_nodes, dtype=np.int64)
+        for u, d in self.G.degree():
+            deg[u] = d
+        indptr = np.concatenate(([0], np.cumsum(deg)))
+        indices = np.zeros(indptr[-1], dtype=np.int64)
+        for u in self.G.nodes():
+            indices[indptr[u] : indptr[u + 1]] = list(self.G.neighbors(u))
+        return indptr, indices
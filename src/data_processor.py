@@ -5,20 +5,18 @@ import scipy
 from scipy import sparse
 import pickle as pkl
 import scipy.sparse as sparse
-import matplotlib.pyplot as plt
 import json
 import random
 import math
-import nltk
 import operator
 from collections import defaultdict
 import csv
 
-nltk.download('punkt')
-nltk.download('stopwords')
+from src.lazy import load_nltk
+from src.vocab import VocabBuilder, HashedVocab
 
 class yelpProcessor(object):
-    def __init__(self, folder, mode):
+    def __init__(self, folder, mode, vocab_size=2000, num_buckets=0, workers=4):
         if mode == 0:
             # read business.json
             self.item_objs = self.load_json('{}/business.json'.format(folder))
@@ -39,17 +37,34 @@ class yelpProcessor(object):
         print ("user: {}".format(len(self.user_objs)))
         print ("review: {}".format(len(self.review_objs)))
         
-        # read vocab
-        self.vocab = {}
-        maxsize = 2000
-        with open('{}/vocab.txt'.format(folder), 'r') as f:
-            for line in f:
-                if len(self.vocab) >= maxsize:
-                    break
-                if line[0] != '#':
-                    self.vocab[line.strip()] = len(self.vocab)
-        print ("vocab size: {}".format(len(self.vocab)))
+        # read or build vocab
+        self.vocab = self.read_vocab(folder, (obj['text'] for obj in self.review_objs),
+                                     vocab_size, num_buckets, workers)
         
+    def read_vocab(self, folder, docs, maxsize=2000, num_buckets=0, workers=4):
+        """
+        Top maxsize terms of folder/vocab.txt if it exists, otherwise the top
+        unigrams and bigrams of docs by document frequency, counted in parallel
+        Args:
+            num_buckets: out-of-vocab terms are hashed into this many extra ids (0: dropped)
+        """
+        filename = '{}/vocab.txt'.format(folder)
+        if os.path.exists(filename):
+            terms = []
+            with open(filename, 'r') as f:
+                for line in f:
+                    if len(terms) >= maxsize:
+                        break
+                    if line[0] != '#':
+                        terms.append(line.strip())
+            vocab = HashedVocab(terms, num_buckets)
+        else:
+            # resolve nltk resources once, before the workers are forked
+            load_nltk()
+            vocab = VocabBuilder(maxsize, num_buckets, workers).build(docs, lambda line: self.string2gram(line, 2))
+        print ("vocab size: {}".format(len(vocab)))
+        return vocab
+
     def load_json(self, filename):
         objs = []
         with open(filename, 'r') as f:
@@ -136,8 +151,9 @@ class yelpProcessor(object):
                     tokens = self.string2gram(obj['text'], 2)
                     feat = defaultdict(int)
                     for t in tokens:
-                        if t in self.vocab:
-                            feat[self.vocab[t]] += 1
+                        idx = self.vocab.index(t)
+                        if idx is not None:
+                            feat[idx] += 1
                     if len(feat) <= 5:
                         removed += 1
                         continue
@@ -225,6 +241,8 @@ class yelpProcessor(object):
         return (user_dict, item_dict, adj_dict, edge_rate, edge_text)
     
     def string2gram(self, line, N):
+        # nltk and punkt are loaded on first use, from the local resource dir
+        nltk = load_nltk()
         # split into words
         tokens = nltk.tokenize.word_tokenize(line)
         # convert to lower case
@@ -246,80 +264,74 @@ class yelpProcessor(object):
                 grams.append(gram)
         return grams
     
-    def process_label(self, item_objs, adj_dict, user_dict, item_dict):
+    def process_label(self, item_objs, adj_dict, user_dict, item_dict, num_class=50):
+        """
+        Item labels are the most common category words, user labels are the
+        labels of their items
+        Returns:
+            class_dict, y [num_nodes, num_class] multi-hot (csr, uint8),
+            y_uni [num_nodes, num_class] one-hot (csr, uint8): first label of an item,
+            most frequent item label of a user
+        """
         print ('----- processing lable -----')
-        noises = ['restaur', 'new', 'food']
-        class_dict = {}
-        item_class = {}
-        item_uni_class = {}
-        # only pick the 50 most common labels
-        class_count = {}
+        noises = set(['restaur', 'new', 'food'])
+        # tokenize each distinct categories string once
+        grams = {}
+        item_labels = []
         for obj in item_objs:
-            labels = self.string2gram(obj['categories'], 1)
-            trim_labels = []
+            if obj['categories'] not in grams:
+                grams[obj['categories']] = [lbl for lbl in self.string2gram(obj['categories'], 1) if lbl not in noises]
+            item_labels.append(grams[obj['categories']])
+
+        # only pick the most common labels
+        class_count = defaultdict(int)
+        for labels in item_labels:
             for lbl in labels:
-                if lbl in noises:
-                    continue
-                trim_labels.append(lbl)
-            for lbl in trim_labels:
-                if lbl not in class_count:
-                    class_count[lbl] = 1
-                else:
-                    class_count[lbl] += 1
+                class_count[lbl] += 1
         sorted_class = sorted(class_count.items(), key=lambda kv: kv[1])[::-1]
-        for i in range(50):
-            class_dict[sorted_class[i][0]]=len(class_dict)
+        class_dict = {}
+        for lbl, _ in sorted_class[:num_class]:
+            class_dict[lbl] = len(class_dict)
+
+        # item x label counts, and the first label of every item
+        num_nodes = len(adj_dict)
+        rows, cols, uni_rows, uni_cols = [], [], [], []
+        for obj, labels in zip(item_objs, item_labels):
+            item = item_dict[obj['business_id']]
+            labels = [class_dict[lbl] for lbl in labels if lbl in class_dict]
+            rows.extend([item] * len(labels))
+            cols.extend(labels)
+            if len(labels) > 0:
+                uni_rows.append(item)
+                uni_cols.append(labels[0])
+        item_lbls = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(num_nodes, len(class_dict)))
+
+        # aggregate item labels to users: user x item adjacency times item x label counts
+        users = np.array(sorted(user_dict.values()), dtype=np.int64)
+        adj_rows = np.repeat(users, [len(adj_dict[u]) for u in users])
+        adj_cols = np.array([n for u in users for n in adj_dict[u]], dtype=np.int64)
+        adj = sparse.csr_matrix((np.ones(len(adj_rows)), (adj_rows, adj_cols)), shape=(num_nodes, num_nodes))
+        user_lbls = adj.dot(item_lbls)
+
+        y = (item_lbls + user_lbls).astype(bool).astype(np.uint8).tocsr()
+        # argmax of user label counts, in dense chunks
+        chunk = 65536
+        for start in range(0, len(users), chunk):
+            batch = users[start : start + chunk]
+            uni_rows.extend(batch)
+            uni_cols.extend(np.asarray(user_lbls[batch].toarray().argmax(axis=1)).ravel())
+        y_uni = sparse.csr_matrix((np.ones(len(uni_rows), dtype=np.uint8), (uni_rows, uni_cols)),
+                                  shape=(num_nodes, len(class_dict)))
 
-        for obj in item_objs:
-            labels = self.string2gram(obj['categories'], 1)
-            trim_labels = []
-            for lbl in labels:
-                if lbl in class_dict:
-                    trim_labels.append(lbl)
-            if len(trim_labels) > 0:
-                trim_uni_labels = trim_labels[:1]
-            item_class[item_dict[obj['business_id']]] = [class_dict[lbl] for lbl in trim_labels]
-            item_uni_class[item_dict[obj['business_id']]] = [class_dict[lbl] for lbl in trim_uni_labels]
-        
-        # aggregate item_node label to user_node label
-        y = np.zeros((len(adj_dict), len(class_dict)))
-        y_uni = np.zeros((len(adj_dict), len(class_dict)))
-        for k, v in adj_dict.items():
-            if k in item_class: # item node
-                for lbl in item_class[k]:
-                    y[k][lbl] = 1
-                for lbl in item_uni_class[k]:
-                    y_uni[k][lbl] = 1
-            else: # user node
-                user_lbls = np.zeros(len(class_dict))
-                for n in v:
-                    for lbl in item_class[n]:
-                        user_lbls[lbl] += 1
-                y_uni[k][np.argmax(user_lbls)] = 1
-                y[k] = [1 if i > 0 else 0 for i in user_lbls]
         # statistics
         print ("classe number: {}".format(len(class_dict)))
         print (class_dict)
-        lens = []
-        for k, v in item_dict.items():
-            lens.append(np.count_nonzero(y[v]))
-        print ("item class stats: ave={}, max={}, min={}, zeros={}".format(sum(lens)/len(lens), max(lens), min(lens), 
-                                                                           len(lens) - np.count_nonzero(lens)))
-        lens = []
-        for k, v in item_dict.items():
-            lens.append(np.count_nonzero(y_uni[v]))
-        print ("item unique class stats: ave={}, max={}, min={}, zeros={}".format(sum(lens)/len(lens), max(lens), min(lens), 
-                                                                           len(lens) - np.count_nonzero(lens)))
-        lens = []
-        for k, v in user_dict.items():
-            lens.append(np.count_nonzero(y[v]))
-        print ("user class stats: ave={}, max={}, min={}, zeros={}".format(sum(lens)/len(lens), max(lens), min(lens), 
-                                                                           len(lens) - np.count_nonzero(lens)))
-        lens = []
-        for k, v in user_dict.items():
-            lens.append(np.count_nonzero(y_uni[v]))
-        print ("user unique class stats: ave={}, max={}, min={}, zeros={}".format(sum(lens)/len(lens), max(lens), min(lens), 
-                                                                           len(lens) - np.count_nonzero(lens)))
+        items = np.array(list(item_dict.values()), dtype=np.int64)
+        for name, nodes in [('item', items), ('user', users)]:
+            for kind, labels in [('class', y), ('unique class', y_uni)]:
+                lens = np.diff(labels.indptr)[nodes]
+                print ("{} {} stats: ave={}, max={}, min={}, zeros={}".format(name, kind, lens.mean(), lens.max(), lens.min(),
+                                                                             len(lens) - np.count_nonzero(lens)))
         return (class_dict, y, y_uni)
 
 def process_yelp():
@@ -374,7 +386,7 @@ def process_yelp():
         
     
 class stackoverflowProcessor(yelpProcessor):
-    def __init__(self, folder):
+    def __init__(self, folder, vocab_size=2000, num_buckets=0, workers=4):
         question_user_map = {} # key: ID, value: userID
         with open('{}/Questions.csv'.format(folder), encoding = "ISO-8859-1") as csv_file:
             csv_reader = csv.reader(csv_file, delimiter=',')
@@ -419,16 +431,8 @@ class stackoverflowProcessor(yelpProcessor):
         self.filter_dense(10, 5)
         print ('Filtered and obtain {} users'.format(len(self.adj)))
         
-        # read vocab
-        self.vocab = {}
-        maxsize = 2000
-        with open('{}/vocab.txt'.format(folder), 'r') as f:
-            for line in f:
-                if len(self.vocab) >= maxsize:
-                    break
-                if line[0] != '#':
-                    self.vocab[line.strip()] = len(self.vocab)
-        print ("vocab size: {}".format(len(self.vocab)))
+        # read or build vocab
+        self.vocab = self.read_vocab(folder, self.answer_texts(folder), vocab_size, num_buckets, workers)
                     
         # read doc and filter out small doc (some edge may removed)
         self.edge_texts = {}
@@ -456,8 +460,9 @@ class stackoverflowProcessor(yelpProcessor):
                         tokens = self.string2gram(row[5], 2)
                         doc = defaultdict(int)
                         for tk in tokens:
-                            if tk in self.vocab:
-                                doc[self.vocab[tk]] += 1
+                            idx = self.vocab.index(tk)
+                            if idx is not None:
+                                doc[idx] += 1
                         if len(doc) <= 10:
                             small += 1
                             continue
@@ -569,6 +574,16 @@ class stackoverflowProcessor(yelpProcessor):
             self.adj = adj_new
             print ('empty: {}, new user: {}'.format(empty, len(self.adj)))
 
+    def answer_texts(self, folder):
+        """
+        Answer texts of the raw data, read lazily for the vocab builder
+        """
+        with open('{}/Answers.csv'.format(folder), encoding = "ISO-8859-1") as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=',')
+            next(csv_reader, None)
+            for row in csv_reader:
+                yield row[5]
+
 def process_stackoverflow():
     folder = "../../dataset/stackoverflow"
     processor = stackoverflowProcessor(folder)
@@ -0,0 +1,119 @@
+import pickle as pkl
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+# names in the frozen graph
+INPUTS = ['batch1', 'batch_size', 'pairs']
+OUTPUTS = ['embeddings', 'theta']
+
+
+def inference_outputs(model):
+    """
+    Named inference outputs of a trained CGAT: embeddings of batch1, theta of pairs
+    """
+    pairs = tf.placeholder(tf.int32, shape=(None, 2), name='pairs')
+    tf.identity(model.embeddings, name='embeddings')
+    tf.identity(model.edge_channels(pairs), name='theta')
+
+def table_variables(model):
+    sampler = model.layer_infos[0].neighbor_sampler
+    tables = [model.features, sampler.adj_info, model.edge_idxs, model.edge_words, model.edge_counts]
+    if sampler.weights is not None:
+        tables.append(sampler.weights)
+    return tables
+
+def const_node(name, value, dtype):
+    node = tf.NodeDef()
+    node.name = name
+    node.op = 'Const'
+    node.attr['dtype'].type = dtype.as_datatype_enum
+    node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value, dtype=dtype))
+    return node
+
+def placeholder_node(variable):
+    node = tf.NodeDef()
+    node.name = variable.name
+    node.op = 'Placeholder'
+    node.attr['dtype'].CopyFrom(variable.attr['dtype'])
+    node.attr['shape'].CopyFrom(variable.attr['shape'])
+    return node
+
+def freeze(sess, model, placeholders, feed_tables=False):
+    """
+    Pruned inference graph of inference_outputs(model): only the ops they need
+    (no optimizer slots, loss or negative tree), variables as constants, inference
+    settings (is_training=False, no dropout) baked in and constant-folded
+    Args:
+        feed_tables: graph tables become placeholders, to be fed at load time,
+                     instead of constants (a GraphDef is limited to 2GB)
+    Returns:
+        graph_def, tables {placeholder name: array} (empty unless feed_tables)
+    """
+    graph_def = tf.graph_util.extract_sub_graph(sess.graph.as_graph_def(), OUTPUTS)
+    settings = {placeholders['is_training'].op.name: (False, tf.bool)}
+    for name in ['dropout', 'ffd_dropout', 'attn_dropout', 'vae_dropout']:
+        settings[placeholders[name].op.name] = (0., tf.float32)
+    table_vars = dict([(v.op.name, v) for v in table_variables(model)]) if feed_tables else {}
+
+    tables = {}
+    pruned = tf.GraphDef()
+    pruned.versions.CopyFrom(graph_def.versions)
+    for node in graph_def.node:
+        if node.name in settings:
+            pruned.node.extend([const_node(node.name, *settings[node.name])])
+        elif node.name in table_vars:
+            pruned.node.extend([placeholder_node(node)])
+            tables[node.name] = sess.run(table_vars[node.name])
+        else:
+            pruned.node.extend([node])
+
+    frozen = tf.graph_util.convert_variables_to_constants(sess, pruned, OUTPUTS)
+    inputs = [name for name in INPUTS] + sorted(tables.keys())
+    frozen = TransformGraph(frozen, inputs, OUTPUTS, ['fold_constants(ignore_errors=true)',
+                                                      'remove_nodes(op=CheckNumerics)',
+                                                      'sort_by_execution_order'])
+    print ('===== frozen graph: {} -> {} nodes, {} MB ====='.format(
+            len(sess.graph.as_graph_def().node), len(frozen.node), frozen.ByteSize() // 2**20))
+    return frozen, tables
+
+def save(filename, graph_def, tables):
+    with open(filename, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    if len(tables) > 0:
+        with open('{}.tables'.format(filename), 'wb') as f:
+            pkl.dump(tables, f, protocol=4)
+
+
+class FrozenModel(object):
+    """
+    Inference from a frozen graph written by save(); fed tables are loaded once
+    into variables of the new graph
+    """
+    def __init__(self, filename, config=None):
+        graph_def = tf.GraphDef()
+        with open(filename, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        table_names = [node.name for node in graph_def.node if node.op == 'Placeholder' and node.name not in INPUTS]
+        tables = {}
+        if len(table_names) > 0:
+            with open('{}.tables'.format(filename), 'rb') as f:
+                tables = pkl.load(f)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            table_phs = {}
+            input_map = {}
+            for name in table_names:
+                table_phs[name] = tf.placeholder(tf.as_dtype(tables[name].dtype), shape=tables[name].shape)
+                input_map[name + ':0'] = tf.Variable(table_phs[name], trainable=False).read_value()
+            tf.import_graph_def(graph_def, input_map=input_map, name='')
+            self.sess = tf.Session(graph=self.graph, config=config)
+            self.sess.run(tf.global_variables_initializer(),
+                          feed_dict=dict([(table_phs[name], tables[name]) for name in table_names]))
+
+    def embed(self, nodes):
+        return self.sess.run('embeddings:0', feed_dict={'batch1:0': nodes, 'batch_size:0': len(nodes)})
+
+    def channels(self, pairs):
+        return self.sess.run('theta:0', feed_dict={'pairs:0': np.array(pairs, dtype=np.int32).reshape(-1, 2)})
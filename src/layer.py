@@ -14,6 +14,30 @@ def zeros_init(shape):
 def ones_init(shape):
     return tf.ones(shape, dtype=tf.float32)
 
+def weighted_batch_norm(x, weights, training, scope, decay=0.999, epsilon=0.001):
+    """
+    Batch norm (center, no scale) over the rows of x, like tf.contrib.layers.batch_norm
+    but with batch moments weighted per row
+    Args:
+        x: [num_rows, dim]
+        weights: [num_rows], multiplicity of each row
+        training: bool (tensor), batch moments and moving average updates in training
+    """
+    dim = x.get_shape().as_list()[-1]
+    with tf.variable_scope(scope):
+        beta = tf.get_variable('beta', shape=[dim], initializer=tf.zeros_initializer())
+        moving_mean = tf.get_variable('moving_mean', shape=[dim], initializer=tf.zeros_initializer(), trainable=False)
+        moving_variance = tf.get_variable('moving_variance', shape=[dim], initializer=tf.ones_initializer(), trainable=False)
+    batch_mean, batch_variance = tf.nn.weighted_moments(x, [0], tf.expand_dims(weights, 1))
+    training = tf.cast(training, tf.float32)
+    tf.add_to_collection(tf.GraphKeys.UPDATE_OPS,
+                         tf.assign_sub(moving_mean, training * (1. - decay) * (moving_mean - batch_mean)))
+    tf.add_to_collection(tf.GraphKeys.UPDATE_OPS,
+                         tf.assign_sub(moving_variance, training * (1. - decay) * (moving_variance - batch_variance)))
+    mean = training * batch_mean + (1. - training) * moving_mean
+    variance = training * batch_variance + (1. - training) * moving_variance
+    return (x - mean) * tf.rsqrt(variance + epsilon) + beta
+
     
 class ChannelAggregator(object):
     """ 
@@ -37,12 +61,15 @@ class ChannelAggregator(object):
     def __call__(self, inputs):
         """
         Args:
-            input: (self_vecs, neighbor_vecs, channel_vecs)
+            input: (self_vecs, neighbor_vecs, channel_vecs[, weights])
             self_vecs.shape = [batch_size, dim]
             neighbor_vecs.shape = [batch_size, num_samples, dim]
             channel_vecs.shape = [batch_size, num_samples, 1]
+            weights.shape = [batch_size, num_samples], importance weights of
+            layer-wise sampled neighbors (None: sampled uniformly from the neighborhood)
         """
-        self_vecs, neighbor_vecs, channel_vecs = inputs
+        self_vecs, neighbor_vecs, channel_vecs = inputs[:3]
+        weights = inputs[3] if len(inputs) > 3 else None
         # reshape: [batch_size, 1, dim]; then concatenate: [batch_size, 1+num_samples, dim]
         vecs = tf.concat([tf.expand_dims(self_vecs, axis=1), neighbor_vecs], axis=1)
         # dropout
@@ -53,7 +80,13 @@ class ChannelAggregator(object):
             f_1 = self.conv2(vecs_trans)  # [batch_size, 1+num_samples, 1]
             f_2 = self.conv2(vecs_trans)
             logits = f_1 + tf.transpose(f_2, [0, 2, 1]) # [batch_size, 1+num_samples, 1+num_samples]
-            coefs = tf.nn.softmax(tf.nn.leaky_relu(logits))
+            logits = tf.nn.leaky_relu(logits)
+            if weights is not None:
+                # self-normalized importance sampling: attention over the full neighborhood
+                # is estimated by weighting each sampled neighbor's score
+                log_weights = tf.log(tf.concat([tf.ones_like(weights[:, :1]), weights], axis=1) + 1e-10)
+                logits += tf.expand_dims(log_weights, axis=1)
+            coefs = tf.nn.softmax(logits)
             # only maintain the target node for each batch
             coefs = tf.slice(coefs, [0,0,0], [-1,1,-1]) # [batch_size, 1, 1+num_samples]
             # channel (add one dim for self channel)
@@ -67,18 +100,20 @@ class ChannelAggregator(object):
             vecs_trans = tf.nn.dropout(vecs_trans, 1-self.ffd_drop)
             # aggregate
             output = tf.matmul(coefs, vecs_trans) # [batch_size, 1, output_dim]
-            output = tf.squeeze(output) # [batch_size, output_dim]
+            output = tf.squeeze(output, axis=1) # [batch_size, output_dim], also for batch_size 1
             if self.usebias:
                 output += self.bias
         return self.act(output)    
             
 class ChannelVAE(object):
-    def __init__(self, name, embed_dim, vocab_dim, channel_dim, dropout=0., act=tf.nn.softplus):
+    def __init__(self, name, embed_dim, vocab_dim, channel_dim, dropout=0., act=tf.nn.softplus, training=True):
         # input_dim: vocabulary size; output_dim: topic number
         self.name = name
         self.dropout = dropout
         self.act = act
         self.channel_dim = channel_dim
+        # bool (tensor): batch statistics in training, moving statistics in inference
+        self.training = training
         
         self.vars = {}
         with tf.variable_scope(name) as scope:
@@ -93,54 +128,87 @@ class ChannelVAE(object):
                                     'sigma_weights': tf.get_variable('sigma_weights', shape=[100, channel_dim]),
                                     'sigma_bias': tf.get_variable('sigma_bias', initializer=zeros_init((channel_dim)))}
             self.vars['decoder'] = {'beta': tf.get_variable('beta', initializer=glorot_init((channel_dim, vocab_dim)))}
+            # topic-word distribution, normalized once per step and shared by every call
+            self.beta = tf.nn.softmax(tf.contrib.layers.batch_norm(self.vars['decoder']['beta'])) # [channel_dim, vocab_dim]
+            self.beta_t = tf.transpose(self.beta) # [vocab_dim, channel_dim]
     
-    def __call__(self, inputs):
+    def __call__(self, inputs, sample=True):
         """
         Args:
             input: (self_vecs, neighbor_vecs, text_vecs)
             self_vecs.shape = [batch_size, embed_dim]
             neighbor_vecs.shape = [batch_size, num_samples, embed_dim]
-            text_vecs.shape = [batch_size, num_samples, vocab_dim]
+            text_vecs = (word_ids, word_counts), bag of words padded with zero counts
+            word_ids.shape = word_counts.shape = [batch_size, num_samples, doc_len]
+            sample: draw z with the reparameterization trick, otherwise use its mean
         """
         self_vecs, neighbor_vecs, text_vecs = inputs
+        word_ids, word_counts = text_vecs
+        doc_len = word_ids.get_shape().as_list()[-1]
+        mu1, var1 = self.prior(self_vecs, neighbor_vecs)
+        
+        # every (node, neighbor) pair is one row of the encoder
+        outs = self.encode(tf.reshape(word_ids, [-1, doc_len]), tf.reshape(word_counts, [-1, doc_len]),
+                           tf.ones([tf.size(word_ids) // doc_len]), sample)
+        shape = tf.shape(word_ids)
+        word_probs = tf.reshape(outs[0], [shape[0], shape[1], doc_len])
+        theta, z_mu0, z_var0, z_log_var0_sq = [tf.reshape(x, [shape[0], shape[1], self.channel_dim]) for x in outs[1:]]
+        return (text_vecs, word_probs, theta, mu1, var1, z_mu0, z_var0, z_log_var0_sq)
+
+    def prior(self, self_vecs, neighbor_vecs):
+        """
+        Channel prior of (node, neighbor) pairs
+        Returns:
+            mu1, var1: [batch_size, num_samples, output_dim]
+        """
         # construct h_{i}+h_{j}: [batch_size, num_samples, embed_dim]
         sum_vecs = tf.multiply(tf.expand_dims(self_vecs, axis=1), neighbor_vecs)
         
-        # prior
         a = tf.exp(tf.nn.softmax(tf.matmul(sum_vecs, self.vars['encoder']['phi']))) # [batch_size, num_samples, output_dim]
         mu1 = tf.log(a) - tf.expand_dims(tf.reduce_mean(tf.log(a), 2), 2)
         var1 = (1.0 / a) * (1. - (2.0 / self.channel_dim)) + \
                  (1.0 / (self.channel_dim * self.channel_dim)) * tf.expand_dims(tf.reduce_sum(1.0 / a, 2), 2)
         mu1 = tf.nn.softmax(mu1)
         var1 = tf.nn.softmax(var1)
-        
+        return mu1, var1
+
+    def encode(self, word_ids, word_counts, weights, sample=True):
+        """
+        Encoder and decoder of edge docs, they only depend on the doc
+        Args:
+            word_ids.shape = word_counts.shape = [num_docs, doc_len]
+            weights: [num_docs], multiplicity of each doc in the batch statistics
+        Returns:
+            word_probs [num_docs, doc_len], theta, z_mu0, z_var0, z_log_var0_sq [num_docs, output_dim]
+        """
         # encoder network
-        layer1 = self.act(tf.add(tf.matmul(text_vecs, self.vars['encoder']['h1_weights']),
+        # sparse first layer: count-weighted sum of the rows of observed words
+        h1_rows = tf.nn.embedding_lookup(self.vars['encoder']['h1_weights'], word_ids) # [num_docs, doc_len, 100]
+        layer1 = self.act(tf.add(tf.reduce_sum(tf.multiply(h1_rows, tf.expand_dims(word_counts, axis=2)), axis=1),
                                 self.vars['encoder']['h1_bias']))
         layer2 = self.act(tf.add(tf.matmul(layer1, self.vars['encoder']['h2_weights']),
                                 self.vars['encoder']['h2_bias']))
         layer_do = tf.nn.dropout(layer2, 1.0-self.dropout)
-        # shape: [batch_size, num_samples, output_dim]
-        z_mu0 = tf.contrib.layers.batch_norm(tf.add(tf.matmul(layer_do, self.vars['encoder']['mean_weights']),
-                                                    self.vars['encoder']['mean_bias']))
-        z_log_var0_sq = tf.contrib.layers.batch_norm(tf.add(tf.matmul(layer_do, self.vars['encoder']['sigma_weights']),
-                                                            self.vars['encoder']['sigma_bias']))
+        # shape: [num_docs, output_dim]
+        # batch norms are shared by every call of this vae
+        with tf.variable_scope(self.name, reuse=tf.AUTO_REUSE):
+            z_mu0 = weighted_batch_norm(tf.add(tf.matmul(layer_do, self.vars['encoder']['mean_weights']),
+                                               self.vars['encoder']['mean_bias']),
+                                        weights, self.training, scope='mean_bn')
+            z_log_var0_sq = weighted_batch_norm(tf.add(tf.matmul(layer_do, self.vars['encoder']['sigma_weights']),
+                                                       self.vars['encoder']['sigma_bias']),
+                                                weights, self.training, scope='sigma_bn')
         z_mu0 = tf.nn.softmax(z_mu0)
         z_log_var0_sq = tf.log(tf.nn.softmax(z_log_var0_sq))
         
         # reparameterization trick
         eps = tf.random_normal(shape=(1, self.channel_dim), mean=0., stddev=1., dtype=tf.float32)
-        z = tf.add(z_mu0, tf.multiply(tf.sqrt(tf.exp(z_log_var0_sq)), eps))
+        z = tf.add(z_mu0, tf.multiply(tf.sqrt(tf.exp(z_log_var0_sq)), eps)) if sample else z_mu0
         z_var0 = tf.exp(z_log_var0_sq)
         
-        # decoder network
+        # decoder network, p(w) = theta * beta[:, w] evaluated only at observed words
         theta = tf.nn.dropout(tf.nn.softmax(z), 1.0-self.dropout)
-        beta = tf.nn.softmax(tf.contrib.layers.batch_norm(self.vars['decoder']['beta']))
-        x_reconstr_mean = tf.add(tf.matmul(theta, beta), 0.0)
-
-        return (text_vecs, x_reconstr_mean, theta, mu1, var1, z_mu0, z_var0, z_log_var0_sq)
-
-
-
-
+        beta_rows = tf.nn.embedding_lookup(self.beta_t, word_ids) # [num_docs, doc_len, output_dim]
+        word_probs = tf.reduce_sum(tf.multiply(beta_rows, tf.expand_dims(theta, axis=1)), axis=2)
 
+        return (word_probs, theta, z_mu0, z_var0, z_log_var0_sq)
@@ -0,0 +1,49 @@
+import os
+import time
+import types
+import importlib
+
+# process start, for reporting startup time of the entry points
+START = time.time()
+
+# local nltk resources, never fetched from the network unless CGAT_NLTK_DOWNLOAD=1
+NLTK_DIR = os.environ.get('NLTK_DATA', os.path.expanduser('~/.cache/cgat/nltk_data'))
+NLTK_RESOURCES = {'punkt': 'tokenizers/punkt'}
+# resources already resolved
+NLTK_LOADED = set()
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module imported on first attribute access, so that heavy dependencies
+    (tensorflow) are not loaded by --help or by scripts that never use them
+    """
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        return getattr(self._module, attr)
+
+
+def load_nltk(resources=('punkt',)):
+    """
+    nltk with its resources resolved from NLTK_DIR
+    """
+    import nltk
+    if NLTK_DIR not in nltk.data.path:
+        nltk.data.path.insert(0, NLTK_DIR)
+    for name in resources:
+        if name in NLTK_LOADED:
+            continue
+        try:
+            nltk.data.find(NLTK_RESOURCES[name])
+        except LookupError:
+            if os.environ.get('CGAT_NLTK_DOWNLOAD') != '1':
+                raise LookupError('nltk resource {} not found in {}: copy it there, '
+                                  'or set CGAT_NLTK_DOWNLOAD=1 to download it'.format(name, NLTK_DIR))
+            nltk.download(name, download_dir=NLTK_DIR, quiet=True)
+        NLTK_LOADED.add(name)
+    return nltk
@@ -3,90 +3,391 @@ import random
 from scipy.sparse import *
 import tensorflow as tf
 
+from src.data_loader import WalkStream
+from src.partition import partition_graph
+
 
 np.random.seed(123)
 
 
 class NeighborSampler(object):
     """
-    Uniformly samples neighbors.
-    Assumes that adj lists are padded with random re-sampling
+    Samples num_samples neighbors of every node from its padded adj list.
+    Every row draws its own random columns, and only the sampled entries of
+    adj_info are gathered
     """
-    def __init__(self, adj_info):
+    def __init__(self, adj_info, replace=False, weights=None):
+        """
+        Args:
+            adj_info: [num_nodes, max_degree] padded adj lists
+            replace: draw columns with replacement (one random number per sample)
+            weights: optional [num_nodes, max_degree] positive weights of the adj entries,
+                     columns are then drawn proportional to them, without replacement
+        """
         self.adj_info = adj_info
+        self.replace = replace and weights is None
+        self.weights = weights
+        self.max_degree = adj_info.get_shape().as_list()[1]
 
     def __call__(self, inputs):
         ids, num_samples = inputs
-        adj_lists = tf.nn.embedding_lookup(self.adj_info, ids) 
-        adj_lists = tf.transpose(tf.random_shuffle(tf.transpose(adj_lists)))
-        adj_lists = tf.slice(adj_lists, [0,0], [-1, num_samples])
-        return adj_lists
+        return self.sample_hops(ids, [num_samples])[0]
+
+    def sample_hops(self, ids, num_samples):
+        """
+        Fused multi-hop sampling: hop k samples num_samples[k] neighbors of every
+        node sampled at hop k-1, random numbers of all hops come from one op
+        Returns:
+            list of [num_nodes at hop k-1, num_samples[k]]
+        """
+        ids = tf.reshape(tf.cast(ids, dtype=tf.int32), [-1])
+        rows = [tf.shape(ids)[0]]
+        for n in num_samples[:-1]:
+            rows.append(rows[-1] * n)
+        sizes = [r * (n if self.replace else self.max_degree) for r, n in zip(rows, num_samples)]
+        draws = tf.split(tf.random_uniform(tf.reshape(tf.add_n(sizes), [1])), tf.stack(sizes))
+
+        hops = []
+        for k, n in enumerate(num_samples):
+            if self.replace:
+                cols = tf.cast(tf.reshape(draws[k], [-1, n]) * self.max_degree, dtype=tf.int32)
+                cols = tf.minimum(cols, self.max_degree - 1)
+            else:
+                # top-k of random keys: a random subset of columns per row,
+                # with Gumbel noise on log weights it is weighted sampling without replacement
+                keys = tf.reshape(draws[k], [-1, self.max_degree])
+                if self.weights is not None:
+                    weights = tf.nn.embedding_lookup(self.weights, ids)
+                    keys = tf.log(weights + 1e-10) - tf.log(-tf.log(keys + 1e-10) + 1e-10)
+                _, cols = tf.nn.top_k(keys, k=n)
+            rows_idx = tf.tile(tf.expand_dims(ids, axis=1), [1, n])
+            nodes = tf.gather_nd(self.adj_info, tf.stack([rows_idx, cols], axis=2))
+            hops.append(nodes)
+            ids = tf.reshape(nodes, [-1])
+        return hops
+
+
+class LayerSampler(object):
+    """
+    Layer-wise importance sampling (FastGCN/LADIES style): every hop samples one
+    node set of at most layer_size nodes from the union of the adj lists of the
+    previous hop, proportional to the number of links into it, and every node
+    draws its neighbors among that set. A hop costs layer_size x num_samples
+    instead of the product of the sample sizes of all hops before it
+    """
+    def __init__(self, adj_info, layer_size=512):
+        self.adj_info = adj_info
+        self.layer_size = layer_size
+        # no adj weights: the layer-wise probabilities replace them
+        self.weights = None
+        self.max_degree = adj_info.get_shape().as_list()[1]
+
+    def sample_layers(self, ids, num_samples):
+        """
+        Returns:
+            per hop k: (nodes [at most layer_size], neighbors [rows, num_samples[k]],
+            positions of the neighbors in nodes, importance weights of the neighbors),
+            rows are the nodes of hop k-1 (the inputs for k=0)
+        """
+        ids = tf.reshape(tf.cast(ids, dtype=tf.int32), [-1])
+        hops = []
+        for n in num_samples:
+            adj = tf.nn.embedding_lookup(self.adj_info, ids) # [rows, max_degree]
+            cands, idx, counts = tf.unique_with_counts(tf.reshape(adj, [-1]))
+            num_cands = tf.shape(cands)[0]
+            probs = tf.cast(counts, tf.float32) / tf.cast(tf.size(adj), tf.float32)
+            # layer_size candidates without replacement (Gumbel top-k)
+            k = tf.minimum(self.layer_size, num_cands)
+            gumbel = -tf.log(-tf.log(tf.random_uniform([num_cands]) + 1e-10) + 1e-10)
+            _, picked = tf.nn.top_k(tf.log(probs) + gumbel, k=k)
+            nodes = tf.gather(cands, picked)
+            # approximate inclusion probability of every picked node
+            inclusion = tf.minimum(1., tf.cast(k, tf.float32) * tf.gather(probs, picked))
+
+            # position in nodes of every adj entry, -1 if not picked
+            slots = tf.scatter_nd(tf.expand_dims(picked, axis=1), tf.range(1, k + 1), tf.expand_dims(num_cands, 0))
+            slots = tf.reshape(tf.gather(slots, idx), tf.shape(adj)) - 1
+            picked_adj = slots >= 0
+            # n picked neighbors per row, uniformly with replacement; rows without
+            # any picked neighbor get zero weights
+            logits = tf.where(picked_adj, tf.zeros_like(slots, dtype=tf.float32), -1e9 * tf.ones_like(slots, dtype=tf.float32))
+            cols = tf.multinomial(logits, n, output_dtype=tf.int32) # [rows, n]
+            rows_idx = tf.tile(tf.expand_dims(tf.range(tf.shape(adj)[0]), axis=1), [1, n])
+            at = tf.stack([rows_idx, cols], axis=2)
+            positions = tf.maximum(tf.gather_nd(slots, at), 0)
+            weights = tf.cast(tf.gather_nd(picked_adj, at), tf.float32) / tf.gather(inclusion, positions)
+            # mean weight 1 per row, as uniformly sampled neighbors have
+            weights /= tf.maximum(tf.reduce_mean(weights, axis=1, keepdims=True), 1e-10)
+            hops.append((nodes, tf.gather(nodes, positions), positions, weights))
+            ids = nodes
+        return hops
+
+
+class AliasSampler(object):
+    """
+    Samples node ids proportional to weights ** distortion in O(1) per draw
+    with Walker's alias method. The table is two flat arrays built once on the
+    host, forked workers share them
+    """
+    def __init__(self, weights, distortion=0.75):
+        probs = np.power(np.asarray(weights, dtype=np.float64), distortion)
+        n = len(probs)
+        probs = probs * n / probs.sum()
+        self.prob = np.ones(n, dtype=np.float64)
+        self.alias = np.arange(n, dtype=np.int64)
+        small = [i for i in range(n) if probs[i] < 1.]
+        large = [i for i in range(n) if probs[i] >= 1.]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = probs[s]
+            self.alias[s] = l
+            probs[l] -= 1. - probs[s]
+            if probs[l] < 1.:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def sample(self, size, exclude=None, max_tries=10):
+        """
+        Args:
+            exclude: node ids never returned (e.g. true partners of the batch),
+                     they are redrawn up to max_tries times, and the draws still
+                     left are taken from the distribution without them
+        """
+        samples = self.draw(size)
+        if exclude is None or len(exclude) == 0:
+            return samples
+        for i in range(max_tries):
+            hit = np.isin(samples, exclude)
+            if not hit.any():
+                return samples
+            samples[hit] = self.draw(hit.sum())
+        hit = np.isin(samples, exclude)
+        if hit.any():
+            probs = self.probs()
+            exclude = np.asarray(exclude, dtype=np.int64)
+            probs[exclude[exclude < len(probs)]] = 0.
+            if probs.sum() == 0:
+                print ('negative sampling: every node is excluded, {} negatives kept'.format(hit.sum()))
+                return samples
+            samples[hit] = np.random.choice(len(probs), hit.sum(), p=probs / probs.sum())
+        return samples
+
+    def probs(self):
+        """
+        Probability of every id, as drawn from the table
+        """
+        n = len(self.prob)
+        return (self.prob + np.bincount(self.alias, weights=1. - self.prob, minlength=n)) / n
+
+    def draw(self, size):
+        idx = np.random.randint(len(self.prob), size=size)
+        keep = np.random.random_sample(size) < self.prob[idx]
+        return np.where(keep, idx, self.alias[idx])
+
     
 class EdgeBatch(object):
     """
     sample edge batch
     """
-    def __init__(self, G, edgetexts, placeholders, walks, batch_size=100, max_degree=25, vocab_dim=5000):
+    # read-only graph tables, built once per graph and max_degree
+    TABLES = ['num_rows', 'adj', 'deg', 'neg_sampler', 'edge_idx', 'edge_words', 'edge_counts', 'num_edges']
+
+    def __init__(self, G, edgetexts, placeholders, walks, batch_size=100, max_degree=25, neg_sample=20,
+                 reserve_nodes=0, reserve_edges=0, tables=None, neg_exclude=False):
+        """
+        Args:
+            neg_exclude: never draw the true partner of a pair of the batch as a negative
+            reserve_nodes, reserve_edges: empty table rows kept for nodes and edges
+                                          spliced in after training (cold start)
+            tables: tables() of another EdgeBatch of the same graph, shared instead of rebuilt
+        Node tables have num_rows + 1 rows: row num_rows is the padding sentinel of
+        the adj lists (no edges, zero features), never taken by a cold-start node
+        """
         self.G = G
         self.placeholders = placeholders
         self.batch_size = batch_size
         self.max_degree = max_degree
+        self.neg_sample = neg_sample
+        self.neg_exclude = neg_exclude
         self.batch_num = 0
+        # {placeholder: table} fed with every batch, see feed_tables
+        self.table_feed = {}
         
         self.nodes = np.random.permutation(G.nodes())
-        self.edges = np.random.permutation(walks)
+        # walks: list of pairs, or a WalkStream read chunk by chunk
+        self.walks = walks if isinstance(walks, WalkStream) else None
+        self.epoch = 0
+        if self.walks is None:
+            self.edges = np.random.permutation(walks)
+        else:
+            self.stream = self.walks.epoch(self.epoch)
+            self.edges = np.zeros((0, 2), dtype=np.int64)
+
+        if tables is not None:
+            for name in self.TABLES:
+                setattr(self, name, tables[name])
+            return
+
+        self.num_rows = len(self.nodes) + reserve_nodes
         self.adj, self.deg = self.construct_adj()
+        # degree-based negative sampling with distortion 0.75
+        self.neg_sampler = AliasSampler(self.deg, distortion=0.75)
         
-        pairs = np.array(sorted([list(k) for k in edgetexts.keys()], key=lambda x:(x[0], x[1])), dtype=np.int64)
-        rows = np.array([p[0] for p in pairs])
-        cols = np.array([p[1] for p in pairs])
-        indexs = np.array([i for i in range(len(edgetexts))], dtype=np.int32)
-        self.edge_idx = csr_matrix((indexs, (rows,cols)), shape=(self.adj.shape[0], self.adj.shape[0])).todense()
+        # edge_idx and edge docs share one (sorted) order of edges,
+        # index 0 is reserved for node pairs without edge (empty doc)
+        pairs = sorted(edgetexts.keys())
+        rows = np.array([p[0] for p in pairs], dtype=np.int64)
+        cols = np.array([p[1] for p in pairs], dtype=np.int64)
+        indexs = np.arange(1, len(pairs) + 1, dtype=np.int32)
+        self.edge_idx = csr_matrix((indexs, (rows,cols)), shape=(self.num_rows + 1, self.num_rows + 1)).todense()
     
-        self.edge_vec = np.array([self.onehot(edgetexts[k], vocab_dim) for k in edgetexts.keys()])
+        self.edge_words, self.edge_counts = self.bag_of_words([{}] + [edgetexts[p] for p in pairs] + [{}] * reserve_edges)
+        # next free row of edge docs
+        self.num_edges = len(pairs) + 1
+
+    def tables(self):
+        return dict([(name, getattr(self, name)) for name in self.TABLES])
+
+    def feed_tables(self, table_feed, adj_ph, weights_ph=None):
+        """
+        Feed the graph tables with every batch instead of copying them into variables:
+        tensorflow reads fed arrays of the placeholder dtype in place (if aligned),
+        so processes forked from the one holding the tables do not copy them
+        Args:
+            table_feed: {placeholder: table}
+            adj_ph, weights_ph: placeholders of the adj lists and their weights
+        """
+        self.table_feed = dict(table_feed)
+        self.table_phs = (adj_ph, weights_ph)
+        if weights_ph is not None:
+            self.table_feed[weights_ph] = self.neighbor_weights()
         
     def construct_adj(self):
-        adj = len(self.nodes) * np.ones((len(self.nodes), self.max_degree))
-        deg = np.zeros((len(self.nodes), ))
+        # nodes without neighbors point to the sentinel row, the sentinel to itself
+        adj = self.num_rows * np.ones((self.num_rows + 1, self.max_degree))
+        deg = np.zeros((self.num_rows + 1, ))
         
         for nid in self.G.nodes():
-            neighbors = np.array([n for n in self.G.neighbors(nid)])
-            degree = len(neighbors)
-            deg[nid] = degree
-            if degree == 0:
+            neighbors = np.array([n for n in self.G.neighbors(nid)], dtype=np.int64)
+            deg[nid] = len(neighbors)
+            neighbors = self.adj_neighbors(nid, neighbors)
+            if len(neighbors) == 0:
                 continue
-            if degree > self.max_degree:
-                neighbors = np.random.choice(neighbors, self.max_degree, replace=False)
-            elif degree < self.max_degree:
-                neighbors = np.random.choice(neighbors, self.max_degree, replace=True)
-            adj[nid, :] = neighbors
+            adj[nid, :] = self.neighbor_row(neighbors)
         return adj, deg
+
+    def adj_neighbors(self, nid, neighbors):
+        """
+        Neighbors of nid kept in its adj list
+        """
+        return neighbors
+
+    def full_graph(self):
+        """
+        Adj lists with all neighbors for export and inference (they already are)
+        """
+        pass
+
+    def neighbor_row(self, neighbors):
+        """
+        Exactly max_degree neighbors: subsampled, or padded by re-sampling
+        """
+        if len(neighbors) > self.max_degree:
+            return np.random.choice(neighbors, self.max_degree, replace=False)
+        elif len(neighbors) < self.max_degree:
+            return np.random.choice(neighbors, self.max_degree, replace=True)
+        return neighbors
     
-    def onehot(self, doc, min_len):
-        vec = []
-        for w_idx, w_cnt in doc.items():
-            for i in range(w_cnt):
-                vec.append(w_idx)
-        return np.bincount(np.array(vec).astype('int'), minlength=min_len)
+    def neighbor_weights(self, nodes=None):
+        """
+        Weights of the adj entries of nodes for weighted neighbor sampling:
+        1 + log(1 + number of words of the edge doc), pairs without doc get 1
+        """
+        nodes = np.arange(self.num_rows + 1) if nodes is None else np.asarray(nodes)
+        adj = self.adj[nodes].astype(np.int64)
+        idx = np.asarray(self.edge_idx)[nodes[:, np.newaxis], adj]
+        return (1. + np.log1p(self.edge_counts.sum(axis=1)[idx])).astype(np.float32)
+
+    def bag_of_words(self, docs):
+        """
+        Sparse edge docs padded to the longest doc: word ids and their counts,
+        padding entries have count 0
+        """
+        doc_len = max([len(doc) for doc in docs])
+        words = np.zeros((len(docs), doc_len), dtype=np.int32)
+        counts = np.zeros((len(docs), doc_len), dtype=np.float32)
+        for i, doc in enumerate(docs):
+            words[i, :len(doc)] = list(doc.keys())
+            counts[i, :len(doc)] = list(doc.values())
+        return words, counts
+
+    def doc_row(self, doc):
+        """
+        One doc in the padded layout of edge_words/edge_counts,
+        keeping the most frequent words if it is longer than the table
+        """
+        doc_len = self.edge_words.shape[1]
+        items = sorted(doc.items(), key=lambda kv: -kv[1])[:doc_len]
+        words = np.zeros(doc_len, dtype=np.int32)
+        counts = np.zeros(doc_len, dtype=np.float32)
+        words[:len(items)] = [w for w, c in items]
+        counts[:len(items)] = [c for w, c in items]
+        return words, counts
 
     def end_edge(self):
+        self.fill()
         return self.batch_num * self.batch_size >= len(self.edges)
+
+    def fill(self):
+        """
+        Streamed walks: keep at least one batch of pairs in the buffer
+        """
+        if self.walks is None or self.stream is None:
+            return
+        self.edges = self.edges[self.batch_num * self.batch_size:]
+        self.batch_num = 0
+        chunks = [self.edges]
+        size = len(self.edges)
+        while size < self.batch_size:
+            chunk = next(self.stream, None)
+            if chunk is None:
+                self.stream = None
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        self.edges = np.concatenate(chunks)
     
     def end_node(self):
         return self.batch_num * self.batch_size >= len(self.nodes)
     
     def left_edge(self):
+        if self.walks is not None:
+            return len(self.walks) // self.batch_size
         return len(self.edges) // self.batch_size
     
     def left_node(self):
         return len(self.nodes) // self.batch_size
     
     def next_edgebatch_feed_dict(self):
+        self.fill()
         start_idx = self.batch_num * self.batch_size
         self.batch_num += 1
         end_idx = min(start_idx + self.batch_size, len(self.edges))
         edge_batch = self.edges[start_idx : end_idx]
-        return (self.batch_feed_dict(edge_batch), edge_batch)
+        feed_dict = self.batch_feed_dict(edge_batch)
+        feed_dict[self.placeholders['neg_sample']] = self.negatives(edge_batch)
+        return (feed_dict, edge_batch)
+
+    def negatives(self, edge_batch):
+        """
+        Negatives shared by the batch; with neg_exclude, the true partners
+        (node2 of every pair) are excluded, negatives being scored against every pair
+        """
+        exclude = None
+        if self.neg_exclude:
+            exclude = np.unique([n2 for n1, n2 in edge_batch])
+        return self.neg_sampler.sample(self.neg_sample, exclude=exclude)
 
     def next_nodebatch_feed_dict(self):
         start_idx = self.batch_num * self.batch_size
@@ -102,15 +403,119 @@ class EdgeBatch(object):
         feed_dict = {self.placeholders['batch_size']: len(edge_batch), 
                      self.placeholders['batch1']: batch1,
                      self.placeholders['batch2']: batch2}
+        feed_dict.update(self.table_feed)
         return feed_dict
         
     def batch_num(self):
         return len(self.edges) // self.batch_size + 1
     
     def shuffle(self):
-        self.edges = np.random.permutation(self.edges)
+        if self.walks is None:
+            self.edges = np.random.permutation(self.edges)
+        else:
+            # a new epoch of walks with a fresh seed
+            self.epoch += 1
+            self.stream = self.walks.epoch(self.epoch)
+            self.edges = np.zeros((0, 2), dtype=np.int64)
+        self.nodes = np.random.permutation(self.nodes)
+        self.batch_num = 0
+
+
+class ClusterBatch(EdgeBatch):
+    """
+    Cluster-GCN style batches: the training graph is partitioned once, and every
+    epoch the clusters are put into random groups of clusters_per_batch. Consecutive
+    batches hold the walk pairs inside one group, and adj lists keep the neighbors
+    inside the group of the epoch, so the trees of a batch mostly expand into the
+    same nodes; links between the clusters of a group are kept
+    """
+    def __init__(self, G, edgetexts, placeholders, walks, num_clusters=50, clusters_per_batch=2, **kwargs):
+        self.num_clusters = num_clusters
+        self.clusters_per_batch = clusters_per_batch
+        adj = dict([(n, list(G.neighbors(n))) for n in G.nodes()])
+        self.parts = partition_graph(adj, num_clusters)
+        # no groups yet: the tables are built with all neighbors
+        self.group = None
+        self.assign = None
+        super(ClusterBatch, self).__init__(G, edgetexts, placeholders, walks, **kwargs)
+        self.full_adj = self.adj
+        # streamed walks are read one whole epoch at a time to be grouped by cluster
+        self.stream = None
+        self.walk_pairs = None if self.walks is not None else self.edges
+        self.new_epoch()
+
+    def adj_neighbors(self, nid, neighbors):
+        if self.group is None or len(neighbors) == 0:
+            return neighbors
+        # nodes without neighbors in the group point to the padding sentinel
+        return neighbors[self.group[neighbors] == self.group[nid]]
+
+    def epoch_pairs(self):
+        if self.walks is None:
+            return self.walk_pairs
+        return np.concatenate([np.zeros((0, 2), dtype=np.int64)] + list(self.walks.epoch(self.epoch)))
+
+    def new_epoch(self):
+        """
+        Random groups of clusters_per_batch clusters, the in-group adj lists
+        and the in-group walk pairs ordered by group, shuffled within a group
+        """
+        self.group = (np.random.permutation(self.num_clusters) // self.clusters_per_batch)[self.parts]
+        self.adj, _ = self.construct_adj()
+        pairs = np.asarray(self.epoch_pairs(), dtype=np.int64).reshape(-1, 2)
+        group = self.group[pairs[:, 0]]
+        inside = group == self.group[pairs[:, 1]]
+        self.edges = pairs[inside][np.lexsort((np.random.random_sample(inside.sum()), group[inside]))]
+        self.push()
+        print ('===== cluster batches: {} clusters, {} per batch, {:.1%} of walk pairs inside a group ====='.format(
+                self.num_clusters, self.clusters_per_batch, len(self.edges) / float(max(1, len(pairs)))))
+
+    def feed_tables(self, table_feed, adj_ph, weights_ph=None):
+        super(ClusterBatch, self).feed_tables(table_feed, adj_ph, weights_ph)
+        # the in-group adj lists of the epoch
+        self.push()
+
+    def bind(self, sess, adj_info, weights=None):
+        """
+        Keep the adj_info (and adj weights) variables of sess in sync with self.adj
+        """
+        self.sess = sess
+        self.adj_ph = tf.placeholder(tf.int32, shape=self.adj.shape)
+        self.assign = [tf.assign(adj_info, self.adj_ph)]
+        self.weights_ph = None
+        if weights is not None:
+            self.weights_ph = tf.placeholder(tf.float32, shape=self.adj.shape)
+            self.assign.append(tf.assign(weights, self.weights_ph))
+
+    def push(self):
+        if len(self.table_feed) > 0:
+            adj_ph, weights_ph = self.table_phs
+            self.table_feed[adj_ph] = self.adj.astype(np.int32, copy=False)
+            if weights_ph is not None:
+                self.table_feed[weights_ph] = self.neighbor_weights()
+        if self.assign is None:
+            return
+        feed_dict = {self.adj_ph: self.adj}
+        if self.weights_ph is not None:
+            feed_dict[self.weights_ph] = self.neighbor_weights()
+        self.sess.run(self.assign, feed_dict=feed_dict)
+
+    def full_graph(self):
+        """
+        All neighbors in the adj lists, for export and inference after training
+        """
+        self.group = None
+        self.adj = self.full_adj
+        self.push()
+
+    def left_edge(self):
+        return len(self.edges) // self.batch_size
+
+    def shuffle(self):
+        # after full_graph only node batches are read, adj lists stay complete
+        if self.group is not None:
+            if self.walks is not None:
+                self.epoch += 1
+            self.new_epoch()
         self.nodes = np.random.permutation(self.nodes)
         self.batch_num = 0
-        
-        
-        
\ No newline at end of file
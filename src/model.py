@@ -21,11 +21,15 @@ class CGAT(object):
     """
     Channel-aware Graph Attention Network
     """
-    def __init__(self, placeholders, features, vocab_dim, edge_idx, edge_vec, degrees, layer_infos, 
-                 neg_sample, learning_rate, weight_decay):
+    def __init__(self, placeholders, features, vocab_dim, edge_idx, edge_words, edge_counts, layer_infos, 
+                 neg_sample, learning_rate, weight_decay, history=False, share_roots=False,
+                 accum_steps=1, warmup_steps=0, feed_features=False):
         self.vocab_dim = vocab_dim
         self.edge_idxs = edge_idx
-        self.edge_vecs = edge_vec
+        # sparse edge docs: [num_edges, doc_len]
+        self.edge_words = edge_words
+        self.edge_counts = edge_counts
+        self.doc_len = edge_words.get_shape().as_list()[1]
 
         # define heads, otherwise cannot _build
         self.heads = [layer_infos[i].num_head for i in range(len(layer_infos))]
@@ -35,15 +39,42 @@ class CGAT(object):
         self.batch_size = placeholders['batch_size']
         self.placeholders = placeholders
         
-        self.features = tf.Variable(tf.constant(features, dtype=tf.float32), trainable=False)
-        self.degrees = degrees
+        # fed at initialization (features_ph), not baked into the graph as a constant;
+        # with feed_features, fed with every run instead of copied into a variable
+        self.features_ph = tf.placeholder(tf.float32, shape=features.shape, name='features')
+        self.features = self.features_ph
+        if not feed_features:
+            self.features = tf.Variable(self.features_ph, trainable=False, name='features')
         self.neg_sample_size = neg_sample
         
         self.dims = [features.shape[1]]
         self.dims.extend([layer_infos[i].output_dim for i in range(len(layer_infos))])
         self.layer_infos = layer_infos
         
-        self.optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate)
+        # historical embeddings: stale outputs of every hidden layer for all nodes,
+        # local variables so that they are neither checkpointed nor restored
+        self.use_history = history
+        self.histories = []
+        if history:
+            for layer in range(len(layer_infos) - 1):
+                self.histories.append(tf.Variable(tf.zeros([features.shape[0], self.dims[layer + 1]]),
+                                                  trainable=False, name='history_' + str(layer),
+                                                  collections=[tf.GraphKeys.LOCAL_VARIABLES]))
+        
+        # one tree per unique node of batch1 and batch2 (cluster batches repeat nodes)
+        self.share_roots = share_roots
+        
+        # large batches: gradients of accum_steps micro-batches are averaged in-graph
+        # before one update, the learning rate ramps up linearly over warmup_steps updates
+        self.accum_steps = accum_steps
+        self.global_step = None
+        self.learning_rate = learning_rate
+        if accum_steps > 1 or warmup_steps > 0:
+            self.global_step = tf.Variable(0, trainable=False, name='global_step')
+            if warmup_steps > 0:
+                warmup = tf.cast(self.global_step + 1, tf.float32) / float(warmup_steps)
+                self.learning_rate = learning_rate * tf.minimum(1., warmup)
+        self.optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
         self.weight_decay = weight_decay
         
         self.build()
@@ -56,40 +87,146 @@ class CGAT(object):
         
         self.loss = self.loss / tf.cast(self.batch_size, tf.float32)
         grads_and_vars = self.optimizer.compute_gradients(self.loss)
-        clipped_grads_and_vars = [(tf.clip_by_value(grad, -5.0, 5.0) if grad is not None else None, var)
-                                 for grad, var in grads_and_vars]
-        self.opt_op = self.optimizer.apply_gradients(clipped_grads_and_vars)
+        self.grads_and_vars = [(tf.clip_by_value(grad, -5.0, 5.0), var)
+                               for grad, var in grads_and_vars if grad is not None]
+        # keep moving statistics of vae batch norms for inference
+        self.update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        if self.accum_steps == 1:
+            with tf.control_dependencies(self.update_ops):
+                self.opt_op = self.optimizer.apply_gradients(self.grads_and_vars, global_step=self.global_step)
+            self.accum_op = self.opt_op
+            return
+
+        # accum_op adds the gradients of a micro-batch, opt_op adds the last one,
+        # applies the mean and resets the sums (local variables, not checkpointed)
+        accums = [tf.Variable(tf.zeros(var.get_shape()), trainable=False, name='accum_' + str(i),
+                              collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                  for i, (_, var) in enumerate(self.grads_and_vars)]
+        with tf.control_dependencies(self.update_ops):
+            self.accum_op = tf.group([accum.assign_add(grad) for accum, (grad, _) in zip(accums, self.grads_and_vars)])
+        with tf.control_dependencies([self.accum_op]):
+            means = [(accum.read_value() / float(self.accum_steps), var) for accum, (_, var) in zip(accums, self.grads_and_vars)]
+            apply_op = self.optimizer.apply_gradients(means, global_step=self.global_step)
+        with tf.control_dependencies([apply_op]):
+            self.opt_op = tf.group([accum.assign(tf.zeros_like(accum)) for accum in accums])
+        # flush_op applies a trailing partial group, the mean over its accum_count micro-batches
+        self.accum_count = tf.placeholder(tf.float32, shape=(), name='accum_count')
+        flush_op = self.optimizer.apply_gradients([(accum.read_value() / self.accum_count, var)
+                                                   for accum, (_, var) in zip(accums, self.grads_and_vars)],
+                                                  global_step=self.global_step)
+        with tf.control_dependencies([flush_op]):
+            self.flush_op = tf.group([accum.assign(tf.zeros_like(accum)) for accum in accums])
+
+    def train_op(self, step):
+        """
+        Op to run for micro-batch step: the update every accum_steps micro-batches
+        """
+        return self.opt_op if (step + 1) % self.accum_steps == 0 else self.accum_op
+
+    def flush(self, sess, steps):
+        """
+        After steps micro-batches, apply the gradients of a trailing partial group
+        """
+        if steps % self.accum_steps != 0:
+            sess.run(self.flush_op, feed_dict={self.accum_count: steps % self.accum_steps})
 
     def _build(self):
-        # negative sampling
-        labels = tf.reshape(tf.cast(self.placeholders['batch2'], dtype=tf.int64), [self.batch_size, 1])
-        self.neg_samples, _, _ = tf.nn.fixed_unigram_candidate_sampler(
-            true_classes=labels,
-            num_true=1,
-            num_sampled=self.neg_sample_size,
-            unique=False,
-            range_max=len(self.degrees),
-            distortion=0.75,
-            unigrams=self.degrees.tolist()
-        )
+        # negative sampling, drawn on the host (EdgeBatch.neg_sampler)
+        self.neg_samples = self.placeholders['neg_sample']
         
         # convolution for three set of nodes
-        # sample layers of nodes
-        samples1, support_sizes1, edges1 = self.sample(self.inputs1, self.batch_size)
-        samples2, support_sizes2, edges2 = self.sample(self.inputs2, self.batch_size)
-        neg_samples, neg_support_sizes, neg_edges = self.sample(self.neg_samples, self.neg_sample_size)
-        
-        # initialize the aggregators
+        # (with history, only 1-hop neighbors are sampled, deeper hops read history tables)
         self.init_aggregator()
-        
-        # aggregate
-        self.outputs1, self.vae_outs1 = self.aggregate(samples1, support_sizes1, edges1, self.batch_size)
-        self.outputs2, self.vae_outs2 = self.aggregate(samples2, support_sizes2, edges2, self.batch_size)
-        self.neg_outputs, self.neg_vae_outs = self.aggregate(neg_samples, neg_support_sizes, neg_edges, self.neg_sample_size)
-        
-        self.outputs1 = tf.nn.l2_normalize(self.outputs1, 1)
-        self.outputs2 = tf.nn.l2_normalize(self.outputs2, 1)
-        self.neg_outputs = tf.nn.l2_normalize(self.neg_outputs, 1)
+        depth = 1 if self.use_history else None
+        roots = [(self.inputs1, self.batch_size), (self.inputs2, self.batch_size), (self.neg_samples, self.neg_sample_size)]
+        if self.share_roots:
+            nodes, inverse = tf.unique(tf.concat([tf.cast(self.inputs1, tf.int32), tf.cast(self.inputs2, tf.int32)], 0))
+            roots = [(nodes, tf.shape(nodes)[0]), (self.neg_samples, self.neg_sample_size)]
+        trees = [self.sample(inputs, size, depth) + (size,) for inputs, size in roots]
+        # the vae of each layer runs once per unique edge doc of the three trees
+        encoded, self.edge_reconstr_loss = self.encode_edges(trees)
+        outs = []
+        for (samples, support_sizes, edges, links, size), enc in zip(trees, encoded):
+            outputs, vae_outs, writes = self.aggregate(samples, support_sizes, edges, size, self.use_history, enc, links)
+            outs.append((tf.nn.l2_normalize(outputs, 1), vae_outs, writes))
+        if self.share_roots:
+            # batch1 and batch2 read their rows of the shared trees, whose vae terms count for both
+            (outputs, vae_outs, writes), neg = outs
+            inverse1, inverse2 = tf.split(inverse, 2)
+            outs = [(tf.gather(outputs, inverse1), vae_outs, writes), (tf.gather(outputs, inverse2), vae_outs, []), neg]
+        (self.outputs1, self.vae_outs1, writes1), (self.outputs2, self.vae_outs2, writes2), \
+            (self.neg_outputs, self.neg_vae_outs, writes_neg) = outs
+        if self.use_history:
+            # in-batch nodes write back their fresh outputs with every training step
+            for write in writes1 + writes2 + writes_neg:
+                tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, write)
+
+        # trees of a single set of nodes (training trees share the vae over all three),
+        # for export, serving, history refresh and the drift of the history approximation;
+        # they never run in a training step, their batch norm updates are dropped
+        update_ops = tf.get_collection_ref(tf.GraphKeys.UPDATE_OPS)
+        num_update_ops = len(update_ops)
+        self.embeddings, _, _ = self.embed(self.inputs1, self.batch_size)
+        if self.use_history:
+            _, _, self.history_refresh = self.embed(self.inputs1, self.batch_size, history=True)
+            self.exact_outputs1 = self.embeddings
+            self.exact_outputs2, _, _ = self.embed(self.inputs2, self.batch_size)
+            self.exact_neg_outputs, _, _ = self.embed(self.neg_samples, self.neg_sample_size)
+        del update_ops[num_update_ops:]
+
+    def embed(self, inputs, batch_size, history=False):
+        """
+        Sample, aggregate and normalize: outputs, vae_outs and history writes of one set of nodes
+        """
+        samples, support_sizes, edges, links = self.sample(inputs, batch_size, depth=1 if history else None)
+        encoded, _ = self.encode_edges([(samples, support_sizes, edges, links, batch_size)])
+        outputs, vae_outs, writes = self.aggregate(samples, support_sizes, edges, batch_size, history, encoded[0], links)
+        return tf.nn.l2_normalize(outputs, 1), vae_outs, writes
+
+    def encode_edges(self, trees):
+        """
+        Run the vae encoder/decoder of every layer once per unique edge doc of the sampled trees.
+        This changes the objective of the per-hop encoding: the batch norm moments are
+        pooled over all hops and trees of a layer (weighted by multiplicity) instead of
+        taken per hop, and the duplicates of a doc share one dropout mask and one
+        posterior sample per layer, so the losses are noisier estimates, in
+        expectation those of pooled batch statistics
+        Args:
+            trees: list of (samples, support_sizes, edges, links, batch_size)
+        Returns:
+            encoded[tree][layer][hop] = (theta, z_mu0, z_var0, z_log_var0_sq), [num_pairs, num_channel]
+            reconstruction loss, each unique doc weighted by its multiplicity as in _loss_vae
+        """
+        num_layers = len(self.layer_infos)
+        encoded = [[[] for layer in range(num_layers)] for tree in trees]
+        reconstr_loss = 0
+        for layer in range(num_layers):
+            idxs = []
+            weights = []
+            slots = []
+            for t, (samples, support_sizes, edges, links, batch_size) in enumerate(trees):
+                for hop in range(min(len(edges), num_layers - layer)):
+                    idx = tf.gather_nd(self.edge_idxs, edges[hop])
+                    idxs.append(idx)
+                    # _loss_vae averages over the rows of each hop
+                    weights.append(tf.ones_like(idx, dtype=tf.float32) / tf.cast(tf.shape(samples[hop])[0], tf.float32))
+                    slots.append(t)
+            unique, inverse = tf.unique(tf.concat(idxs, 0))
+            num_unique = tf.shape(unique)[0]
+            counts = tf.unsorted_segment_sum(tf.ones_like(inverse, dtype=tf.float32), inverse, num_unique)
+            weight = tf.unsorted_segment_sum(tf.concat(weights, 0), inverse, num_unique)
+
+            word_ids = tf.nn.embedding_lookup(self.edge_words, unique)
+            word_counts = tf.nn.embedding_lookup(self.edge_counts, unique)
+            word_probs, theta, z_mu0, z_var0, z_log_var0_sq = self.vaes[layer].encode(word_ids, word_counts, counts)
+            reconstr = -tf.reduce_sum(word_counts * tf.log(word_probs + 1e-10), 1)
+            reconstr_loss += tf.reduce_sum(weight * reconstr) / self.vocab_dim
+
+            # scatter back to the sampled pairs
+            splits = tf.split(inverse, tf.stack([tf.shape(idx)[0] for idx in idxs]))
+            for t, split in zip(slots, splits):
+                encoded[t][layer].append([tf.gather(x, split) for x in [theta, z_mu0, z_var0, z_log_var0_sq]])
+        return encoded, reconstr_loss
             
     def _loss(self):
         # loss from graph reconstruction
@@ -104,20 +241,17 @@ class CGAT(object):
         reconstr_loss_neg, kl_loss_neg = self._loss_vae(self.neg_vae_outs)
         
         # total loss
-        self.reconstr_loss = reconstr_loss1 + reconstr_loss2 + reconstr_loss_neg
+        self.reconstr_loss = self.edge_reconstr_loss + reconstr_loss1 + reconstr_loss2 + reconstr_loss_neg
         self.kl_loss = kl_loss1 + kl_loss2 + kl_loss_neg
         self.loss = self.graph_loss + self.reconstr_loss + self.kl_loss
     
     def _loss_vae(self, vae_outs):
-        # out = (text_vecs, x_reconstr_mean, theta, mu1, var1, z_mu0, z_var0, z_log_var0_sq)
+        # out = (text_vecs, word_probs, theta, mu1, var1, z_mu0, z_var0, z_log_var0_sq)
         reconstr_losses = 0
         kl_losses = 0
         for vae_out in vae_outs:
-            x, x_reconstr_mean, theta, mu1, var1, z_mu0, z_var0, z_log_var0_sq = vae_out
+            text_vecs, word_probs, theta, mu1, var1, z_mu0, z_var0, z_log_var0_sq = vae_out
             topic_num = tf.cast(theta.shape[-1], dtype=tf.float32)
-            # reconstruction loss
-            x_reconstr_mean += 1e-10
-            reconstr_loss = -tf.reduce_sum(x * tf.log(x_reconstr_mean), 1)
             # KL loss
             kl_loss = 0.5 * (tf.reduce_sum(tf.div(z_var0, var1), 1)) + \
                       0.5 * (tf.reduce_sum(tf.multiply(tf.div((mu1 - z_mu0), var1), (mu1 - z_mu0)), 1)) - \
@@ -125,37 +259,81 @@ class CGAT(object):
                       0.5 * (tf.reduce_mean(tf.log(var1), 1) - tf.reduce_mean(z_log_var0_sq, 1))
                          
             # average over [batch_size, num_samples]
-            reconstr_losses += tf.reduce_mean(tf.reduce_mean(reconstr_loss))
             kl_losses += tf.reduce_mean(tf.reduce_mean(kl_loss))
+            # reconstruction loss, only observed words contribute
+            # (sum over num_samples, mean over vocabulary as the dense loss did),
+            # edges from encode_edges have it in edge_reconstr_loss
+            if word_probs is not None:
+                word_ids, word_counts = text_vecs
+                reconstr_loss = -tf.reduce_sum(word_counts * tf.log(word_probs + 1e-10), 2)
+                reconstr_losses += tf.reduce_mean(tf.reduce_sum(reconstr_loss, 1)) / self.vocab_dim
         return (reconstr_losses, kl_losses)
         
     def _accuracy(self):
-        aff = loss.affinity(self.outputs1, self.outputs2)
-        neg_aff = loss.neg_cost(self.outputs1, self.neg_outputs)
+        self.mrr = self.rank_mrr(self.outputs1, self.outputs2, self.neg_outputs)
+        if self.use_history:
+            self.exact_mrr = self.rank_mrr(self.exact_outputs1, self.exact_outputs2, self.exact_neg_outputs)
+            # 1 - cosine between history and exact embeddings of the same nodes
+            self.history_drift = 1. - tf.reduce_mean(tf.reduce_sum(self.outputs1 * self.exact_outputs1, 1))
+
+    def rank_mrr(self, outputs1, outputs2, neg_outputs):
+        aff = loss.affinity(outputs1, outputs2)
+        neg_aff = loss.neg_cost(outputs1, neg_outputs)
         neg_aff = tf.reshape(neg_aff, [self.batch_size, self.neg_sample_size])
         _aff = tf.expand_dims(aff, axis=1)
         aff_all = tf.concat(axis=1, values=[neg_aff, _aff])
         size = tf.shape(aff_all)[1]
         _, indices_of_ranks = tf.nn.top_k(aff_all, k=size)
         _, ranks = tf.nn.top_k(-indices_of_ranks, k=size)
-        self.mrr = tf.reduce_mean(tf.div(1.0, tf.cast(ranks[:, -1] + 1, tf.float32)))
+        return tf.reduce_mean(tf.div(1.0, tf.cast(ranks[:, -1] + 1, tf.float32)))
         
-    def sample(self, inputs, batch_size):
+    def sample(self, inputs, batch_size, depth=None):
         """
-        Sample neighbors to be the supportive set for convolution
+        Sample neighbors to be the supportive set for convolution,
+        depth hops (default: one per layer)
+        Returns:
+            samples, support_sizes, edges, links: per hop, None for trees, or
+            (positions of the neighbors in the next samples, importance weights)
+            for layer-wise sampling
         """
+        depth = depth or len(self.layer_infos)
         inputs = tf.cast(inputs, dtype=tf.int32)
         samples = [inputs]
         edges = []
         support_size = 1
         support_sizes = [support_size]
-        for k in range(len(self.layer_infos)):
+        # all hops in one fused op when every layer shares the sampler
+        num_samples = [self.layer_infos[len(self.layer_infos) - k - 1].num_samples for k in range(len(self.layer_infos))]
+        samplers = [layer_info.neighbor_sampler for layer_info in self.layer_infos]
+        layer_wise = [hasattr(sampler, 'sample_layers') for sampler in samplers]
+        if any(layer_wise) and not all([sampler is samplers[0] for sampler in samplers]):
+            # node sets of a layer-wise sampler are drawn jointly for all hops
+            raise ValueError('a layer-wise sampler must be shared by all layers, got {}'.format(
+                    ', '.join(['{}: {}'.format(layer_info.layer_name, type(sampler).__name__)
+                               for layer_info, sampler in zip(self.layer_infos, samplers)])))
+        if all([sampler is samplers[0] for sampler in samplers]) and hasattr(samplers[0], 'sample_layers'):
+            # one node set per hop, every node links num_samples of its neighbors in it
+            links = []
+            for k, (nodes, neighbors, positions, weights) in enumerate(samplers[0].sample_layers(inputs, num_samples[:depth])):
+                curnodes = tf.tile(tf.expand_dims(samples[k], axis=1), [1, num_samples[k]]) # [rows, num_samples]
+                edges.append(tf.reshape(tf.cast(tf.stack([curnodes, neighbors], axis=2), dtype=tf.int64), [-1, 2]))
+                samples.append(nodes)
+                support_sizes.append(None)
+                links.append((positions, weights))
+            return samples, support_sizes, edges, links
+        hops = None
+        if all([sampler is samplers[0] for sampler in samplers]) and hasattr(samplers[0], 'sample_hops'):
+            hops = samplers[0].sample_hops(inputs, num_samples[:depth])
+        for k in range(depth):
             # expanding neighbors of input nodes layer by layer backward
             # layer_info: forward, samples: backward
             t = len(self.layer_infos) - k - 1
             support_size *= self.layer_infos[t].num_samples
             sampler = self.layer_infos[t].neighbor_sampler
-            node = sampler((samples[k], self.layer_infos[t].num_samples)) # [batch_size, num_samples]
+            if hops is not None:
+                node = hops[k] # [batch_size, num_samples]
+            else:
+                node = sampler((samples[k], self.layer_infos[t].num_samples)) # [batch_size, num_samples]
             # concatenate to construct all pairs
             neighbors = tf.expand_dims(node, axis=2) # [batch_size, num_samples, 1]
             curnodes = tf.stack([samples[k] for i in range(self.layer_infos[t].num_samples)]) # [num_samples, batch_size]
@@ -166,14 +344,43 @@ class CGAT(object):
             samples.append(tf.reshape(node, [support_size * batch_size,])) # [batch_size * num_samples, ]
             support_sizes.append(support_size)
             edges.append(tf.reshape(edge, [support_size * batch_size, 2]))
-        return samples, support_sizes, edges
+        return samples, support_sizes, edges, [None] * depth
+
+    def edge_channels(self, pairs):
+        """
+        Channel distribution (theta of the first layer vae) of given node pairs
+        Args:
+            pairs: [num_pairs, 2], pairs without edge get an empty doc
+        Returns:
+            [num_pairs, num_head of layer 1]
+        """
+        pairs = tf.cast(pairs, dtype=tf.int64)
+        idxs = tf.gather_nd(self.edge_idxs, pairs)
+        word_ids = tf.expand_dims(tf.nn.embedding_lookup(self.edge_words, idxs), axis=1)
+        word_counts = tf.expand_dims(tf.nn.embedding_lookup(self.edge_counts, idxs), axis=1)
+        self_vecs = tf.nn.embedding_lookup(self.features, pairs[:, 0])
+        neighbor_vecs = tf.expand_dims(tf.nn.embedding_lookup(self.features, pairs[:, 1]), axis=1)
+        vae_out = self.vaes[0]((self_vecs, neighbor_vecs, (word_ids, word_counts)), sample=False)
+        return tf.squeeze(vae_out[2], axis=1)
+
+    def doc_channels(self, word_ids, word_counts):
+        """
+        Channel distribution of edge docs for every layer, as edge_channels: theta of
+        the vae encoder at the mean of z
+        Args:
+            word_ids, word_counts: [num_docs, doc_len], padded as edge_words/edge_counts
+        Returns:
+            list of [num_docs, num_head of layer]
+        """
+        weights = tf.ones(tf.shape(word_ids)[:1])
+        return [vae.encode(word_ids, word_counts, weights, sample=False)[1] for vae in self.vaes]
 
     def return_topic(self):
         # topic
         self.beta = []
         self.phi = []
         for layer in range(len(self.dims) - 1):
-            self.beta.append(tf.nn.softmax(tf.contrib.layers.batch_norm(self.vaes[layer].vars['decoder']['beta'])))
+            self.beta.append(self.vaes[layer].beta)
             self.phi.append(self.vaes[layer].vars['encoder']['phi'])
                 
     def init_aggregator(self):
@@ -197,57 +404,86 @@ class CGAT(object):
                 multihead_attns.append(aggregator)
             # vae
             vae = ChannelVAE(name, self.dims[layer], self.vocab_dim, self.heads[layer], 
-                             dropout=self.placeholders['vae_dropout'])
+                             dropout=self.placeholders['vae_dropout'],
+                             training=self.placeholders['is_training'])
             self.vaes.append(vae)
             self.aggregators.append(multihead_attns)
     
-    def aggregate(self, samples, support_sizes, edges, batch_size):
+    def aggregate(self, samples, support_sizes, edges, batch_size, history=False, encoded=None, links=None):
         """ Aggregate embeddings of neighbors to compute the embeddings at next layer
         Args:
-            samples: a list of node samples hops away at each layer. size=K+1
+            samples: a list of node samples hops away at each layer. size=K+1 (2 with history)
             support_sizes: a list of node numbers at each layer. size=K+1
             batch_size: input size
+            history: hidden outputs of 1-hop neighbors are read from the history tables
+                     instead of being computed from their own neighbors
+            encoded: encoder outputs of the sampled edges from encode_edges, per layer and hop
+            links: from sample, neighbors of layer-wise samples are gathered by position
+                   and their attention is corrected by importance weights
         Returns:
-            The final embedding for input nodes
+            The final embedding for input nodes, vae outputs, history writes
         """
         num_samples = [layer_info.num_samples for layer_info in self.layer_infos] # neighbor size for each node (size: K)
         hiddens = [tf.nn.embedding_lookup([self.features], node_sample) for node_sample in samples] # size: K+1
         vae_outs = []
+        writes = []
         for layer in range(len(num_samples)):
             # embedding at current layer for all support nodes hops away
             next_hiddens = []
-            for hop in range(len(num_samples) - layer):
-                # construct edge docs
-                idxs = tf.gather_nd(self.edge_idxs, edges[hop])
-                docs = tf.nn.embedding_lookup(self.edge_vecs, idxs)
-                # reshape docs: [batch_size, num_samples, vocab_dim]
-                doc_dims = [batch_size * support_sizes[hop], 
-                                     num_samples[len(num_samples) - hop - 1],
-                                     self.vocab_dim]
-                
+            num_hops = len(num_samples) - layer
+            if history:
+                num_hops = min(num_hops, 2)
+            for hop in range(num_hops):
+                if history and hop > 0:
+                    # stale outputs of out-of-batch neighbors
+                    next_hiddens.append(tf.nn.embedding_lookup(self.histories[layer], samples[hop]))
+                    continue
                 # reshape neighbor info: [batch_size, num_samples, embed_dim]
-                neighbor_dims = [batch_size * support_sizes[hop], 
+                neighbor_dims = [tf.shape(samples[hop])[0], 
                                      num_samples[len(num_samples) - hop - 1],
                                      self.dims[layer]]
+                if links is None or links[hop] is None:
+                    neighbor_vecs = tf.reshape(hiddens[hop+1], neighbor_dims)
+                    weights = None
+                else:
+                    positions, weights = links[hop]
+                    neighbor_vecs = tf.gather(hiddens[hop+1], positions)
                 
                 # go through vae first
-                inputs1 = (hiddens[hop], tf.reshape(hiddens[hop+1], neighbor_dims),
-                          tf.reshape(docs, doc_dims))
-                # out = (text_vecs, x_reconstr_mean, theta, mu1, var1, z_mu0, z_var0, z_log_var0_sq)
-                vae_out = self.vaes[layer](inputs1)
+                # out = (text_vecs, word_probs, theta, mu1, var1, z_mu0, z_var0, z_log_var0_sq)
+                if encoded is not None:
+                    # encoder outputs were computed once per unique edge, only the prior is per pair
+                    mu1, var1 = self.vaes[layer].prior(hiddens[hop], neighbor_vecs)
+                    channel_dims = neighbor_dims[:2] + [self.heads[layer]]
+                    theta, z_mu0, z_var0, z_log_var0_sq = [tf.reshape(x, channel_dims) for x in encoded[layer][hop]]
+                    vae_out = (None, None, theta, mu1, var1, z_mu0, z_var0, z_log_var0_sq)
+                else:
+                    # construct edge docs
+                    idxs = tf.gather_nd(self.edge_idxs, edges[hop])
+                    word_ids = tf.nn.embedding_lookup(self.edge_words, idxs)
+                    word_counts = tf.nn.embedding_lookup(self.edge_counts, idxs)
+                    # reshape docs: [batch_size, num_samples, doc_len]
+                    doc_dims = neighbor_dims[:2] + [self.doc_len]
+                    inputs1 = (hiddens[hop], neighbor_vecs,
+                              (tf.reshape(word_ids, doc_dims), tf.reshape(word_counts, doc_dims)))
+                    vae_out = self.vaes[layer](inputs1)
                 vae_outs.append(vae_out)
                 channel_vecs = vae_out[2]
                 
                 # go through ChannelGAT 
                 attns = []
                 for head in range(self.heads[layer]):
-                    inputs2 = (hiddens[hop], tf.reshape(hiddens[hop+1], neighbor_dims),
-                           tf.slice(channel_vecs, [0,0,head], [-1,-1,1]))
+                    inputs2 = (hiddens[hop], neighbor_vecs,
+                           tf.slice(channel_vecs, [0,0,head], [-1,-1,1]), weights)
                     h = self.aggregators[layer][head](inputs2)
                     attns.append(h)
                 next_hiddens.append(tf.add_n(attns) / self.heads[layer])
-                
+            
+            if history and layer < len(num_samples) - 1:
+                # in-batch nodes write back their fresh outputs
+                writes.append(tf.scatter_update(self.histories[layer], samples[0],
+                                                tf.stop_gradient(next_hiddens[0])))
             hiddens = next_hiddens
         
-        return (hiddens[0], vae_outs)
+        return (hiddens[0], vae_outs, writes)
     
\ No newline at end of file
@@ -0,0 +1,246 @@
+import os
+import time
+import queue
+import resource
+import traceback
+import pickle as pkl
+import multiprocessing as mp
+import numpy as np
+
+
+class SharedArray(object):
+    """
+    float32 array in shared memory, visible to forked workers without copy
+    """
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.raw = mp.RawArray('f', int(np.prod(self.shape)))
+
+    def array(self):
+        return np.frombuffer(self.raw, dtype=np.float32).reshape(self.shape)
+
+
+class AllReduce(object):
+    """
+    Local all-reduce stand-in: every worker writes its flattened gradient
+    into its own slot of a shared buffer, and after a barrier all workers
+    read the same mean gradient. A worker that fails aborts the barrier, and
+    a barrier that is not reached within timeout seconds breaks, so that the
+    other workers raise BrokenBarrierError instead of waiting forever
+    """
+    def __init__(self, num_workers, size, timeout=None):
+        self.grads = SharedArray((num_workers, size))
+        self.params = SharedArray((size,))
+        self.barrier = mp.get_context('fork').Barrier(num_workers, timeout=timeout)
+
+    def mean(self, rank, grad):
+        grads = self.grads.array()
+        grads[rank] = grad
+        self.barrier.wait()
+        mean = grads.mean(axis=0)
+        # no worker overwrites its slot before everyone has read
+        self.barrier.wait()
+        return mean
+
+    def broadcast(self, rank, params):
+        """
+        Values of worker 0 to every worker
+        """
+        if rank == 0:
+            self.params.array()[:] = params
+        self.barrier.wait()
+        params = self.params.array().copy()
+        self.barrier.wait()
+        return params
+
+
+def quiet_tensorflow():
+    import tensorflow as tf
+    from tensorflow.python.util import deprecation
+    deprecation._PRINT_DEPRECATION_WARNINGS = False
+    return tf
+
+def count_params(args, feature_dim, vocab_dim, conn):
+    """
+    Number of trained parameters, from a throwaway graph with empty tables
+    (parameter shapes do not depend on the graph size)
+    """
+    tf = quiet_tensorflow()
+    from src.minibatch import NeighborSampler
+    from src.model import CGAT
+    from run_unsupervised import construct_placeholders, construct_layers
+
+    with tf.Graph().as_default():
+        placeholders = construct_placeholders()
+        sampler = NeighborSampler(tf.zeros((1, args.max_degree), dtype=tf.int32))
+        model = CGAT(placeholders, np.zeros((1, feature_dim)), vocab_dim,
+                     tf.zeros((1, 1), dtype=tf.int32), tf.zeros((1, 1), dtype=tf.int32), tf.zeros((1, 1)),
+                     construct_layers(sampler, args),
+                     args.neg_sample, args.learning_rate, args.weight_decay)
+        conn.send(int(np.sum([np.prod(v.get_shape().as_list()) for _, v in model.grads_and_vars])))
+
+def param_size(args, feature_dim, vocab_dim):
+    """
+    Number of trained parameters, counted in a child process: tensorflow is
+    never started in the parent, whose forked workers would inherit its threads
+    """
+    ctx = mp.get_context('fork')
+    recv, send = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=count_params, args=(args, feature_dim, vocab_dim, send))
+    process.start()
+    # only the child holds the sending end, recv fails if it dies
+    send.close()
+    try:
+        size = recv.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError('counting parameters failed with exit code {}'.format(process.exitcode))
+    process.join()
+    return size
+
+
+class DataParallelTrainer(object):
+    """
+    Synchronous data-parallel training on one host: num_workers processes,
+    each with its own session and its own shard of walk pairs, average
+    their gradients through AllReduce before every update
+    """
+    def __init__(self, args, num_workers, data_fn, feature_dim, vocab_dim, timeout=600.):
+        """
+        Args:
+            data_fn: rank -> data_trn of that worker, (G, features, walks, edgetexts, vocab_dim),
+                     called inside the worker process
+            timeout: seconds a worker waits for the others at a synchronization point
+        """
+        self.args = args
+        self.num_workers = num_workers
+        self.data_fn = data_fn
+        self.feature_dim = feature_dim
+        self.vocab_dim = vocab_dim
+        self.timeout = timeout
+
+    def run(self, steps, save=False):
+        """
+        Run steps synchronous updates on every worker
+        Returns:
+            dict of throughput (pairs/sec) and final loss/mrr of worker 0
+        Raises:
+            RuntimeError when a worker fails or dies, after stopping the others
+        """
+        self.allreduce = AllReduce(self.num_workers, param_size(self.args, self.feature_dim, self.vocab_dim),
+                                   self.timeout)
+
+        ctx = mp.get_context('fork')
+        results = ctx.Queue()
+        workers = [ctx.Process(target=self.worker, args=(rank, steps, save, results))
+                   for rank in range(self.num_workers)]
+        for w in workers:
+            w.start()
+        outs = []
+        error = None
+        while len(outs) < self.num_workers and error is None:
+            try:
+                out = results.get(timeout=1.)
+            except queue.Empty:
+                dead = [rank for rank, w in enumerate(workers) if w.exitcode not in (None, 0)]
+                if len(dead) > 0:
+                    error = 'worker {} died with exit code {}'.format(dead[0], workers[dead[0]].exitcode)
+                continue
+            if 'error' in out:
+                error = 'worker {} failed:\n{}'.format(out['rank'], out['error'])
+            outs.append(out)
+        if error is not None:
+            self.allreduce.barrier.abort()
+            for w in workers:
+                w.terminate()
+            for w in workers:
+                w.join()
+            raise RuntimeError(error)
+        outs = sorted(outs, key=lambda x: x['rank'])
+        for w in workers:
+            w.join()
+        elapsed = max([o['time'] for o in outs])
+        return {'workers': self.num_workers,
+                'steps': steps,
+                'time': elapsed,
+                'pairs_per_sec': self.num_workers * steps * self.args.batch_size / elapsed,
+                'loss': outs[0]['loss'],
+                'mrr': outs[0]['mrr'],
+                'peak_rss': max([o['peak_rss'] for o in outs])}
+
+    def worker(self, rank, steps, save, results):
+        try:
+            self.train_worker(rank, steps, save, results)
+        except Exception:
+            # release the workers waiting at the barrier, report to the parent
+            self.allreduce.barrier.abort()
+            results.put({'rank': rank, 'error': traceback.format_exc()})
+            raise
+
+    def train_worker(self, rank, steps, save, results):
+        tf = quiet_tensorflow()
+        from run_unsupervised import build_model, refresh_history
+
+        # split the cores between workers
+        threads = max(1, mp.cpu_count() // self.num_workers)
+        config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                inter_op_parallelism_threads=threads)
+        placeholders, minibatch, model, sess = build_model(self.data_fn(rank), self.args, config)
+
+        grads = [tf.convert_to_tensor(g) for g, _ in model.grads_and_vars]
+        variables = [v for _, v in model.grads_and_vars]
+        shapes = [v.get_shape().as_list() for v in variables]
+        grad_phs = [tf.placeholder(tf.float32, shape=shape) for shape in shapes]
+        value_phs = [tf.placeholder(tf.float32, shape=shape) for shape in shapes]
+        apply_op = model.optimizer.apply_gradients(zip(grad_phs, variables), global_step=model.global_step)
+        assign_op = [tf.assign(v, ph) for v, ph in zip(variables, value_phs)]
+        sess.run(tf.variables_initializer(model.optimizer.variables()))
+
+        # every worker starts from the parameters of worker 0
+        values = self.allreduce.broadcast(rank, self.flatten(sess.run(variables)))
+        sess.run(assign_op, feed_dict=self.unflatten(values, value_phs, shapes))
+
+        history = getattr(self.args, 'history', False)
+        t = time.time()
+        for step in range(steps):
+            # every worker keeps its own history cache
+            if history and (step == 0 or (self.args.history_refresh > 0 and step % self.args.history_refresh == 0)):
+                refresh_history(placeholders, minibatch, model, sess, self.args.batch_size)
+            # every worker runs the same number of steps, restart the shard when it ends
+            if minibatch.end_edge():
+                minibatch.shuffle()
+            feed_dict, _ = minibatch.next_edgebatch_feed_dict()
+            feed_dict.update({placeholders['dropout']: self.args.dropout})
+            feed_dict.update({placeholders['ffd_dropout']: self.args.ffd_dropout})
+            feed_dict.update({placeholders['attn_dropout']: self.args.attn_dropout})
+            feed_dict.update({placeholders['vae_dropout']: self.args.vae_dropout})
+            outs = sess.run([model.loss, model.mrr, grads, model.update_ops], feed_dict=feed_dict)
+            grad = self.allreduce.mean(rank, self.flatten(outs[2]))
+            sess.run(apply_op, feed_dict=self.unflatten(grad, grad_phs, shapes))
+            if rank == 0 and step % 100 == 0:
+                print ('-- step: ', '{:4d}'.format(step),
+                       'train_loss=', '{:.5f}'.format(outs[0]),
+                       'train_mrr=', '{:.5f}'.format(outs[1]),
+                       'time so far=', '{:.5f}'.format((time.time() - t)/60))
+        elapsed = time.time() - t
+
+        if save and rank == 0:
+            if not os.path.exists(self.args.embed_dir):
+                os.makedirs(self.args.embed_dir)
+            with open('{}/args.bin'.format(self.args.embed_dir), 'wb') as f:
+                pkl.dump(vars(self.args), f)
+            tf.train.Saver().save(sess, '{}/model.ckpt'.format(self.args.embed_dir), global_step=steps)
+        results.put({'rank': rank, 'time': elapsed, 'loss': float(outs[0]), 'mrr': float(outs[1]),
+                     'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024})
+
+    def flatten(self, values):
+        return np.concatenate([np.ravel(v) for v in values])
+
+    def unflatten(self, flat, phs, shapes):
+        feed_dict = {}
+        start = 0
+        for ph, shape in zip(phs, shapes):
+            size = int(np.prod(shape))
+            feed_dict[ph] = flat[start : start + size].reshape(shape)
+            start += size
+        return feed_dict
@@ -0,0 +1,288 @@
+import os
+import resource
+import threading
+import pickle as pkl
+from collections import deque, OrderedDict
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import networkx as nx
+
+from src.data_loader import WalkStream, artifact_keys
+
+AUTHKEY = b'cgat-partition'
+
+
+def partition_graph(adj, k, seed=0, n_iter=5, imbalance=0.05):
+    """
+    Locality-preserving balanced k-way partition: the BFS order from random roots
+    is cut into k equal blocks, then refined by size-constrained label propagation
+    Args:
+        adj: dict, k=node_idx (0..n-1), v=[neighbors_idx]
+    Returns:
+        parts: [n], partition of each node
+    """
+    n = len(adj)
+    rand = np.random.RandomState(seed)
+    order = []
+    seen = np.zeros(n, dtype=bool)
+    for root in rand.permutation(n):
+        if seen[root]:
+            continue
+        seen[root] = True
+        queue = deque([root])
+        while queue:
+            u = queue.popleft()
+            order.append(u)
+            for v in adj[u]:
+                if not seen[v]:
+                    seen[v] = True
+                    queue.append(v)
+    parts = np.zeros(n, dtype=np.int32)
+    parts[np.array(order, dtype=np.int64)] = np.arange(n) * k // n
+
+    # move nodes to the partition most of their neighbors are in, without overfilling it
+    capacity = int((1 + imbalance) * n / k) + 1
+    sizes = np.bincount(parts, minlength=k)
+    for i in range(n_iter):
+        moved = 0
+        for u in rand.permutation(n):
+            if len(adj[u]) == 0:
+                continue
+            counts = np.bincount(parts[adj[u]], minlength=k)
+            best = np.argmax(counts)
+            if counts[best] > counts[parts[u]] and sizes[best] < capacity:
+                sizes[parts[u]] -= 1
+                sizes[best] += 1
+                parts[u] = best
+                moved += 1
+        print ('-- label propagation iter {}: moved {} nodes, edge cut={:.4f}'.format(i, moved, edge_cut(adj, parts)))
+        if moved == 0:
+            break
+    return parts
+
+def edge_cut(adj, parts):
+    cut = 0
+    total = 0
+    for u, nbrs in adj.items():
+        cut += np.count_nonzero(parts[nbrs] != parts[u])
+        total += len(nbrs)
+    return cut / max(total, 1)
+
+
+class PartitionStore(object):
+    """
+    Tables owned by one partition: adjacency, feature rows and edge docs (u, v) of its
+    nodes u, and the walk pairs rooted in them (None: walks are streamed).
+    Every partition is saved to its own file, so a process only loads its part
+    """
+    def __init__(self, part, tables, walks=None):
+        self.part = part
+        self.tables = tables
+        self.walks = walks
+
+    @staticmethod
+    def split(part, parts, adj, features, edge_text, walks=None):
+        nodes = np.where(parts == part)[0].tolist()
+        tables = {'adj': {u: adj[u] for u in nodes},
+                  'features': {u: features[u] for u in nodes},
+                  'docs': {(u, v): edge_text[(u, v)] for u in nodes for v in adj[u] if (u, v) in edge_text}}
+        return PartitionStore(part, tables, walks)
+
+    def get(self, table, keys):
+        # None for missing rows (e.g. edges without doc)
+        return [self.tables[table].get(k) for k in keys]
+
+    def save(self, dirname):
+        with open(os.path.join(dirname, 'part_{}.bin'.format(self.part)), 'wb') as f:
+            pkl.dump((self.tables, self.walks), f, protocol=4)
+
+    @staticmethod
+    def load(dirname, part):
+        with open(os.path.join(dirname, 'part_{}.bin'.format(part)), 'rb') as f:
+            tables, walks = pkl.load(f)
+        return PartitionStore(part, tables, walks)
+
+
+def partition_key(cache, seed, k, stream_walks):
+    """
+    Key of the partition stores of k parts, from the artifact keys of the
+    data they are split from (see data_loader.artifact_keys)
+    """
+    keys = artifact_keys(cache, seed)
+    if stream_walks:
+        keys.pop('walk')
+    return cache.key([], dict(keys, parts=k, stream_walks=stream_walks))
+
+def save_partitions(loader, k, dirname):
+    """
+    Partition the training graph of loader into k parts and save the store of
+    every part, with the partition of every node and the table dims in meta.bin
+    Returns:
+        meta dict: parts, feature_dim, vocab_dim, seed, stream_walks, key (partition_key)
+    """
+    adj = nx.to_dict_of_lists(loader.G_trn)
+    print ('===== partition graph into {} parts ====='.format(k))
+    parts = partition_graph(adj, k)
+    print ('partition sizes: {}'.format(np.bincount(parts, minlength=k).tolist()))
+    walks = None
+    if not isinstance(loader.walks, WalkStream):
+        walks = np.array(loader.walks, dtype=np.int64).reshape(-1, 2)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    for part in range(k):
+        part_walks = None if walks is None else walks[parts[walks[:, 0]] == part]
+        PartitionStore.split(part, parts, adj, loader.features, loader.edge_text, part_walks).save(dirname)
+    meta = {'parts': parts, 'feature_dim': loader.features.shape[1], 'vocab_dim': len(loader.vocab),
+            'seed': loader.seed, 'stream_walks': walks is None,
+            'key': partition_key(loader.cache, loader.seed, k, walks is None)}
+    with open(os.path.join(dirname, 'meta.bin'), 'wb') as f:
+        pkl.dump(meta, f, protocol=4)
+    return meta
+
+def load_meta(dirname):
+    with open(os.path.join(dirname, 'meta.bin'), 'rb') as f:
+        return pkl.load(f)
+
+
+def serve_partition(dirname, part, addresses):
+    """
+    Local RPC stand-in: loads the PartitionStore of part and answers (table, keys) requests
+    """
+    store = PartitionStore.load(dirname, part)
+    listener = Listener(('localhost', 0), authkey=AUTHKEY)
+    addresses.put((store.part, listener.address))
+
+    def handle(conn):
+        try:
+            while True:
+                table, keys = conn.recv()
+                conn.send(store.get(table, keys))
+        except EOFError:
+            conn.close()
+
+    while True:
+        conn = listener.accept()
+        thread = threading.Thread(target=handle, args=(conn,))
+        thread.daemon = True
+        thread.start()
+
+
+class HaloClient(object):
+    """
+    Fetches rows owned by other partitions, with a bounded LRU halo cache per table
+    """
+    def __init__(self, part, parts, addresses, cache_size=1000000):
+        self.part = part
+        self.parts = parts
+        self.conns = {p: Client(address, authkey=AUTHKEY) for p, address in addresses.items() if p != part}
+        self.cache_size = cache_size
+        self.cache = {'adj': OrderedDict(), 'features': OrderedDict(), 'docs': OrderedDict()}
+        self.hits = 0
+        self.misses = 0
+
+    def owner(self, key):
+        return self.parts[key[0] if isinstance(key, tuple) else key]
+
+    def fetch(self, table, keys):
+        cache = self.cache[table]
+        values = {}
+        groups = {}
+        pending = set()
+        for k in keys:
+            if k in values or k in pending:
+                continue
+            if k in cache:
+                cache.move_to_end(k)
+                values[k] = cache[k]
+                self.hits += 1
+            else:
+                # every uncached key is requested once
+                pending.add(k)
+                groups.setdefault(self.owner(k), []).append(k)
+                self.misses += 1
+        # one batched request per owner
+        for owner, ks in groups.items():
+            self.conns[owner].send((table, ks))
+            for k, v in zip(ks, self.conns[owner].recv()):
+                values[k] = v
+                cache[k] = v
+                if len(cache) > self.cache_size:
+                    cache.popitem(last=False)
+        return [values[k] for k in keys]
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+def build_local_data(store, client, vocab_dim, hops=2, seed=0):
+    """
+    Training data of one partition: owned nodes plus their halo up to hops away,
+    relabeled to local idx. Halo rows come from their owners through client,
+    and halo nodes at the last hop only keep their links back into the local set
+    Args:
+        seed: seed of the walk stream, when store.walks is None
+    Returns:
+        (data_trn, nodes), nodes[local_idx] = global idx
+    """
+    adj = dict(store.tables['adj'])
+    owned = set(adj.keys())
+    frontier = set(v for u in owned for v in adj[u]) - owned
+    halo = set()
+    for hop in range(hops):
+        halo |= frontier
+        if hop == hops - 1:
+            break
+        expand = sorted(frontier)
+        adj.update(zip(expand, client.fetch('adj', expand)))
+        frontier = set(v for u in expand for v in adj[u]) - owned - halo
+    nodes = sorted(owned) + sorted(halo)
+    local = {u: i for i, u in enumerate(nodes)}
+
+    G = nx.Graph()
+    G.add_nodes_from(range(len(nodes)))
+    G.add_edges_from([(local[u], local[v]) for u, nbrs in adj.items() for v in nbrs])
+
+    remote = sorted(halo)
+    rows = store.get('features', sorted(owned)) + client.fetch('features', remote)
+    features = np.array(rows)
+
+    # docs of every local edge, in both directions
+    pairs = [(u, v) for u, nbrs in adj.items() for v in nbrs]
+    local_pairs = [p for p in pairs if p[0] in owned]
+    remote_pairs = [p for p in pairs if p[0] not in owned]
+    docs = store.get('docs', local_pairs) + client.fetch('docs', remote_pairs)
+    edgetexts = {}
+    for (u, v), doc in zip(local_pairs + remote_pairs, docs):
+        if doc is None:
+            continue
+        edgetexts[(local[u], local[v])] = doc
+        edgetexts[(local[v], local[u])] = doc
+
+    # walks rooted in the partition (owned nodes come first in local idx)
+    if store.walks is None:
+        local_walks = WalkStream(G, range(len(owned)), seed)
+    else:
+        local_walks = [(local[u], local[v]) for u, v in store.walks if v in local]
+
+    print ('partition {}: {} owned + {} halo nodes, {} edges, {} walks, halo cache hit rate={:.3f}'.format(
+            store.part, len(owned), len(halo), G.number_of_edges(), len(local_walks), client.hit_rate()))
+    return (G, features, local_walks, edgetexts, vocab_dim), np.array(nodes)
+
+def table_bytes(data_trn, max_degree):
+    """
+    Memory of the tables a worker holds for data_trn (as built by EdgeBatch)
+    """
+    (G, features, walks, edgetexts, vocab_dim) = data_trn
+    n = G.number_of_nodes()
+    doc_len = max([len(doc) for doc in edgetexts.values()]) if len(edgetexts) > 0 else 0
+    return {'features': features.nbytes,
+            'adj': n * max_degree * 4,
+            'edge_idx': n * n * 4,
+            'edge_docs': (len(edgetexts) + 1) * doc_len * 8,
+            'walks': len(walks) * 16}
+
+def peak_rss():
+    """
+    Peak resident memory of this process in bytes (Linux reports KB)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,159 @@
+import numpy as np
+import pickle as pkl
+
+from src.retrieval import kmeans, nearest
+
+
+def quantize_int8(x):
+    """
+    Symmetric int8 quantization with one scale per row: x ~ codes * scale
+    Returns:
+        codes [n, dim] int8, scale [n] float32
+    """
+    x = np.asarray(x, dtype=np.float32)
+    scale = np.abs(x).max(axis=1) / 127.
+    scale[scale == 0] = 1.
+    codes = np.clip(np.rint(x / scale[:, np.newaxis]), -127, 127).astype(np.int8)
+    return codes, scale.astype(np.float32)
+
+def dequantize_int8(codes, scale):
+    return codes.astype(np.float32) * scale[:, np.newaxis]
+
+
+class ScalarQuantizer(object):
+    """
+    int8 embedding store, 1 byte per dimension plus a float32 scale per vector.
+    Scores are computed on the int8 codes and rescaled, without decoding the store
+    """
+    def build(self, vecs, ids):
+        self.codes, self.scale = quantize_int8(vecs)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        print ('===== int8 store: {} vectors, {} bytes each ====='.format(len(self.ids), self.codes.shape[1] + 4))
+        return self
+
+    def decode(self, rows=None):
+        rows = np.arange(len(self.ids)) if rows is None else rows
+        return dequantize_int8(self.codes[rows], self.scale[rows])
+
+    def scores(self, queries, chunk=65536):
+        """
+        Inner products of float queries with every stored vector: [num_queries, n]
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        scores = np.zeros((len(queries), len(self.ids)), dtype=np.float32)
+        for start in range(0, len(self.ids), chunk):
+            codes = self.codes[start : start + chunk].astype(np.float32)
+            scores[:, start : start + chunk] = queries.dot(codes.T) * self.scale[start : start + chunk]
+        return scores
+
+    def nbytes(self):
+        # codes and scales, without the ids
+        return self.codes.nbytes + self.scale.nbytes
+
+    def pair_scores(self, rows1, rows2):
+        """
+        Inner products of stored vectors rows1[i], rows2[i], in int32 arithmetic
+        """
+        dots = np.einsum('ij,ij->i', self.codes[rows1].astype(np.int32), self.codes[rows2].astype(np.int32))
+        return dots * self.scale[rows1] * self.scale[rows2]
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pkl.dump({'codes': self.codes, 'scale': self.scale, 'ids': self.ids}, f, protocol=4)
+
+    @staticmethod
+    def load(filename):
+        store = ScalarQuantizer()
+        with open(filename, 'rb') as f:
+            store.__dict__.update(pkl.load(f))
+        return store
+
+
+class ProductQuantizer(object):
+    """
+    Product quantization: the dims are split into num_sub subspaces, each one
+    quantized to one of num_codes k-means centroids, 1 byte per subspace.
+    Queries are scored by table lookups (asymmetric distance computation)
+    """
+    def __init__(self, num_sub=8, num_codes=256, n_iter=20, seed=0):
+        if not 1 <= num_codes <= 256:
+            raise ValueError('num_codes must be in [1, 256] to fit uint8 codes, got {}'.format(num_codes))
+        self.num_sub = num_sub
+        self.num_codes = num_codes
+        self.n_iter = n_iter
+        self.seed = seed
+
+    def build(self, vecs, ids, train_size=100000):
+        vecs = np.asarray(vecs, dtype=np.float32)
+        dim = vecs.shape[1]
+        if dim % self.num_sub != 0:
+            raise ValueError('embedding dim {} is not divisible into {} subspaces'.format(dim, self.num_sub))
+        self.sub_dim = dim // self.num_sub
+        train = vecs[np.random.RandomState(self.seed).permutation(len(vecs))[:train_size]]
+        # codebooks [num_sub, num_codes, sub_dim]
+        self.codebooks = np.zeros((self.num_sub, min(self.num_codes, len(train)), self.sub_dim), dtype=np.float32)
+        self.codes = np.zeros((len(vecs), self.num_sub), dtype=np.uint8)
+        for m in range(self.num_sub):
+            sub = slice(m * self.sub_dim, (m + 1) * self.sub_dim)
+            self.codebooks[m], _ = kmeans(train[:, sub], self.num_codes, self.n_iter, self.seed + m)
+            self.codes[:, m] = nearest(vecs[:, sub], self.codebooks[m])
+        self.ids = np.asarray(ids, dtype=np.int64)
+        print ('===== pq store: {} vectors, {} bytes each, codebooks {} KB ====='.format(
+                len(self.ids), self.num_sub, self.codebooks.nbytes // 1024))
+        return self
+
+    def decode(self, rows=None):
+        codes = self.codes if rows is None else self.codes[rows]
+        # codebooks[m, codes[:, m]] for all m at once: [n, num_sub, sub_dim]
+        return self.codebooks[np.arange(self.num_sub), codes].reshape(len(codes), -1)
+
+    def tables(self, queries):
+        """
+        Inner products of every query subvector with every centroid: [num_queries, num_sub, num_codes]
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(len(queries), self.num_sub, self.sub_dim)
+        return np.einsum('qmd,mkd->qmk', queries, self.codebooks)
+
+    def scores(self, queries):
+        """
+        Inner products of float queries with every stored vector: [num_queries, n]
+        """
+        tables = self.tables(queries)
+        scores = np.zeros((len(queries), len(self.ids)), dtype=np.float32)
+        for m in range(self.num_sub):
+            scores += tables[:, m, self.codes[:, m]]
+        return scores
+
+    def nbytes(self):
+        # codes and codebooks, without the ids
+        return self.codes.nbytes + self.codebooks.nbytes
+
+    def pair_scores(self, rows1, rows2):
+        return np.einsum('ij,ij->i', self.decode(rows1), self.decode(rows2))
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pkl.dump(self.__dict__, f, protocol=4)
+
+    @staticmethod
+    def load(filename):
+        store = ProductQuantizer()
+        with open(filename, 'rb') as f:
+            store.__dict__.update(pkl.load(f))
+        return store
+
+
+def link_mrr(pair_scores, edges, negatives):
+    """
+    MRR of held-out edges: the true neighbor is ranked against the same
+    negatives for every store, ties count against it
+    Args:
+        pair_scores: function (rows1, rows2) -> scores
+        edges: [num_edges, 2] store rows
+        negatives: [num_edges, num_neg] store rows
+    """
+    num_neg = negatives.shape[1]
+    pos = pair_scores(edges[:, 0], edges[:, 1])
+    neg = pair_scores(np.repeat(edges[:, 0], num_neg), negatives.reshape(-1)).reshape(-1, num_neg)
+    ranks = 1 + (neg >= pos[:, np.newaxis]).sum(axis=1)
+    return float(np.mean(1. / ranks))
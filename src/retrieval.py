@@ -0,0 +1,143 @@
+import numpy as np
+import pickle as pkl
+
+
+def l2_normalize(x):
+    norm = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norm, 1e-12)
+
+def nearest(x, centroids, chunk=65536):
+    """
+    Index of the nearest centroid for each row of x, computed in chunks
+    """
+    c_norm = (centroids ** 2).sum(axis=1)
+    assign = np.zeros(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk):
+        dist = c_norm[np.newaxis, :] - 2 * x[start : start + chunk].dot(centroids.T)
+        assign[start : start + chunk] = np.argmin(dist, axis=1)
+    return assign
+
+def kmeans(x, k, n_iter=20, seed=0):
+    """
+    Lloyd's k-means, empty clusters are re-seeded with random points
+    Returns:
+        centroids [k, dim], assignment [n]
+    """
+    rand = np.random.RandomState(seed)
+    k = min(k, len(x))
+    centroids = x[rand.choice(len(x), k, replace=False)].astype(np.float32)
+    for i in range(n_iter):
+        assign = nearest(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, np.newaxis]
+        centroids[empty] = x[rand.choice(len(x), empty.sum())]
+    return centroids, nearest(x, centroids)
+
+def topk(scores, k):
+    """
+    Row-wise top-k of a score matrix, sorted by decreasing score
+    """
+    k = min(k, scores.shape[1])
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1)
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+def exact_search(vecs, ids, queries, k, chunk=1024):
+    """
+    Brute-force top-k by inner product
+    Returns:
+        ids [num_queries, k], scores [num_queries, k]
+    """
+    res_ids = []
+    res_scores = []
+    for start in range(0, len(queries), chunk):
+        idx, scores = topk(queries[start : start + chunk].dot(vecs.T), k)
+        res_ids.append(ids[idx])
+        res_scores.append(scores)
+    return np.concatenate(res_ids), np.concatenate(res_scores)
+
+
+class IVFIndex(object):
+    """
+    Inverted-file index for top-k inner product search over L2-normalized vectors:
+    vectors are bucketed by their nearest k-means centroid, and a query only
+    scores the vectors in its nprobe closest buckets
+    """
+    def __init__(self, nlist=100, nprobe=8, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.seed = seed
+
+    def build(self, vecs, ids):
+        vecs = l2_normalize(np.asarray(vecs, dtype=np.float32))
+        centroids, assign = kmeans(vecs, self.nlist, seed=self.seed)
+        self.nlist = len(centroids)
+        self.centroids = centroids
+        # vectors of one bucket are contiguous: bucket i is [offsets[i], offsets[i+1])
+        order = np.argsort(assign, kind='stable')
+        self.vecs = vecs[order]
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=self.nlist))))
+        print ('===== ivf index: {} vectors, {} lists ====='.format(len(self.ids), self.nlist))
+        return self
+
+    def search(self, queries, k, nprobe=None):
+        """
+        Queries are grouped by probed list: each list is scored against all of its
+        queries with one matmul and top-k, then the nprobe * k candidates of every
+        query are merged with one top-k
+        Returns:
+            ids [num_queries, k], scores [num_queries, k], padded with -1/-inf
+        """
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        queries = l2_normalize(np.asarray(queries, dtype=np.float32))
+        probes, _ = topk(queries.dot(self.centroids.T), nprobe)
+        # candidate rows of self.vecs and their scores: [num_queries, nprobe, k]
+        cand_rows = -np.ones((len(queries), nprobe, k), dtype=np.int64)
+        cand_scores = -np.inf * np.ones((len(queries), nprobe, k), dtype=np.float32)
+        # (query, probe slot) entries sorted by list: list p is [bounds[p], bounds[p+1])
+        flat = probes.reshape(-1)
+        order = np.argsort(flat, kind='stable')
+        bounds = np.searchsorted(flat[order], np.arange(self.nlist + 1))
+        for p in range(self.nlist):
+            start, end = self.offsets[p], self.offsets[p + 1]
+            if bounds[p] == bounds[p + 1] or start == end:
+                continue
+            q, slot = np.divmod(order[bounds[p] : bounds[p + 1]], nprobe)
+            idx, scores = topk(queries[q].dot(self.vecs[start : end].T), k)
+            cand_rows[q, slot, :idx.shape[1]] = start + idx
+            cand_scores[q, slot, :idx.shape[1]] = scores
+        idx, res_scores = topk(cand_scores.reshape(len(queries), -1), k)
+        rows = np.take_along_axis(cand_rows.reshape(len(queries), -1), idx, axis=1)
+        res_ids = np.where(rows >= 0, self.ids[rows], -1)
+        return res_ids, res_scores
+
+    def recall(self, queries, k, nprobe=None):
+        """
+        Fraction of the exact top-k found by the index
+        """
+        approx, _ = self.search(queries, k, nprobe)
+        exact, _ = exact_search(self.vecs, self.ids, l2_normalize(np.asarray(queries, dtype=np.float32)), k)
+        hits = [len(set(a) & set(e)) for a, e in zip(approx, exact)]
+        return np.sum(hits) / float(exact.size)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pkl.dump({'nlist': self.nlist, 'nprobe': self.nprobe, 'seed': self.seed,
+                      'centroids': self.centroids, 'vecs': self.vecs,
+                      'ids': self.ids, 'offsets': self.offsets}, f)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as f:
+            state = pkl.load(f)
+        index = IVFIndex(state['nlist'], state['nprobe'], state['seed'])
+        index.centroids = state['centroids']
+        index.vecs = state['vecs']
+        index.ids = state['ids']
+        index.offsets = state['offsets']
+        return index
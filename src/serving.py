@@ -0,0 +1,401 @@
+import sys
+import json
+import time
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import numpy as np
+import tensorflow as tf
+
+
+class Request(object):
+    def __init__(self, kind, items):
+        self.kind = kind      # 'embed': node idx; 'channels': (u, v) pairs
+        self.items = items
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ColdStart(object):
+    """
+    Splices new nodes and edges into the tables of a serving session in place:
+    feature rows, sampled neighbor rows, edge_idx entries and edge docs of the
+    affected nodes are scattered into the reserved rows of EdgeBatch tables,
+    so that the inductive model embeds them without retraining
+    """
+    def __init__(self, sess, model, minibatch, loader):
+        self.sess = sess
+        self.minibatch = minibatch
+        self.loader = loader
+        self.lock = threading.Lock()
+
+        sampler = model.layer_infos[0].neighbor_sampler
+        adj_info = sampler.adj_info
+        doc_len = minibatch.edge_words.shape[1]
+        self.nodes = tf.placeholder(tf.int32, shape=(None,))
+        self.features = tf.placeholder(tf.float32, shape=(None, model.dims[0]))
+        self.neighbors = tf.placeholder(tf.int32, shape=(None, minibatch.max_degree))
+        self.pairs = tf.placeholder(tf.int32, shape=(None, 2))
+        self.pair_rows = tf.placeholder(tf.int32, shape=(None,))
+        self.rows = tf.placeholder(tf.int32, shape=(None,))
+        self.words = tf.placeholder(tf.int32, shape=(None, doc_len))
+        self.counts = tf.placeholder(tf.float32, shape=(None, doc_len))
+        self.update_op = [tf.scatter_update(model.features, self.nodes, self.features),
+                          tf.scatter_update(adj_info, self.nodes, self.neighbors),
+                          tf.scatter_nd_update(model.edge_idxs, self.pairs, self.pair_rows),
+                          tf.scatter_update(model.edge_words, self.rows, self.words),
+                          tf.scatter_update(model.edge_counts, self.rows, self.counts)]
+        self.weights = None
+        if sampler.weights is not None:
+            self.weights = tf.placeholder(tf.float32, shape=(None, minibatch.max_degree))
+            self.update_op.append(tf.scatter_update(sampler.weights, self.nodes, self.weights))
+
+    def add(self, delta):
+        """
+        Args:
+            delta: list of (user_id, item_id, doc), as DataLoader.update
+        Returns:
+            sorted idx of the nodes to re-embed: the new and affected nodes
+            and their 1-hop neighbors, which aggregate them
+        """
+        with self.lock:
+            loader = self.loader
+            minibatch = self.minibatch
+            new_ids = set()
+            for u_id, i_id, doc in delta:
+                for node_id, id_map in [(u_id, loader.user_dict), (i_id, loader.item_dict)]:
+                    if node_id not in id_map:
+                        new_ids.add((id(id_map), node_id))
+            if len(loader.adj) + len(new_ids) > minibatch.num_rows:
+                raise ValueError('cold start capacity of {} nodes exhausted'.format(minibatch.num_rows))
+            if minibatch.num_edges + len(delta) > minibatch.edge_words.shape[0]:
+                raise ValueError('cold start capacity of {} edges exhausted'.format(minibatch.edge_words.shape[0]))
+
+            affected = sorted(loader.update(delta, persist=False))
+
+            # one doc row per touched pair, shared by both directions
+            pairs = []
+            rows = []
+            docs = []
+            for u_id, i_id, doc in delta:
+                u = loader.user_dict[u_id]
+                i = loader.item_dict[i_id]
+                if u == i:
+                    continue
+                row = minibatch.edge_idx[u, i]
+                if row == 0:
+                    row = minibatch.num_edges
+                    minibatch.num_edges += 1
+                for pair in [(u, i), (i, u)]:
+                    minibatch.edge_idx[pair] = row
+                    pairs.append(pair)
+                    rows.append(row)
+                docs.append((row, loader.edge_text[(u, i)]))
+            docs = dict(docs)
+            bags = [minibatch.doc_row(doc) for doc in docs.values()]
+            neighbors = [minibatch.neighbor_row(np.array(list(loader.G_trn.neighbors(k)))) for k in affected]
+            neighbors = np.array(neighbors).reshape(-1, minibatch.max_degree)
+            words = np.array([w for w, c in bags]).reshape(-1, minibatch.edge_words.shape[1])
+            counts = np.array([c for w, c in bags]).reshape(-1, minibatch.edge_words.shape[1])
+            # keep the host tables in sync
+            minibatch.adj[affected] = neighbors
+            minibatch.edge_words[list(docs.keys())] = words
+            minibatch.edge_counts[list(docs.keys())] = counts
+
+            feed_dict = {self.nodes: affected,
+                         self.features: loader.features[affected],
+                         self.neighbors: neighbors,
+                         self.pairs: np.array(pairs, dtype=np.int32).reshape(-1, 2),
+                         self.pair_rows: rows,
+                         self.rows: list(docs.keys()),
+                         self.words: words,
+                         self.counts: counts}
+            if self.weights is not None:
+                feed_dict[self.weights] = minibatch.neighbor_weights(affected)
+            self.sess.run(self.update_op, feed_dict=feed_dict)
+            reembed = set(affected)
+            for k in affected:
+                reembed.update(loader.G_trn.neighbors(k))
+            return sorted(reembed)
+
+
+class InferenceServer(object):
+    """
+    Long-lived inference over a trained CGAT session.
+    Requests wait in a bounded queue, and one worker merges them into micro-batches
+    of at most max_batch items, waiting at most max_wait seconds to fill a batch
+    """
+    def __init__(self, sess, model, placeholders, max_batch=256, max_wait=0.005, queue_size=1024, cold_start=None):
+        self.sess = sess
+        self.model = model
+        self.placeholders = placeholders
+        self.cold_start = cold_start
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.pairs = tf.placeholder(tf.int32, shape=(None, 2), name='channel_pairs')
+        self.theta = model.edge_channels(self.pairs)
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.latency = {'embed': deque(maxlen=100000), 'channels': deque(maxlen=100000), 'add': deque(maxlen=100000)}
+        self.batch_sizes = deque(maxlen=100000)
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def embed(self, nodes):
+        return self.submit('embed', list(nodes))
+
+    def channels(self, pairs):
+        return self.submit('channels', [tuple(p) for p in pairs])
+
+    def add(self, delta):
+        """
+        Cold start: splice new edges (and their new nodes) into the tables and
+        re-embed the affected nodes
+        Returns:
+            (nodes, embeddings)
+        """
+        t = time.time()
+        nodes = self.cold_start.add(delta)
+        embeddings = self.embed(nodes) if len(nodes) > 0 else np.zeros((0, self.model.dims[-1]))
+        self.latency['add'].append(time.time() - t)
+        return nodes, embeddings
+
+    def submit(self, kind, items, timeout=1.0):
+        """
+        Blocks until the request is served; raises queue.Full when the queue
+        stays full for timeout seconds
+        """
+        t = time.time()
+        req = Request(kind, items)
+        self.queue.put(req, timeout=timeout)
+        req.done.wait()
+        self.latency[kind].append(time.time() - t)
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            size = len(batch[0].items)
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    req = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(req)
+                size += len(req.items)
+            self.batch_sizes.append(size)
+            for kind in ['embed', 'channels']:
+                reqs = [req for req in batch if req.kind == kind]
+                if len(reqs) > 0:
+                    self.serve(kind, reqs)
+
+    def serve(self, kind, reqs):
+        """
+        Answer the valid requests in one run; a request that fails is answered
+        with its own error, without failing the others of the micro-batch
+        """
+        valid = []
+        for req in reqs:
+            req.error = self.validate(kind, req.items)
+            if req.error is None:
+                valid.append(req)
+        if len(valid) > 0:
+            try:
+                self.run_batch(kind, valid)
+            except Exception:
+                # isolate the failing requests
+                for req in valid:
+                    try:
+                        self.run_batch(kind, [req])
+                    except Exception as e:
+                        req.error = e
+        for req in reqs:
+            req.done.set()
+
+    def run_batch(self, kind, reqs):
+        items = [item for req in reqs for item in req.items]
+        if kind == 'embed':
+            outs = self.run_embed(items)
+        else:
+            outs = self.run_channels(items)
+        start = 0
+        for req in reqs:
+            req.result = outs[start : start + len(req.items)]
+            start += len(req.items)
+
+    def num_nodes(self):
+        """
+        Number of nodes with table rows, grows with cold start
+        """
+        if self.cold_start is not None:
+            return len(self.cold_start.loader.adj)
+        # the last row is the padding sentinel
+        return self.model.features.get_shape().as_list()[0] - 1
+
+    def validate(self, kind, items):
+        """
+        Returns:
+            ValueError for the first invalid item of a request, None if all are valid
+        """
+        num_nodes = self.num_nodes()
+        for item in items:
+            nodes = [item] if kind == 'embed' else item
+            if kind == 'channels' and len(nodes) != 2:
+                return ValueError('pair {} does not have 2 nodes'.format(list(item)))
+            for n in nodes:
+                if not isinstance(n, (int, np.integer)) or isinstance(n, bool) or not 0 <= n < num_nodes:
+                    return ValueError('node {} is not in [0, {})'.format(n, num_nodes))
+        return None
+
+    def run_embed(self, nodes):
+        feed_dict = {self.placeholders['batch_size']: len(nodes),
+                     self.placeholders['batch1']: nodes,
+                     self.placeholders['batch2']: nodes,
+                     self.placeholders['is_training']: False}
+        return self.sess.run(self.model.embeddings, feed_dict=feed_dict)
+
+    def run_channels(self, pairs):
+        feed_dict = {self.pairs: np.array(pairs, dtype=np.int32).reshape(-1, 2),
+                     self.placeholders['is_training']: False}
+        return self.sess.run(self.theta, feed_dict=feed_dict)
+
+    def stats(self):
+        stats = {'queue': self.queue.qsize()}
+        if len(self.batch_sizes) > 0:
+            stats['mean_batch'] = float(np.mean(self.batch_sizes))
+        for kind, lats in self.latency.items():
+            if len(lats) == 0:
+                continue
+            lats = np.array(lats) * 1000
+            stats[kind] = {'count': len(lats),
+                           'p50_ms': float(np.percentile(lats, 50)),
+                           'p99_ms': float(np.percentile(lats, 99))}
+        return stats
+
+    def handle(self, request):
+        """
+        One json request: {'op': 'embed', 'nodes': [...]}, {'op': 'channels', 'pairs': [[u, v], ...]},
+        {'op': 'add', 'edges': [[user_id, item_id, {word_idx: count}], ...]} or {'op': 'stats'}
+        """
+        op = request.get('op')
+        try:
+            if op == 'embed':
+                response = {'embeddings': self.embed(request['nodes']).tolist()}
+            elif op == 'channels':
+                response = {'theta': self.channels(request['pairs']).tolist()}
+            elif op == 'add' and self.cold_start is not None:
+                delta = [(u, i, {int(w): c for w, c in doc.items()}) for u, i, doc in request['edges']]
+                nodes, embeddings = self.add(delta)
+                response = {'nodes': [int(n) for n in nodes], 'embeddings': embeddings.tolist()}
+            elif op == 'stats':
+                response = self.stats()
+            else:
+                response = {'error': 'unknown op {}'.format(op)}
+        except queue.Full:
+            response = {'error': 'queue full'}
+        except Exception as e:
+            response = {'error': str(e)}
+        if 'id' in request:
+            response['id'] = request['id']
+        return response
+
+
+def parse_request(text):
+    """
+    Returns:
+        (request, None) for a json object, (None, error response) otherwise
+    """
+    try:
+        request = json.loads(text)
+    except (ValueError, TypeError) as e:
+        return None, {'error': 'invalid json: {}'.format(e)}
+    if not isinstance(request, dict):
+        return None, {'error': 'invalid request: not a json object'}
+    return request, None
+
+def serve_stdio(server, fin=sys.stdin, fout=sys.stdout, workers=64):
+    """
+    Json lines in, json lines out; up to workers lines are served concurrently
+    so that they can share micro-batches, responses carry the request 'id'
+    """
+    lock = threading.Lock()
+    # bounds the lines in flight, reading stops while the pool is busy
+    slots = threading.BoundedSemaphore(workers)
+
+    def respond(line):
+        try:
+            request, response = parse_request(line)
+            if request is not None:
+                response = server.handle(request)
+            with lock:
+                fout.write(json.dumps(response) + '\n')
+                fout.flush()
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for line in fin:
+            if line.strip() == '':
+                continue
+            slots.acquire()
+            pool.submit(respond, line)
+    print (json.dumps(server.stats()), file=sys.stderr)
+
+
+def serve_http(server, port):
+    """
+    POST /embed, POST /channels, POST /add with the json body of handle(); GET /stats
+    """
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, response):
+            body = json.dumps(response).encode()
+            self.send_response(400 if 'error' in response else 200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.reply(server.handle({'op': self.path.strip('/')}))
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+            except ValueError:
+                self.reply({'error': 'invalid Content-Length'})
+                return
+            request, error = ({}, None)
+            if length > 0:
+                request, error = parse_request(self.rfile.read(length).decode('utf-8', 'replace'))
+            if request is None:
+                self.reply(error)
+                return
+            request['op'] = self.path.strip('/')
+            self.reply(server.handle(request))
+
+        def log_message(self, format, *args):
+            pass
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    httpd = ThreadingHTTPServer(('', port), Handler)
+    print ('===== serving on port {} ====='.format(port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print (json.dumps(server.stats()))
@@ -0,0 +1,107 @@
+import numpy as np
+import pickle as pkl
+from scipy.sparse import csr_matrix
+
+
+class TopicIndex(object):
+    """
+    Precomputed channel summaries of a trained CGAT, per layer:
+        top words of each channel (from beta),
+        channel distribution and dominant channel of every edge and node,
+        inverted index: channel -> top edges / top nodes
+    """
+    def __init__(self, num_words=20, num_top=100):
+        self.num_words = num_words
+        self.num_top = num_top
+
+    def build(self, beta, vocab, edge_text, num_nodes, doc_theta=None):
+        """
+        Args:
+            beta: list of [num_channel, vocab_dim] topic-word distributions, one per layer
+            vocab: dict, k=word, v=idx
+            edge_text: dict, k=(node1, node2), v={word_idx: count}
+            doc_theta: function list of docs -> list of [num_docs, num_channel] edge channel
+            distributions per layer, from the trained encoder (CGAT.doc_channels);
+            None: posterior of the docs under beta with a uniform prior, an approximation
+            that ignores the encoder
+        """
+        self.words = np.array([w for w, _ in sorted(vocab.items(), key=lambda kv: kv[1])])
+        # undirected edges in sorted order, docs as a sparse [num_edges, vocab_dim] matrix
+        pairs = sorted(set([(min(p), max(p)) for p in edge_text.keys()]))
+        texts = [edge_text[p] if p in edge_text else edge_text[(p[1], p[0])] for p in pairs]
+        self.num_nodes = num_nodes
+        self.edges = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        self.edge_keys = self.edges[:, 0] * num_nodes + self.edges[:, 1]
+        rows = np.repeat(np.arange(len(pairs)), [len(doc) for doc in texts])
+        cols = np.array([w for doc in texts for w in doc.keys()], dtype=np.int64)
+        vals = np.array([c for doc in texts for c in doc.values()], dtype=np.float32)
+        docs = csr_matrix((vals, (rows, cols)), shape=(len(pairs), len(vocab)))
+
+        thetas = doc_theta(texts) if doc_theta is not None else [None] * len(beta)
+        self.layers = []
+        for b, theta in zip(beta, thetas):
+            self.layers.append(self.build_layer(np.asarray(b, dtype=np.float64), docs, theta))
+            print ('===== topic index: {} channels, {} edges ====='.format(b.shape[0], len(pairs)))
+        return self
+
+    def build_layer(self, beta, docs, edge_theta=None):
+        num_channel = beta.shape[0]
+        top_words = np.argsort(-beta, axis=1)[:, :self.num_words].astype(np.int32)
+        if edge_theta is None:
+            # edge channel posterior with a uniform prior: log p(k|doc) = sum_w c_w log beta[k, w] + const
+            scores = docs.dot(np.log(beta.T + 1e-10))
+            scores -= scores.max(axis=1, keepdims=True)
+            edge_theta = np.exp(scores)
+            edge_theta /= edge_theta.sum(axis=1, keepdims=True)
+        edge_theta = np.asarray(edge_theta, dtype=np.float64)
+        # node channel: average over incident edges
+        node_theta = np.zeros((self.num_nodes, num_channel))
+        np.add.at(node_theta, self.edges[:, 0], edge_theta)
+        np.add.at(node_theta, self.edges[:, 1], edge_theta)
+        node_theta /= np.maximum(node_theta.sum(axis=1, keepdims=True), 1e-10)
+        # inverted index
+        num_top = min(self.num_top, len(edge_theta))
+        top_edges = np.argsort(-edge_theta, axis=0)[:num_top].T.astype(np.int32)
+        top_nodes = np.argsort(-node_theta, axis=0)[:min(self.num_top, self.num_nodes)].T.astype(np.int32)
+        return {'top_words': top_words,
+                'edge_theta': edge_theta.astype(np.float16),
+                'edge_channel': np.argmax(edge_theta, axis=1).astype(np.int16),
+                'node_theta': node_theta.astype(np.float16),
+                'node_channel': np.argmax(node_theta, axis=1).astype(np.int16),
+                'top_edges': top_edges,
+                'top_nodes': top_nodes}
+
+    # lookups
+    def channel_words(self, layer, channel):
+        return list(self.words[self.layers[layer]['top_words'][channel]])
+
+    def channel_edges(self, layer, channel):
+        return [tuple(e) for e in self.edges[self.layers[layer]['top_edges'][channel]]]
+
+    def channel_nodes(self, layer, channel):
+        return list(self.layers[layer]['top_nodes'][channel])
+
+    def edge_idx(self, u, v):
+        key = min(u, v) * self.num_nodes + max(u, v)
+        i = np.searchsorted(self.edge_keys, key)
+        if i == len(self.edge_keys) or self.edge_keys[i] != key:
+            return None
+        return i
+
+    def edge_channel(self, layer, u, v):
+        i = self.edge_idx(u, v)
+        return None if i is None else self.layers[layer]['edge_theta'][i]
+
+    def node_channel(self, layer, node):
+        return self.layers[layer]['node_theta'][node]
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pkl.dump(self.__dict__, f)
+
+    @staticmethod
+    def load(filename):
+        index = TopicIndex()
+        with open(filename, 'rb') as f:
+            index.__dict__.update(pkl.load(f))
+        return index
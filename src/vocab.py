@@ -0,0 +1,167 @@
+import hashlib
+import multiprocessing as mp
+import numpy as np
+
+# tokenizer of the running build, set before the workers are forked
+WORKER = {}
+
+
+def term_hash(term):
+    """
+    Stable 63-bit hash of a term (the builtin hash is salted per process)
+    """
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little') >> 1
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts in depth x width int32 counters: a term is counted in one
+    counter per row, its estimate is the minimum over rows (never below the true count)
+    """
+    def __init__(self, width=2**20, depth=4, seed=0):
+        rand = np.random.RandomState(seed)
+        self.width = width
+        self.depth = depth
+        # row hashes (a * h + b) mod width on 32-bit folded term hashes, without uint64 overflow
+        self.a = rand.randint(1, 2**31, size=(depth, 1)).astype(np.uint64)
+        self.b = rand.randint(0, 2**31, size=(depth, 1)).astype(np.uint64)
+        self.table = np.zeros((depth, width), dtype=np.int32)
+
+    def columns(self, hashes):
+        """
+        [depth, num_terms] counter of every term in every row
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        folded = (hashes ^ (hashes >> np.uint64(32))) & np.uint64(0xffffffff)
+        return ((self.a * folded[np.newaxis, :] + self.b) % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, hashes):
+        cols = self.columns(hashes)
+        for row in range(self.depth):
+            np.add.at(self.table[row], cols[row], 1)
+
+    def query(self, hashes):
+        cols = self.columns(hashes)
+        return self.table[np.arange(self.depth)[:, np.newaxis], cols].min(axis=0)
+
+    def merge(self, table):
+        self.table += table
+
+
+class HashedVocab(dict):
+    """
+    Vocab with a hashing-trick fallback: out-of-vocab terms map into num_buckets
+    extra ids after the kept terms, so vocab_dim is bounded. Buckets are regular
+    entries ('#bucket-i'), len() and items() cover them. Membership and item
+    access are plain dict lookups of kept terms and bucket entries; index() is
+    the id of any term, with the fallback
+    """
+    def __init__(self, terms=(), num_buckets=0):
+        super(HashedVocab, self).__init__()
+        for term in terms:
+            self[term] = len(self)
+        self.offset = len(self)
+        self.num_buckets = num_buckets
+        for i in range(num_buckets):
+            self['#bucket-{}'.format(i)] = self.offset + i
+
+    def index(self, term):
+        """
+        Id of a kept term, else of its hashed bucket (None without buckets);
+        a term spelled like a bucket entry is hashed like any other unkept term
+        """
+        idx = self.get(term)
+        if idx is not None and idx < self.offset:
+            return idx
+        if self.num_buckets == 0:
+            return None
+        return self.offset + term_hash(term) % self.num_buckets
+
+
+def count_chunk(docs):
+    """
+    Worker: document frequency of the terms of a chunk of docs in a local sketch,
+    with heavy-hitter candidates pruned to WORKER['capacity'] terms
+    """
+    sketch = CountMinSketch(WORKER['width'], WORKER['depth'])
+    candidates = {}
+    hashes = []
+    for doc in docs:
+        for t in set(WORKER['tokenize'](doc)):
+            if t not in candidates:
+                candidates[t] = term_hash(t)
+            hashes.append(candidates[t])
+    sketch.add(hashes)
+    return sketch.table, prune(sketch, candidates, WORKER['capacity'])
+
+def prune(sketch, candidates, capacity):
+    """
+    Keep the capacity candidates with the highest estimated counts
+    """
+    if len(candidates) <= capacity:
+        return candidates
+    terms = list(candidates.keys())
+    counts = sketch.query([candidates[t] for t in terms])
+    keep = np.argpartition(-counts, capacity - 1)[:capacity]
+    return dict([(terms[i], candidates[terms[i]]) for i in keep])
+
+def chunks(docs, size):
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+class VocabBuilder(object):
+    """
+    Top-K terms by document frequency, counted in one parallel pass over the
+    corpus in bounded memory: each chunk is counted into a count-min sketch and
+    keeps its heavy hitters, sketches are summed and candidates re-ranked
+    """
+    def __init__(self, max_size=2000, num_buckets=0, workers=4, chunk_size=10000,
+                 width=2**20, depth=4, capacity=0):
+        """
+        Args:
+            num_buckets: hashing-trick buckets for out-of-vocab terms (0: they are dropped)
+            capacity: heavy-hitter candidates kept per chunk and in total (0: 20 * max_size)
+        """
+        self.max_size = max_size
+        self.num_buckets = num_buckets
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.width = width
+        self.depth = depth
+        self.capacity = capacity or 20 * max_size
+
+    def build(self, docs, tokenize):
+        """
+        Args:
+            docs: iterable of raw texts, read once
+            tokenize: function text -> terms (e.g. string2gram with unigrams and bigrams)
+        Returns:
+            HashedVocab, k=term, v=idx, in decreasing document frequency
+        """
+        WORKER.update({'tokenize': tokenize, 'width': self.width, 'depth': self.depth,
+                       'capacity': self.capacity})
+        sketch = CountMinSketch(self.width, self.depth)
+        candidates = {}
+        num_chunks = 0
+        with mp.get_context('fork').Pool(self.workers) as pool:
+            for table, chunk_candidates in pool.imap_unordered(count_chunk, chunks(docs, self.chunk_size)):
+                sketch.merge(table)
+                candidates.update(chunk_candidates)
+                candidates = prune(sketch, candidates, self.capacity)
+                num_chunks += 1
+        terms = list(candidates.keys())
+        counts = sketch.query([candidates[t] for t in terms]) if len(terms) > 0 else np.zeros(0)
+        # ties broken by term, so that the vocab does not depend on the chunk order
+        order = sorted(range(len(terms)), key=lambda i: (-counts[i], terms[i]))[:self.max_size]
+        vocab = HashedVocab([terms[i] for i in order], self.num_buckets)
+        print ('===== vocab: {} terms (+ {} hashed buckets) from {} chunks, df {} .. {} ====='.format(
+                len(order), self.num_buckets, num_chunks,
+                counts[order[0]] if order else 0, counts[order[-1]] if order else 0))
+        return vocab
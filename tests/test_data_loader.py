@@ -0,0 +1,47 @@
+import numpy as np
+import networkx as nx
+
+from src.data_loader import DataLoader, TST_RATIO
+
+
+def loader(G, users, items):
+    # DataLoader on an in-memory graph, without the files of a dataset folder
+    l = DataLoader.__new__(DataLoader)
+    l.adj = nx.to_dict_of_lists(G)
+    l.user_dict = dict([(u, u) for u in users])
+    l.item_dict = dict([(i, i) for i in items])
+    return l
+
+def edge_arrays(l):
+    deg = np.array([len(l.adj[k]) for k in range(len(l.adj))], dtype=np.int64)
+    src = np.repeat(np.arange(len(l.adj), dtype=np.int64), deg)
+    dst = np.concatenate([np.array(l.adj[k], dtype=np.int64) for k in range(len(l.adj))])
+    return deg, src, dst
+
+def test_user_picks_floor_of_degree():
+    # users 0..59 linked to items and to other users (as on stackoverflow)
+    G = nx.gnm_random_graph(100, 1500, seed=1)
+    l = loader(G, range(60), range(60, 100))
+    deg, src, dst = edge_arrays(l)
+    is_user = np.arange(100) < 60
+    pick = l.pick_test_edges(src, deg, is_user, np.random.RandomState(448))
+    picked = np.bincount(src[pick], minlength=100)
+    assert (picked[:60] == np.floor(TST_RATIO * deg[:60])).all()
+    assert (picked[60:] == 0).all()
+    # picks are drawn from the whole adjacency, independently of the node ids
+    assert set(dst[pick]) & set(range(60))
+
+def test_bipartite_test_fraction():
+    G = nx.bipartite.random_graph(50, 30, 0.3, seed=2)
+    l = loader(G, range(50), range(50, 80))
+    deg = np.array([G.degree(n) for n in range(80)])
+    G_trn, G_tst = l.sample_edges(448)
+    for u in range(50):
+        tst = G_tst.degree(u) if u in G_tst else 0
+        assert tst == np.floor(TST_RATIO * deg[u])
+        assert tst + (G_trn.degree(u) if u in G_trn else 0) == deg[u]
+
+def test_same_seed_same_split():
+    G = nx.gnm_random_graph(100, 1500, seed=3)
+    l = loader(G, range(60), range(60, 100))
+    assert sorted(l.sample_edges(7)[1].edges()) == sorted(l.sample_edges(7)[1].edges())